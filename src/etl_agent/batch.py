@@ -0,0 +1,531 @@
+"""
+
+Run a queue of agent tasks (many ETL jobs, or many business questions such as the DABStep ones) as a batch,
+instead of one task at a time.
+
+* Tasks are taken from a queue by a bounded pool of async workers, each one running a (blocking) agent
+  run in a thread of its own: at most `max_workers` tasks run at any given time.
+* All the completions go through a per-provider token bucket (requests per minute, and optionally
+  estimated tokens per minute), shared by all the workers: a burst of tasks is spread over time, instead
+  of hitting the provider limits and failing.
+* Transient errors (rate limits, timeouts, dropped connections, 5xx) are retried with jittered exponential
+  backoff (honoring Retry-After): a rate limited completion also drains the bucket of its provider, so
+  that the other workers slow down too. A task interrupted anyway is retried, resuming its checkpoint.
+* Every result is appended to a JSONL file as soon as it is ready: running the same batch again skips the
+  tasks which already succeeded.
+
+    uv run batch.py tasks.jsonl --template prompt.txt --results results.jsonl --workers 16
+    uv run batch.py --offline 200
+
+A task file has one JSON object per line, with a task_id, and optionally a model_name and a prompt (the
+template): all the other fields are variables of the template, e.g. {"task_id": "5", "question": "..."}.
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from checkpoints import is_transient_error
+from context import approx_tokens
+from fanout import provider_of
+
+
+# one task of the batch: None values fall back to the defaults of the runner
+BatchTask = namedtuple(
+    'BatchTask',
+    ['task_id', 'prompt_variables', 'model_name', 'user_prompt_template'],
+    defaults=(None, None)
+)
+# the outcome of one task, as written to the results file
+TaskResult = namedtuple('TaskResult', ['task_id', 'model_name', 'ok', 'answer', 'attempts', 'seconds', 'error'])
+BatchSummary = namedtuple('BatchSummary', ['results', 'skipped', 'seconds'])
+# the limits of a provider: None means no limit
+ProviderLimit = namedtuple('ProviderLimit', ['requests_per_minute', 'tokens_per_minute'], defaults=(None,))
+# conservative defaults, to raise with the limits of your account
+DEFAULT_PROVIDER_LIMITS = {
+    'together_ai': ProviderLimit(requests_per_minute=600, tokens_per_minute=1_000_000),
+    'openai': ProviderLimit(requests_per_minute=500, tokens_per_minute=800_000),
+}
+DEFAULT_LIMIT = ProviderLimit(requests_per_minute=60)
+
+
+class TaskInterrupted(RuntimeError):
+    """
+    The agent run of a task ended with an error, and was checkpointed: the task can be retried, resuming it.
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: `rate` tokens per second are added, up to `capacity`. Taking tokens
+    reserves them right away (the level can go negative), and waits until the bucket would have had them:
+    concurrent callers are served in order, and never exceed the rate on average.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic, sleep=time.sleep):
+        assert rate > 0 and capacity > 0, "A token bucket needs a positive rate and capacity"
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._level = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Take the tokens, and return how long to wait before using them.
+        """
+        with self._lock:
+            now = self.clock()
+            self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            # a request larger than the bucket waits for a full bucket, instead of forever
+            self._level -= min(amount, self.capacity)
+            return max(0.0, -self._level / self.rate)
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """
+        Wait until the tokens are available, and return the time waited.
+        """
+        wait = self.reserve(amount)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """
+        Empty the bucket for `seconds`, e.g. after the provider said we were over its limit.
+        """
+        with self._lock:
+            self._level = min(self._level, -seconds * self.rate)
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, rng=random) -> float:
+    """
+    Exponential backoff with full jitter: a random delay up to base_delay * 2^attempt (at most max_delay),
+    so that the workers failing together do not retry together.
+    """
+    return rng.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry_after(error: Exception) -> float:
+    """
+    The Retry-After of an error in seconds (on the error, or in the headers of its response), or None.
+    """
+    value = getattr(error, 'retry_after', None)
+    if value is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        value = headers.get('retry-after') if hasattr(headers, 'get') else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedCompletion:
+    """
+    A completion function (litellm signature) sharing the limits of each provider among all its callers,
+    and retrying transient errors with jittered exponential backoff: see the module docstring.
+
+    Parameters:
+    - completion_fn: The completion function to call.
+    - provider_limits: The ProviderLimit of each provider, by name (as in provider_of).
+    - default_limit: The limit of the providers not in provider_limits.
+    - max_retries: How many times a transient error is retried, before it is raised to the caller.
+    - base_delay, max_delay: The backoff parameters, in seconds.
+    """
+
+    def __init__(
+        self,
+        completion_fn,
+        provider_limits: dict = None,
+        default_limit: ProviderLimit = DEFAULT_LIMIT,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        self.completion_fn = completion_fn
+        self.provider_limits = DEFAULT_PROVIDER_LIMITS if provider_limits is None else provider_limits
+        self.default_limit = default_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.waited = 0.0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def buckets(self, provider: str) -> tuple:
+        """
+        The (requests, tokens) buckets of a provider: None for the missing limits.
+        """
+        with self._lock:
+            if provider not in self._buckets:
+                limit = self.provider_limits.get(provider, self.default_limit)
+                # one second worth of requests can go at once, and a full minute of tokens
+                self._buckets[provider] = (
+                    TokenBucket(limit.requests_per_minute / 60, max(1.0, limit.requests_per_minute / 60))
+                    if limit.requests_per_minute else None,
+                    TokenBucket(limit.tokens_per_minute / 60, limit.tokens_per_minute)
+                    if limit.tokens_per_minute else None
+                )
+            return self._buckets[provider]
+
+    def __call__(self, model: str, messages: list, max_tokens: int = None, **kwargs):
+        requests, tokens = self.buckets(provider_of(model))
+        # what the request may cost: the prompt, and at most max_tokens of completion
+        cost = approx_tokens(json.dumps(messages, default=str)) + (max_tokens or 0)
+        attempt = 0
+        while True:
+            if requests is not None:
+                self.waited += requests.acquire()
+            if tokens is not None:
+                self.waited += tokens.acquire(cost)
+            try:
+                return self.completion_fn(model=model, messages=messages, max_tokens=max_tokens, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient_error(e):
+                    raise
+                delay = max(retry_after(e) or 0.0, backoff_delay(attempt, self.base_delay, self.max_delay))
+                if requests is not None and getattr(e, 'status_code', None) == 429:
+                    # the provider is telling all of us to slow down, not only this caller
+                    requests.pause(delay)
+                with self._lock:
+                    self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+
+
+def load_tasks(path: str, template: str = None) -> list:
+    """
+    Read the BatchTasks of a JSONL file (see the module docstring): template is the default prompt.
+    """
+    tasks = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            task_id = str(row.pop('task_id'))
+            tasks.append(BatchTask(
+                task_id=task_id,
+                model_name=row.pop('model_name', None),
+                user_prompt_template=row.pop('prompt', template),
+                prompt_variables=row
+            ))
+    return tasks
+
+
+def completed_tasks(results_path: str) -> set:
+    """
+    The ids of the tasks which already succeeded, according to the results file.
+    """
+    done = set()
+    if results_path and os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # the last line of a killed run may be incomplete
+                    continue
+                if row.get('ok'):
+                    done.add(row['task_id'])
+    return done
+
+
+async def run_batch(
+    tasks: list,
+    run_task,
+    results_path: str,
+    max_workers: int = 8,
+    max_attempts: int = 3,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    skip_completed: bool = True
+) -> BatchSummary:
+    """
+    Run the tasks on a bounded pool of workers, streaming the results to a JSONL file.
+
+    Parameters:
+    - tasks: The BatchTasks to run.
+    - run_task: A (blocking) function run_task(task, attempt) returning the answer of the task, or None if
+      the agent failed; raising a transient error or TaskInterrupted makes the task be retried.
+    - results_path: The JSONL file the TaskResults are appended to.
+    - max_workers: How many tasks run at the same time.
+    - max_attempts: How many times a task is attempted at most.
+    - base_delay, max_delay: The backoff between attempts, in seconds.
+    - skip_completed: Skip the tasks which already succeeded in the results file.
+    """
+    start = time.perf_counter()
+    done = completed_tasks(results_path) if skip_completed else set()
+    queue = asyncio.Queue()
+    skipped = 0
+    for task in tasks:
+        if task.task_id in done:
+            skipped += 1
+        else:
+            queue.put_nowait(task)
+    print(f"📋 {queue.qsize()} tasks to run with {max_workers} workers ({skipped} already done)")
+    if os.path.dirname(results_path):
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    results = []
+    loop = asyncio.get_running_loop()
+    threads = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch-task')
+
+    async def run_one(task: BatchTask) -> TaskResult:
+        task_start = time.perf_counter()
+        answer, error, attempt = None, None, 0
+        while attempt < max_attempts:
+            attempt += 1
+            try:
+                answer = await loop.run_in_executor(threads, run_task, task, attempt)
+                error = None
+                break
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if attempt >= max_attempts or not (isinstance(e, TaskInterrupted) or is_transient_error(e)):
+                    break
+                delay = max(retry_after(e) or 0.0, backoff_delay(attempt - 1, base_delay, max_delay))
+                print(f"🔁 Task {task.task_id} failed ({error}), attempt {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        return TaskResult(
+            task_id=task.task_id,
+            model_name=task.model_name,
+            ok=answer is not None,
+            answer=answer,
+            attempts=attempt,
+            seconds=time.perf_counter() - task_start,
+            error=error
+        )
+
+    async def worker(results_file):
+        while True:
+            try:
+                task = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            result = await run_one(task)
+            results.append(result)
+            # one line per result, as soon as it is ready: a killed batch loses nothing finished
+            results_file.write(json.dumps(result._asdict(), default=str) + "\n")
+            results_file.flush()
+            print(f"{'✅' if result.ok else '❌'} Task {result.task_id} in {result.seconds:.1f}s "
+                  f"({len(results)} done, {queue.qsize()} queued)")
+
+    try:
+        with open(results_path, 'a') as results_file:
+            await asyncio.gather(*[worker(results_file) for _ in range(max(1, min(max_workers, queue.qsize())))])
+    finally:
+        threads.shutdown(wait=False)
+
+    return BatchSummary(results=results, skipped=skipped, seconds=time.perf_counter() - start)
+
+
+@contextmanager
+def react_task_runner(
+    s3_raw_bucket: str,
+    bauplan_api_key: str,
+    eb2_api_key: str,
+    model_name: str,
+    max_tokens: int,
+    max_iterations: int,
+    llm_folder: str,
+    completion_fn=None,
+    executor_factory=None,
+    temperature: float = 0.7,
+    **loop_kwargs
+):
+    """
+    Build a run_task function for run_batch running run_react_loop, with rate limited completions shared
+    by all the tasks. Each task has its own folder for the generated code and its checkpoint: a retried
+    task resumes its run, instead of starting over.
+
+    executor_factory() gives the CodeExecutor of each attempt: by default, a session from an E2B pool
+    shared by the whole batch, which is shut down when the context exits:
+
+        with react_task_runner(...) as run_task:
+            summary = asyncio.run(run_batch(tasks, run_task, results_path))
+    """
+    from etl_agent_loop import run_react_loop, resume_react_loop
+    from checkpoints import RunCheckpoint
+    from prompts import system_prompt, USER_PROMPT_TEMPLATE
+
+    if completion_fn is None:
+        from llm import litellm_completion
+        completion_fn = litellm_completion
+    if not isinstance(completion_fn, RateLimitedCompletion):
+        completion_fn = RateLimitedCompletion(completion_fn)
+    if executor_factory is None:
+        from sandbox import SandboxPool, E2BSession, PooledCodeExecutor
+        from wap import sandbox_install_code
+        from preflight import bauplan_requirement
+        pool = SandboxPool(
+            session_factory=lambda: E2BSession(api_key=eb2_api_key, envs={'BAUPLAN_API_KEY': bauplan_api_key}),
+            size=2,
+            warm_packages=[bauplan_requirement()],
+            warmup_code='import bauplan\n' + sandbox_install_code()
+        )
+        executor_factory = lambda: PooledCodeExecutor(pool)
+    else:
+        pool = None
+
+    def run_task(task: BatchTask, attempt: int):
+        task_folder = os.path.join(llm_folder, 'batch', task.task_id)
+        checkpoint_folder = os.path.join(task_folder, 'checkpoints')
+        os.makedirs(os.path.join(task_folder, 'etl_agent'), exist_ok=True)
+        run_id = f"task-{task.task_id}"
+        executor = executor_factory()
+        try:
+            if attempt > 1 and os.path.exists(os.path.join(checkpoint_folder, f"{run_id}.json")):
+                answer = resume_react_loop(
+                    run_id=run_id,
+                    checkpoint_folder=checkpoint_folder,
+                    bauplan_api_key=bauplan_api_key,
+                    eb2_api_key=eb2_api_key,
+                    executor=executor,
+                    completion_fn=completion_fn,
+                    **loop_kwargs
+                )
+            else:
+                answer = run_react_loop(
+                    templated_user_input=task.user_prompt_template or USER_PROMPT_TEMPLATE,
+                    s3_raw_bucket=s3_raw_bucket,
+                    bauplan_api_key=bauplan_api_key,
+                    model_name=task.model_name or model_name,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    eb2_api_key=eb2_api_key,
+                    system_prompt=system_prompt(),
+                    max_iterations=max_iterations,
+                    llm_folder=task_folder,
+                    executor=executor,
+                    completion_fn=completion_fn,
+                    prompt_variables=task.prompt_variables,
+                    checkpoint_folder=checkpoint_folder,
+                    run_id=run_id,
+                    **loop_kwargs
+                )
+        finally:
+            executor.close()
+        checkpoint = RunCheckpoint.load(checkpoint_folder, run_id)
+        if checkpoint.data['status'] == 'error':
+            raise TaskInterrupted(checkpoint.data['error'])
+        return answer
+
+    try:
+        yield run_task
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def _offline_batch(n_tasks: int, results_path: str, max_workers: int) -> BatchSummary:
+    """
+    Run a batch of scripted agents against a fake provider allowing 20 requests per second: no network
+    involved. Some executions fail with a dropped connection, to exercise the retries.
+    """
+    import tempfile
+    from fakes import ScriptedLLM, FakeCodeExecutor, RateLimitedProvider
+
+    code = (
+        "<reasoning>Answer the question</reasoning><packages>bauplan</packages>"
+        "<code>try:\n    print('42')\nexcept Exception as e:\n    print(e)</code>"
+    )
+
+    def scripted(model: str, messages: list, **kwargs):
+        # the first turn writes code, the next one answers: the same for every task
+        text = code if len(messages) <= 2 else "<done>42</done>"
+        return ScriptedLLM([text], delay=0.05)(model=model, messages=messages, **kwargs)
+
+    provider = RateLimitedProvider(scripted, requests_per_second=20)
+    completion_fn = RateLimitedCompletion(
+        provider,
+        provider_limits={'together_ai': ProviderLimit(requests_per_minute=20 * 60)},
+        base_delay=0.1,
+        max_delay=2.0
+    )
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    def on_run(code, packages):
+        with rng_lock:
+            failed = rng.random() < 0.05
+        if failed:
+            raise ConnectionError("Sandbox connection dropped")
+        from utils import ExecutorResponse
+        return ExecutorResponse(result=[], stdout=['42\n'], stderr=[], error=None)
+
+    tasks = [
+        BatchTask(task_id=str(i), prompt_variables={'question': f"Question {i}"}, user_prompt_template="{question} on {s3_raw_bucket}")
+        for i in range(n_tasks)
+    ]
+    with react_task_runner(
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        eb2_api_key='fake',
+        model_name='together_ai/fake-model',
+        max_tokens=1000,
+        max_iterations=4,
+        llm_folder=tempfile.mkdtemp(prefix='batch_'),
+        completion_fn=completion_fn,
+        executor_factory=lambda: FakeCodeExecutor(on_run=on_run, delay=0.2)
+    ) as run_task:
+        summary = asyncio.run(run_batch(tasks, run_task, results_path, max_workers=max_workers, base_delay=0.1))
+    print(f"Provider rejected {provider.rejected} requests, {completion_fn.retries} retries, "
+          f"{completion_fn.waited:.1f}s spent waiting for the rate limit")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a batch of agent tasks")
+    parser.add_argument('tasks', nargs='?', help="the tasks, as JSONL")
+    parser.add_argument('--template', default=None, help="a file with the prompt template of the tasks")
+    parser.add_argument('--results', default='results.jsonl', help="where to append the results (JSONL)")
+    parser.add_argument('--workers', type=int, default=8, help="tasks running at the same time")
+    parser.add_argument('--model', default='together_ai/deepseek-ai/DeepSeek-V3', help="the default model")
+    parser.add_argument('--rpm', type=int, default=None, help="requests per minute for the provider of the model")
+    parser.add_argument('--offline', type=int, default=None, metavar='N', help="run N scripted tasks against fakes")
+    args = parser.parse_args()
+    if args.offline:
+        import tempfile
+        results_path = os.path.join(tempfile.mkdtemp(prefix='batch_'), 'results.jsonl')
+        summary = _offline_batch(args.offline, results_path, args.workers)
+    else:
+        from config import load_env, check_env, completion_from_env
+        from etl_agent_loop import MAX_TOKENS, MAX_ITERATIONS
+        load_env()
+        check_env(['BAUPLAN_API_KEY', 'E2B_API_KEY', 'S3_BUCKET_RAW_DATA'])
+        assert args.tasks, "Pass the tasks file, or --offline N"
+        template = None
+        if args.template:
+            with open(args.template) as f:
+                template = f.read()
+        limits = dict(DEFAULT_PROVIDER_LIMITS)
+        if args.rpm:
+            limits[provider_of(args.model)] = ProviderLimit(requests_per_minute=args.rpm)
+        results_path = args.results
+        with react_task_runner(
+            s3_raw_bucket=os.environ['S3_BUCKET_RAW_DATA'],
+            bauplan_api_key=os.environ['BAUPLAN_API_KEY'],
+            eb2_api_key=os.environ['E2B_API_KEY'],
+            model_name=args.model,
+            max_tokens=MAX_TOKENS,
+            max_iterations=MAX_ITERATIONS,
+            llm_folder=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_code"),
+            completion_fn=RateLimitedCompletion(completion_from_env(), provider_limits=limits)
+        ) as run_task:
+            summary = asyncio.run(run_batch(load_tasks(args.tasks, template), run_task, results_path, max_workers=args.workers))
+    ok = sum(r.ok for r in summary.results)
+    rate = len(summary.results) / summary.seconds * 3600 if summary.seconds else 0
+    print(f"📊 {ok}/{len(summary.results)} tasks succeeded ({summary.skipped} skipped) in {summary.seconds:.1f}s, "
+          f"{rate:.0f} tasks/hour: results in {results_path}")
@@ -0,0 +1,349 @@
+"""
+
+Offline benchmark for the agent loop: it runs run_react_loop end to end against deterministic stand-ins
+(a scripted LLM, a local sandbox session, a fake Bauplan client), over a suite of scenarios, to measure
+the overhead of the loop itself, independently of the remote services.
+
+For each scenario we report latency percentiles per stage, memory peaks and iterations to success,
+in a JSON file that can be compared with the one of another commit:
+
+    uv run benchmark.py --output bench.json
+    uv run benchmark.py --output bench_new.json --compare bench.json
+
+With --startup, it measures instead the time to import the entry points (with `python -X importtime`,
+in fresh interpreters), and fails if one goes over IMPORT_BUDGET_MS, or imports a provider SDK: short-lived
+workers and tools should only pay for what they use.
+
+    uv run benchmark.py --startup
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+
+# the modules whose import time is measured, the budget of each (median cumulative time, in ms), and
+# the packages they must not import (they are loaded on first use)
+STARTUP_MODULES = ('etl_agent_loop', 'batch', 'fanout', 'verifier', 'routing', 'checkpoints', 'prompts', 'config')
+IMPORT_BUDGET_MS = 250
+HEAVY_MODULES = ('litellm', 'e2b', 'e2b_code_interpreter', 'dotenv', 'bauplan', 'pyarrow', 'boto3', 'openai')
+
+# a scenario: the scripted responses of the model, and the number of iterations the run should need
+Scenario = namedtuple('Scenario', ['name', 'responses', 'expected_iterations'])
+
+_IMPORT = (
+    "<reasoning>Import the raw files in a temporary branch and check the tables.</reasoning>\n"
+    "<packages>bauplan</packages>\n"
+    "<code>\n"
+    "import bauplan\n"
+    "try:\n"
+    "    client = bauplan.Client()\n"
+    "    branch = client.info().user.username + '.etl_bench'\n"
+    "    if client.has_branch(branch):\n"
+    "        client.delete_branch(branch)\n"
+    "    client.create_branch(branch, from_ref='main')\n"
+    "    for t in ['acquirer_countries', 'payments', 'merchant_category_codes', 'fees', 'merchant_data']:\n"
+    "        client.create_table(t, search_uri=f's3://raw/{t}.parquet', branch=branch, replace=True)\n"
+    "        client.import_data(t, search_uri=f's3://raw/{t}.parquet', branch=branch)\n"
+    "        assert client.query(f'SELECT * FROM {t} LIMIT 3', ref=branch).num_rows > 0\n"
+    "    client.merge_branch(source_ref=branch, into_branch='main')\n"
+    "    print(branch)\n"
+    "except Exception as e:\n"
+    "    print(f'ETL failed: {e}')\n"
+    "</code>"
+)
+_BROKEN = (
+    "<reasoning>First attempt at the import.</reasoning>\n"
+    "<packages>bauplan</packages>\n"
+    "<code>\n"
+    "import bauplan\n"
+    "client = bauplan.Client()\n"
+    "client.client.create_table('payments', search_uri='s3://raw/payments.parquet', branch='main')\n"
+    "</code>"
+)
+_LARGE_STDOUT = (
+    "<reasoning>Print every file in the bucket while importing.</reasoning>\n"
+    "<packages>bauplan</packages>\n"
+    "<code>\n"
+    "try:\n"
+    "    for i in range(200000):\n"
+    "        print(f'raw/part-{i:06d}.parquet imported')\n"
+    "except Exception as e:\n"
+    "    print(f'ETL failed: {e}')\n"
+    "</code>"
+)
+_DONE = "<done>Temporary branch name: fake_user.etl_bench</done>"
+
+SCENARIOS = [
+    Scenario('first_try_success', [_IMPORT, _DONE], 2),
+    Scenario('multi_iteration_repair', [_BROKEN, _BROKEN, _IMPORT, _DONE], 4),
+    Scenario('malformed_responses', ["Sure! Here is the code: import bauplan", _IMPORT.replace('</code>', ''), _IMPORT, _DONE], 4),
+    Scenario('large_stdout', [_LARGE_STDOUT, _IMPORT, _DONE], 3),
+]
+
+
+class _TimedCompletion:
+    """
+    Wrap a completion function and record how long each completion takes, until its stream is closed.
+    """
+
+    def __init__(self, completion_fn):
+        self.completion_fn = completion_fn
+        self.durations = []
+
+    def __call__(self, **kwargs):
+        start = time.perf_counter()
+        response = self.completion_fn(**kwargs)
+        if not kwargs.get('stream'):
+            self.durations.append(time.perf_counter() - start)
+            return response
+        return self._timed(response, start)
+
+    def _timed(self, stream, start):
+        try:
+            yield from stream
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+
+class _TimedExecutor:
+    """
+    Wrap a CodeExecutor and record how long each execution takes.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.durations = []
+
+    def prepare(self, python_packages: list = None):
+        self.executor.prepare(python_packages)
+
+    def run_code(self, code: str, python_packages: list = None):
+        start = time.perf_counter()
+        try:
+            return self.executor.run_code(code, python_packages)
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+    def close(self):
+        self.executor.close()
+
+
+def _fake_bauplan_path() -> str:
+    # a folder with a `bauplan` module backed by FakeBauplanClient, to put first in the sandbox path
+    folder = tempfile.mkdtemp(prefix='fake_bauplan_')
+    with open(os.path.join(folder, 'bauplan.py'), 'w') as f:
+        f.write("from fakes import FakeBauplanClient\n\ndef Client(**kwargs):\n    return FakeBauplanClient()\n")
+    return folder
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+        'mean': statistics.fmean(ordered), 'max': ordered[-1]
+    }
+
+
+def run_scenario(scenario: Scenario, runs: int, pool, llm_folder: str) -> dict:
+    """
+    Run a scenario `runs` times, and aggregate its metrics.
+    """
+    from etl_agent_loop import run_react_loop
+    from fakes import ScriptedLLM
+    from sandbox import PooledCodeExecutor
+    from tracing import InMemorySpanExporter, configure_tracing
+
+    spans = InMemorySpanExporter()
+    configure_tracing(exporters=[spans])
+    totals, llm, execute, overhead, peaks, iterations, successes = [], [], [], [], [], [], 0
+    for _ in range(runs):
+        completion_fn = _TimedCompletion(ScriptedLLM(scenario.responses))
+        executor = _TimedExecutor(PooledCodeExecutor(pool))
+        tracemalloc.start()
+        start = time.perf_counter()
+        # the loop logs are not part of what we measure
+        with contextlib.redirect_stdout(io.StringIO()):
+            answer = run_react_loop(
+                templated_user_input="Run the ETL on {s3_raw_bucket}",
+                s3_raw_bucket='s3://raw',
+                bauplan_api_key='fake',
+                model_name='scripted/model',
+                max_tokens=4000,
+                temperature=0.0,
+                eb2_api_key='fake',
+                system_prompt='You are a data agent.',
+                max_iterations=len(scenario.responses),
+                llm_folder=llm_folder,
+                executor=executor,
+                completion_fn=completion_fn
+            )
+        total = time.perf_counter() - start
+        peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+        tracemalloc.stop()
+        executor.close()
+        totals.append(total * 1000)
+        llm.extend(d * 1000 for d in completion_fn.durations)
+        execute.extend(d * 1000 for d in executor.durations)
+        overhead.append((total - sum(completion_fn.durations) - sum(executor.durations)) * 1000)
+        if answer is not None:
+            successes += 1
+            iterations.append(len(completion_fn.durations))
+
+    # every traced stage, e.g. llm.completion, response.parse, sandbox.install, sandbox.execute
+    span_durations = {}
+    for span in spans.spans:
+        span_durations.setdefault(span.name, []).append(span.duration * 1000)
+    return {
+        'runs': runs,
+        'success_rate': successes / runs,
+        'expected_iterations': scenario.expected_iterations,
+        'iterations_to_success': percentiles(iterations),
+        'latency_ms': {
+            'run_total': percentiles(totals),
+            'llm_stream': percentiles(llm),
+            'execute': percentiles(execute),
+            'loop_overhead': percentiles(overhead),
+            **{f"span:{name}": percentiles(values) for name, values in sorted(span_durations.items())}
+        },
+        'peak_memory_kb': percentiles(peaks)
+    }
+
+
+def run_benchmark(runs: int = 10, scenarios: list = None) -> dict:
+    from sandbox import LocalSession, SandboxPool
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    envs = {'PYTHONPATH': os.pathsep.join([_fake_bauplan_path(), here])}
+    llm_folder = tempfile.mkdtemp(prefix='bench_llm_code_')
+    os.makedirs(os.path.join(llm_folder, 'etl_agent'))
+    pool = SandboxPool(session_factory=lambda: LocalSession(envs=envs), size=1, warmup_code='import bauplan')
+    try:
+        results = {s.name: run_scenario(s, runs, pool, llm_folder) for s in (scenarios or SCENARIOS)}
+    finally:
+        pool.close()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=here).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs_per_scenario': runs,
+        'scenarios': results
+    }
+
+
+def measure_startup(module: str, runs: int = 5) -> dict:
+    """
+    Import the module in `runs` fresh interpreters with -X importtime: return the median cumulative import
+    time (ms), the slowest imports of the median run, and the heavy packages it imported.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')])))
+    measured = []
+    for _ in range(runs):
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+            cwd=here, env=env, capture_output=True, text=True, check=True
+        ).stderr
+        # "import time: self [us] | cumulative | imported package", nested imports are indented, and
+        # listed before their parent: the ones of the module follow the last top level one before it
+        # (what the interpreter imports at startup)
+        imports = []
+        for line in stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            if not parts[2].startswith('  '):
+                if parts[2].strip() == module:
+                    measured.append((int(parts[1]) / 1000, imports))
+                    break
+                imports = []
+                continue
+            imports.append((parts[2].strip(), int(parts[1]) / 1000))
+    measured.sort(key=lambda m: m[0])
+    total, imports = measured[len(measured) // 2]
+    return {
+        'import_ms': total,
+        'slowest': sorted(imports, key=lambda i: -i[1])[:5],
+        'heavy': sorted({n for n, _ in imports if n.split('.')[0] in HEAVY_MODULES})
+    }
+
+
+def check_startup(modules: tuple = STARTUP_MODULES, runs: int = 5, budget_ms: float = IMPORT_BUDGET_MS) -> bool:
+    """
+    Measure the import time of every module, print it, and return False if one is over the budget or
+    imports a heavy package.
+    """
+    ok = True
+    for module in modules:
+        startup = measure_startup(module, runs)
+        over = startup['import_ms'] > budget_ms
+        ok = ok and not over and not startup['heavy']
+        print(f"{'❌' if over or startup['heavy'] else '✅'} {module:>16}: {startup['import_ms']:7.1f} ms "
+              f"(budget {budget_ms} ms), slowest: " + ', '.join(f"{n} {ms:.1f}" for n, ms in startup['slowest']))
+        if startup['heavy']:
+            print(f"   imports heavy packages at import time: {', '.join(startup['heavy'])}")
+    return ok
+
+
+def compare(current: dict, baseline: dict):
+    """
+    Print the p50 of every stage of the current benchmark against the baseline one.
+    """
+    print(f"Comparing {current.get('commit')} against {baseline.get('commit')} (p50, ms)")
+    for name, scenario in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for stage, stats in scenario['latency_ms'].items():
+            old, new = base['latency_ms'].get(stage, {}).get('p50'), stats.get('p50')
+            if not old or new is None:
+                continue
+            print(f"{name:>24} {stage:>14}: {old:9.2f} -> {new:9.2f} ({(new - old) / old * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the ETL agent loop")
+    parser.add_argument('--runs', type=int, default=10, help="runs per scenario")
+    parser.add_argument('--output', default='bench.json', help="where to write the results (JSON)")
+    parser.add_argument('--compare', default=None, help="a previous results file to compare against")
+    parser.add_argument('--startup', action='store_true', help="check the import time of the entry points instead")
+    args = parser.parse_args()
+    if args.startup:
+        sys.exit(0 if check_startup() else 1)
+    results = run_benchmark(runs=args.runs)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, scenario in results['scenarios'].items():
+        latency = scenario['latency_ms']
+        print(f"{name:>24}: success {scenario['success_rate']:.0%}, "
+              f"iterations p50 {scenario['iterations_to_success'].get('p50')}, "
+              f"run p50 {latency['run_total']['p50']:.1f} ms, "
+              f"overhead p50 {latency['loop_overhead']['p50']:.1f} ms, "
+              f"peak memory p50 {scenario['peak_memory_kb']['p50']:.0f} KB")
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    sys.exit(0)
@@ -0,0 +1,236 @@
+"""
+
+A catalog of the raw data in the S3 bucket, built from the parquet footers only, to give the agent upfront
+what it would otherwise discover in its first iterations (listing files, guessing schemas and ID columns).
+
+For every parquet file, we read the footer with range requests (the last bytes of the file, where parquet
+keeps schema, row count and column statistics): no file is downloaded. Footers are cached locally, keyed
+by the object ETag, so that the catalog of an unchanged bucket is rebuilt with one listing only. Files are
+grouped into tables: a file at the top of the bucket is a table, a folder of files (e.g. payments/*) too.
+
+"""
+
+import io
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_CATALOG_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'data-agents', 'catalog.json')
+# what a footer tells us about one file
+FileEntry = namedtuple('FileEntry', ['key', 'size', 'etag', 'num_rows', 'num_row_groups', 'columns', 'non_null'])
+# a table of the catalog: uri is what to import (the file, or the folder with the * pattern)
+TableEntry = namedtuple('TableEntry', ['name', 'uri', 'files', 'size', 'num_rows', 'columns', 'key_candidates'])
+# the parquet footer is at the end of the file: one request for the tail is usually enough
+TAIL_BYTES = 64 * 1024
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file over an S3 object, reading with range requests: the tail of the object is
+    fetched once (where the parquet footer is), any other read is a range request of its own.
+    `bytes_read` counts the bytes actually transferred.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, size: int, etag: str = None, tail_bytes: int = TAIL_BYTES):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+        self.bytes_read = 0
+        self._tail_start = max(0, size - tail_bytes)
+        self._tail = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def _get_range(self, start: int, end: int) -> bytes:
+        kwargs = {'IfMatch': self.etag} if self.etag else {}
+        body = self.s3_client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}", **kwargs
+        )['Body'].read()
+        self.bytes_read += len(body)
+        return body
+
+    def readinto(self, buffer) -> int:
+        end = min(self.size, self.position + len(buffer))
+        if end <= self.position:
+            return 0
+        if self.position >= self._tail_start:
+            if self._tail is None:
+                self._tail = self._get_range(self._tail_start, self.size)
+            data = self._tail[self.position - self._tail_start:end - self._tail_start]
+        else:
+            data = self._get_range(self.position, end)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def read_footer(s3_client, bucket: str, key: str, size: int, etag: str = None) -> FileEntry:
+    """
+    Read the parquet footer of an S3 object, with range requests only.
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_metadata(S3RangeFile(s3_client, bucket, key, size, etag))
+    schema = metadata.schema.to_arrow_schema()
+    # a column has no nulls if the statistics of every row group say so (no statistics: we do not know)
+    non_null = []
+    for i, field in enumerate(schema):
+        stats = [metadata.row_group(rg).column(i).statistics for rg in range(metadata.num_row_groups)]
+        if stats and all(s is not None and s.has_null_count and s.null_count == 0 for s in stats):
+            non_null.append(field.name)
+    return FileEntry(
+        key=key,
+        size=size,
+        etag=etag,
+        num_rows=metadata.num_rows,
+        num_row_groups=metadata.num_row_groups,
+        columns=[[field.name, str(field.type)] for field in schema],
+        non_null=non_null
+    )
+
+
+def key_candidates(table_name: str, columns: list, non_null: list) -> list:
+    """
+    The columns which look like a key of the table, best first: named like an ID (id, *_id, *_reference)
+    or like the table itself (merchant in merchant_data), and never null according to the statistics.
+    """
+    def score(name: str) -> int:
+        lowered = name.lower()
+        if lowered == 'id':
+            return 0
+        if lowered.endswith(('_id', '_reference', '_ref', '_key', '_uuid')):
+            return 1
+        if table_name.lower().split('_')[0] == lowered:
+            return 2
+        return None
+
+    scored = [(score(name), i, name) for i, (name, _) in enumerate(columns) if name in non_null]
+    return [name for s, _, name in sorted(c for c in scored if c[0] is not None)]
+
+
+def _table_name(key: str) -> str:
+    # a file at the top of the bucket is a table named after it, a folder of files too
+    folder = key.split('/')[0]
+    return folder if '/' in key else os.path.splitext(folder)[0]
+
+
+def build_catalog(
+    s3_client,
+    bucket: str,
+    prefix: str = '',
+    cache_path: str = DEFAULT_CATALOG_CACHE,
+    max_workers: int = 8
+) -> list:
+    """
+    List the parquet files of the bucket, read (or reuse from the cache) their footers concurrently,
+    and return the tables, sorted by name.
+    """
+    objects = [
+        obj
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get('Contents', [])
+        if obj['Key'].endswith('.parquet')
+    ]
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    lock = threading.Lock()
+
+    def entry(obj: dict) -> FileEntry:
+        cache_key = f"{bucket}/{obj['Key']}"
+        with lock:
+            cached = cache.get(cache_key)
+        if cached is not None and cached['etag'] == obj['ETag']:
+            return FileEntry(**cached)
+        footer = read_footer(s3_client, bucket, obj['Key'], obj['Size'], obj['ETag'])
+        with lock:
+            cache[cache_key] = footer._asdict()
+        return footer
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(objects) or 1))) as pool:
+        files = list(pool.map(entry, objects))
+    if cache_path:
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+
+    by_table = {}
+    for f in files:
+        by_table.setdefault(_table_name(f.key), []).append(f)
+    tables = []
+    for name, table_files in sorted(by_table.items()):
+        first = table_files[0]
+        # a column is non null in the table if it is non null in every file
+        non_null = [c for c in first.non_null if all(c in f.non_null for f in table_files)]
+        is_folder = '/' in first.key
+        tables.append(TableEntry(
+            name=name,
+            uri=f"s3://{bucket}/{name}/*" if is_folder else f"s3://{bucket}/{first.key}",
+            files=len(table_files),
+            size=sum(f.size for f in table_files),
+            num_rows=sum(f.num_rows for f in table_files),
+            columns=first.columns,
+            key_candidates=key_candidates(name, first.columns, non_null)
+        ))
+    return tables
+
+
+def format_catalog(tables: list, max_columns: int = 40) -> str:
+    """
+    A compact text summary of the catalog, one line per table, to add to the prompt.
+    """
+    lines = []
+    for t in tables:
+        columns = ', '.join(f"{name} {type_}" for name, type_ in t.columns[:max_columns])
+        if len(t.columns) > max_columns:
+            columns += f", ... ({len(t.columns) - max_columns} more)"
+        key = t.key_candidates[0] if t.key_candidates else 'none'
+        lines.append(
+            f"- {t.name}: import from {t.uri} ({t.files} file{'s' if t.files > 1 else ''}, {t.num_rows} rows, "
+            f"{t.size / 1024 / 1024:.1f} MB); ID column: {key}; columns: {columns}"
+        )
+    return "\n".join(lines)
+
+
+def catalog_for_prompt(bucket: str, s3_client=None, cache_path: str = DEFAULT_CATALOG_CACHE) -> str:
+    """
+    The catalog summary of the bucket for the prompt, or None if it cannot be built (e.g. no AWS
+    credentials): the agent can always explore the bucket by itself.
+    """
+    try:
+        if s3_client is None:
+            import boto3
+            from botocore import UNSIGNED
+            from botocore.config import Config
+            # the raw bucket is publicly readable: without credentials, we send unsigned requests
+            no_credentials = boto3.Session().get_credentials() is None
+            s3_client = boto3.client('s3', config=Config(signature_version=UNSIGNED) if no_credentials else None)
+        tables = build_catalog(s3_client, bucket, cache_path=cache_path)
+    except Exception as e:
+        print(f"⚠️ Could not build the raw data catalog of {bucket}: {e}")
+        return None
+    if not tables:
+        return None
+    return format_catalog(tables)
@@ -0,0 +1,313 @@
+"""
+
+Durable checkpoints of the agent runs, so that a run interrupted by an exception (or a killed process)
+does not lose what it already paid for: completions, sandbox executions and the data branch it created.
+
+Every run gets a JSON file in the checkpoint folder (llm_code/checkpoints by default), rewritten atomically
+(write and rename) at every step:
+
+* as soon as a response is parsed, it is saved as pending: a resumed run executes it instead of asking
+  the model again;
+* after every iteration, the full history, the parsed response, a summary of the execution result and the
+  outcome are saved, and the pending response is cleared;
+* the data branches the run created are recorded: the branch assigned to it, the ones its code creates by
+  name and, if a client is available and no branch is assigned, the new branches of the user after each
+  execution; a resumed run is told which of them still exist, and a failed run deletes them. Branch names
+  which only appear in the output are never recorded: they may well belong to someone else.
+
+Resume with `uv run etl_agent_loop.py --resume [RUN_ID]`, list the runs or clean up the branches of a
+run with this script:
+
+    uv run checkpoints.py --list
+    uv run checkpoints.py --cleanup RUN_ID
+
+"""
+
+import argparse
+import ast
+import json
+import os
+import time
+import uuid
+
+
+DEFAULT_CHECKPOINT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'llm_code', 'checkpoints')
+# the status of a run: running (or interrupted, if the process died), done, failed, stopped or error
+RUN_STATUSES = ('running', 'done', 'failed', 'stopped', 'error')
+# how much of the execution output we keep in the checkpoint: the history has what the model saw
+MAX_OUTPUT_CHARS = 20_000
+# errors after which the same request may well succeed: rate limits, timeouts, connections, 5xx
+TRANSIENT_ERROR_NAMES = {
+    'RateLimitError', 'Timeout', 'APITimeoutError', 'APIConnectionError', 'ServiceUnavailableError',
+    'InternalServerError', 'BadGatewayError', 'ConnectionError', 'TimeoutError', 'ConnectTimeout',
+    'ReadTimeout', 'WriteTimeout', 'PoolTimeout', 'RemoteDisconnected', 'RemoteProtocolError', 'ConnectError',
+    'ReadError', 'WriteError',
+    # E2B: the request (or the sandbox) timed out, the sandbox API is rate limited; its other errors
+    # (missing sandbox, authentication, invalid arguments...) fail again
+    'TimeoutException', 'RateLimitException'
+}
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504, 529}
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    True if the error is worth retrying: any class in its hierarchy has a transient name (we do not import
+    litellm or e2b to check their exception types), or it carries a transient HTTP status code.
+    """
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return isinstance(status, int) and status in TRANSIENT_STATUS_CODES
+
+
+def new_run_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def detect_branches(code: str) -> set:
+    """
+    The data branches a piece of code creates by name: the string literals passed as branch to
+    create_branch, e.g. create_branch('jacopo.etl', ...). Names built at runtime are found by comparing
+    the branches before and after the code runs (see user_branches).
+    """
+    try:
+        tree = ast.parse(code or '')
+    except SyntaxError:
+        return set()
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute) or node.func.attr != 'create_branch':
+            continue
+        arguments = node.args[:1] + [k.value for k in node.keywords if k.arg == 'branch']
+        names |= {a.value for a in arguments if isinstance(a, ast.Constant) and isinstance(a.value, str)}
+    return names
+
+
+def user_branches(client, username: str) -> set:
+    """
+    The names of the branches of the user on the lakehouse.
+    """
+    return {b.name for b in client.get_branches(user=username) if b.name.startswith(f"{username}.")}
+
+
+def execution_summary(execution_result) -> dict:
+    """
+    A JSON friendly summary of an ExecutorResponse, with the output truncated to MAX_OUTPUT_CHARS.
+    """
+    def text(items) -> str:
+        joined = ''.join(str(o) for o in items or [])
+        return joined if len(joined) <= MAX_OUTPUT_CHARS else joined[:MAX_OUTPUT_CHARS] + '\n[... truncated ...]'
+
+    return {
+        'result': [str(r)[:MAX_OUTPUT_CHARS] for r in execution_result.result or []],
+        'stdout': text(execution_result.stdout),
+        'stderr': text(execution_result.stderr),
+        'error': None if execution_result.error is None else str(execution_result.error)[:MAX_OUTPUT_CHARS]
+    }
+
+
+class RunCheckpoint:
+    """
+    The checkpoint of one agent run, saved as JSON at every change: see the module docstring.
+
+    Parameters:
+    - path: The JSON file of the run.
+    - data: The state of the run: use RunCheckpoint.create or RunCheckpoint.load to build it.
+    """
+
+    def __init__(self, path: str, data: dict):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def create(cls, folder: str, config: dict, history: list, run_id: str = None) -> 'RunCheckpoint':
+        """
+        Start the checkpoint of a new run: config has what is needed to resume it (no secrets).
+        """
+        run_id = run_id or new_run_id()
+        checkpoint = cls(os.path.join(folder, f"{run_id}.json"), {
+            'run_id': run_id,
+            'status': 'running',
+            'created_at': time.time(),
+            'updated_at': time.time(),
+            'config': config,
+            'history': list(history),
+            'next_iteration': 0,
+            'pending_response': None,
+            'iterations': [],
+            'branches': [],
+            'answer': None,
+            'error': None
+        })
+        checkpoint.save()
+        return checkpoint
+
+    @classmethod
+    def load(cls, folder: str, run_id: str = None) -> 'RunCheckpoint':
+        """
+        Load the checkpoint of a run, or of the most recent one if run_id is None.
+        """
+        if run_id is None:
+            runs = list_runs(folder)
+            assert runs, f"No checkpoints in {folder}"
+            run_id = runs[-1]['run_id']
+        path = os.path.join(folder, f"{run_id}.json")
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    @property
+    def run_id(self) -> str:
+        return self.data['run_id']
+
+    @property
+    def history(self) -> list:
+        return list(self.data['history'])
+
+    @property
+    def next_iteration(self) -> int:
+        return self.data['next_iteration']
+
+    @property
+    def branches(self) -> list:
+        return list(self.data['branches'])
+
+    def pending_response(self, iteration: int) -> str:
+        """
+        The text of the response already received for this iteration, if it was never executed, or None.
+        """
+        pending = self.data['pending_response']
+        return pending['text'] if pending is not None and pending['iteration'] == iteration else None
+
+    def save(self):
+        self.data['updated_at'] = time.time()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=1, default=str)
+        os.replace(tmp_path, self.path)
+
+    def record_response(self, iteration: int, text: str):
+        """
+        Save a parsed response before it is executed.
+        """
+        self.data['pending_response'] = {'iteration': iteration, 'text': text}
+        self.save()
+
+    def record_iteration(
+        self,
+        iteration: int,
+        outcome: str,
+        history: list,
+        response=None,
+        execution_result=None,
+        error: str = None,
+        seconds: float = None,
+        tier: str = None
+    ):
+        """
+        Save a finished iteration: the history after it, the ParsedResponse and the ExecutorResponse, if any,
+        and the model tier which wrote the response (see routing.py).
+        """
+        self.data['iterations'].append({
+            'iteration': iteration,
+            'outcome': outcome,
+            'tier': tier,
+            'response': None if response is None else response._asdict(),
+            'execution': None if execution_result is None else execution_summary(execution_result),
+            'error': error,
+            'seconds': seconds
+        })
+        self.data['history'] = list(history)
+        self.data['next_iteration'] = iteration + 1
+        self.data['pending_response'] = None
+        self.save()
+
+    def add_branches(self, branches):
+        new = sorted(set(branches) - set(self.data['branches']))
+        if new:
+            self.data['branches'] += new
+            self.save()
+
+    def remove_branches(self, branches):
+        self.data['branches'] = [b for b in self.data['branches'] if b not in set(branches)]
+        self.save()
+
+    def finish(self, status: str, answer: str = None, error: str = None):
+        assert status in RUN_STATUSES, f"Unknown status {status}, expected one of {RUN_STATUSES}"
+        self.data.update(status=status, answer=answer, error=error)
+        self.save()
+
+
+def list_runs(folder: str) -> list:
+    """
+    A summary of every checkpointed run in the folder, oldest first.
+    """
+    if not os.path.isdir(folder):
+        return []
+    runs = []
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(folder, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        runs.append({
+            'run_id': data['run_id'],
+            'status': data['status'],
+            'updated_at': data['updated_at'],
+            'model_name': data['config'].get('model_name'),
+            'iterations': data['next_iteration'],
+            'branches': data['branches'],
+            'error': data['error']
+        })
+    return sorted(runs, key=lambda r: r['updated_at'])
+
+
+def existing_branches(client, branches) -> list:
+    """
+    The branches which are still on the lakehouse.
+    """
+    return [b for b in branches if client.has_branch(b)]
+
+
+def cleanup_branches(client, branches) -> list:
+    """
+    Delete the branches which are still on the lakehouse, and return the ones deleted. Only user branches
+    (username.<name>) are ever deleted.
+    """
+    username = client.info().user.username
+    deleted = []
+    for branch in branches:
+        if not branch.startswith(f"{username}."):
+            continue
+        try:
+            if client.has_branch(branch):
+                client.delete_branch(branch)
+                deleted.append(branch)
+        except Exception as e:
+            print(f"Could not delete branch {branch}: {e}")
+    return deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the checkpoints of the agent runs, and clean up their branches")
+    parser.add_argument('--folder', default=DEFAULT_CHECKPOINT_FOLDER, help="the checkpoint folder")
+    parser.add_argument('--list', action='store_true', help="list the runs")
+    parser.add_argument('--cleanup', metavar='RUN_ID', help="delete the data branches of a run")
+    args = parser.parse_args()
+    if args.cleanup:
+        import bauplan
+        from config import load_env
+        load_env()
+        checkpoint = RunCheckpoint.load(args.folder, args.cleanup)
+        client = bauplan.Client(profile=os.environ.get('BAUPLAN_PROFILE', 'default'))
+        deleted = cleanup_branches(client, checkpoint.branches)
+        checkpoint.remove_branches(deleted)
+        print(f"🧹 Deleted {len(deleted)} branches of {checkpoint.run_id}: {deleted}")
+    else:
+        for run in list_runs(args.folder):
+            updated = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['updated_at']))
+            print(f"{run['run_id']}: {run['status']} at {updated}, {run['iterations']} iterations, "
+                  f"model {run['model_name']}, branches {run['branches']}" + (f", error: {run['error']}" if run['error'] else ''))
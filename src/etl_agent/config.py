@@ -0,0 +1,64 @@
+"""
+
+The configuration of the entry points (etl_agent_loop.py, fanout.py, batch.py...), read from the environment
+when they run, and never when a module is imported: tools, tests and the verifier can import anything
+without credentials, and without paying for the provider SDKs.
+
+The .env file is loaded if python-dotenv is installed, and every problem of the configuration is reported
+at once, in one ConfigError, instead of one assert at a time.
+
+"""
+
+import os
+
+
+# how completions are requested: through litellm (any provider), or the built-in HTTP client for
+# OpenAI compatible endpoints (see llm.py), which needs no SDK
+LLM_BACKENDS = ('litellm', 'http')
+
+
+class ConfigError(ValueError):
+    """
+    The environment is missing settings, or has invalid ones: the message lists all of them.
+    """
+    pass
+
+
+def load_env() -> bool:
+    """
+    Load the .env file into the environment, if python-dotenv is installed: return True if a file was loaded.
+    """
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return False
+    return load_dotenv()
+
+
+def check_env(required: list, choices: dict = None, env: dict = None) -> dict:
+    """
+    Check that the required variables are set (and not empty), and that the variables in choices
+    (name -> allowed values) have one of the allowed values, if set. Return the required values.
+    """
+    env = os.environ if env is None else env
+    problems = [f"{name} is not set" for name in required if not env.get(name)]
+    for name, allowed in (choices or {}).items():
+        value = env.get(name)
+        if value and value not in allowed:
+            problems.append(f"{name} is {value!r}, expected one of {', '.join(allowed)}")
+    if problems:
+        raise ConfigError("Invalid configuration (check your .env file): " + "; ".join(problems))
+    return {name: env[name] for name in required}
+
+
+def completion_from_env(env: dict = None):
+    """
+    The completion function LLM_BACKEND asks for: litellm's (imported on the first call) by default, or
+    the built-in HTTP client, for the endpoint at LLM_BASE_URL (or the one of the model provider).
+    """
+    from llm import HTTPCompletion, litellm_completion
+
+    env = os.environ if env is None else env
+    if env.get('LLM_BACKEND', 'litellm') == 'http':
+        return HTTPCompletion(base_url=env.get('LLM_BASE_URL') or None)
+    return litellm_completion
@@ -0,0 +1,170 @@
+"""
+
+Keep the prompt of the ReAct loop within a token budget.
+
+Every iteration adds the full response of the model and the full output of the sandbox to the history,
+and every turn sends all of it again: without care, latency and cost per turn grow with the number of
+iterations. The ContextManager builds the messages for each turn from the full history:
+
+* execution outputs are compacted when they enter the history: repeated lines are collapsed, long
+  stdout / tracebacks keep only their head and tail;
+* superseded attempts (all but the most recent ones) are collapsed into short summaries;
+* if still over budget, the oldest attempts are dropped;
+* the prefix (system prompt with the API docs, and the task) never changes, so that providers can cache it.
+
+"""
+
+from collections import namedtuple
+
+
+# the token accounting of one turn, to report in the logs
+TurnBudget = namedtuple(
+    'TurnBudget',
+    ['prefix_tokens', 'history_tokens', 'total_tokens', 'budget', 'collapsed', 'dropped']
+)
+
+
+def approx_tokens(text: str) -> int:
+    """
+    A fast, provider-agnostic estimate of the number of tokens of a text (~4 characters per token).
+    Pass a real tokenizer to the ContextManager (e.g. litellm.token_counter) for exact numbers.
+    """
+    return (len(text) + 3) // 4
+
+
+def compact_output(text: str, max_chars: int = 4000, head_lines: int = 20, tail_lines: int = 40) -> str:
+    """
+    Compact a long output (stdout, stderr, traceback): runs of identical lines are collapsed into one,
+    and if the text is still longer than max_chars we keep its first and last lines, where the useful
+    information (what started, and how it ended) usually is.
+    """
+    if not text:
+        return text
+    lines = []
+    for line in text.splitlines():
+        if lines and line == lines[-1][0]:
+            lines[-1][1] += 1
+        else:
+            lines.append([line, 1])
+    compacted = [line if n == 1 else f"{line}  [repeated {n} times]" for line, n in lines]
+    result = "\n".join(compacted)
+    if len(result) <= max_chars:
+        return result
+    if len(compacted) > head_lines + tail_lines:
+        omitted = len(compacted) - head_lines - tail_lines
+        compacted = compacted[:head_lines] + [f"[... {omitted} lines omitted ...]"] + compacted[-tail_lines:]
+        result = "\n".join(compacted)
+    if len(result) > max_chars:
+        half = max_chars // 2
+        result = f"{result[:half]}\n[... {len(result) - 2 * half} characters omitted ...]\n{result[-half:]}"
+    return result
+
+
+def _as_text(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ''.join(str(v) for v in value)
+    return str(value)
+
+
+class ContextManager:
+    """
+    Build the messages to send at each turn from the full ReAct history, within `max_prompt_tokens`.
+
+    Parameters:
+    - max_prompt_tokens: The token budget for the prompt of each turn.
+    - keep_last_attempts: How many of the most recent code attempts are sent verbatim.
+    - max_output_chars: The maximum size of each (compacted) output of the sandbox.
+    - token_counter: A function text -> number of tokens: approx_tokens by default.
+    - cache_prefix: Mark the system prompt as cacheable (cache_control), for providers which need it
+      explicitly: the others cache identical prefixes automatically.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = 24000,
+        keep_last_attempts: int = 1,
+        max_output_chars: int = 4000,
+        token_counter=None,
+        cache_prefix: bool = False
+    ):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.keep_last_attempts = keep_last_attempts
+        self.max_output_chars = max_output_chars
+        self.token_counter = token_counter or approx_tokens
+        self.cache_prefix = cache_prefix
+
+    def format_execution_result(self, execution_result) -> str:
+        """
+        The message reporting an execution back to the model, with every output compacted.
+        """
+        def compact(value):
+            return compact_output(_as_text(value), max_chars=self.max_output_chars)
+
+        return (
+            f"Result:{compact(execution_result.result)} "
+            f"\nStandard output: {compact(execution_result.stdout)} "
+            f"\nError output if any: {compact(execution_result.stderr)} "
+            f"\nSandbox error if any: {compact(execution_result.error)}"
+        )
+
+    def _summarize(self, message: dict) -> dict:
+        # a superseded attempt: keep the reasoning, drop the code; keep the end of its output
+        content = message['content']
+        if message['role'] == 'assistant':
+            reasoning = content.split('</reasoning>')[0].replace('<reasoning>', '').strip()
+            if len(reasoning) > 500:
+                reasoning = reasoning[:500] + '...'
+            code_lines = content.split('<code>')[-1].count('\n') + 1
+            summary = f"<reasoning>{reasoning}</reasoning>\n[code of this superseded attempt omitted, {code_lines} lines]"
+        else:
+            summary = compact_output(content, max_chars=600, head_lines=2, tail_lines=6)
+        return {'role': message['role'], 'content': summary}
+
+    def _tokens(self, message: dict) -> int:
+        content = message['content']
+        if isinstance(content, list):
+            content = ''.join(block.get('text', '') for block in content)
+        # a few tokens of overhead for role and separators
+        return self.token_counter(content) + 4
+
+    def build(self, history: list) -> tuple:
+        """
+        Return the messages to send for this turn, and the TurnBudget. The history itself is not modified.
+
+        The first two messages (system prompt and task) are the stable prefix; the rest are pairs of
+        (assistant response, user feedback).
+        """
+        prefix, turns = [dict(m) for m in history[:2]], list(history[2:])
+        attempts = [i for i, m in enumerate(turns) if m['role'] == 'assistant' and '<code>' in m['content']]
+        superseded = set(attempts[:-self.keep_last_attempts] if self.keep_last_attempts else attempts)
+        collapsed = 0
+        messages = []
+        for i, message in enumerate(turns):
+            if i in superseded or (i - 1 in superseded and message['role'] == 'user'):
+                messages.append(self._summarize(message))
+                collapsed += 1
+            else:
+                messages.append(message)
+        if self.cache_prefix and prefix and isinstance(prefix[0]['content'], str):
+            prefix[0]['content'] = [
+                {'type': 'text', 'text': prefix[0]['content'], 'cache_control': {'type': 'ephemeral'}}
+            ]
+        prefix_tokens = sum(self._tokens(m) for m in prefix)
+        sizes = [self._tokens(m) for m in messages]
+        dropped = 0
+        # drop the oldest (assistant, user) pairs, but never the last one
+        while prefix_tokens + sum(sizes) > self.max_prompt_tokens and len(messages) > 2:
+            del messages[:2], sizes[:2]
+            dropped += 2
+        history_tokens = sum(sizes)
+        budget = TurnBudget(
+            prefix_tokens=prefix_tokens,
+            history_tokens=history_tokens,
+            total_tokens=prefix_tokens + history_tokens,
+            budget=self.max_prompt_tokens,
+            collapsed=collapsed,
+            dropped=dropped
+        )
+        return prefix + messages, budget
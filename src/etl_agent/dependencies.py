@@ -0,0 +1,160 @@
+"""
+
+Dependency handling for the code generated by the agent.
+
+The model lists the packages it needs in the <packages> tag, at every turn, usually repeating the same
+set (e.g. "bauplan, pyarrow"), sometimes with stray whitespace or standard library modules. Here we
+normalize and deduplicate that list, drop what is in the standard library or already installed in the
+session, and install whatever is left with ONE pip call, backed by a local wheel cache keyed by a hash
+of the package set, so that after the first turn installing is (close to) free.
+
+"""
+
+import hashlib
+import os
+import re
+import subprocess
+import sys
+
+
+# the distribution name at the start of a requirement string, e.g. "pyarrow" in "pyarrow>=14"
+_NAME_RE = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)")
+DEFAULT_WHEEL_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'data-agents', 'wheels')
+
+
+def canonical_name(requirement: str) -> str:
+    """
+    Return the canonical (PEP 503) name of the distribution in a requirement string.
+    """
+    match = _NAME_RE.match(requirement)
+    if not match:
+        return ''
+    return re.sub(r"[-_.]+", "-", match.group(1)).lower()
+
+
+def normalize_packages(packages) -> list:
+    """
+    Turn the packages requested by the model (a list, or a comma-separated string) into a sorted,
+    deduplicated list of requirement strings, without standard library modules.
+    """
+    if not packages:
+        return []
+    if isinstance(packages, str):
+        packages = packages.split(',')
+    requirements = {}
+    for pkg in packages:
+        requirement = re.sub(r"\s+", "", pkg or '').lower()
+        name = canonical_name(requirement)
+        if not name or name.replace('-', '_') in sys.stdlib_module_names:
+            continue
+        # the last spelling wins, if the same package is requested twice
+        requirements[name] = requirement
+    return sorted(requirements.values(), key=canonical_name)
+
+
+def package_set_key(requirements: list) -> str:
+    """
+    A stable hash for a (normalized) set of requirements.
+    """
+    payload = "\n".join(sorted(requirements))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_freeze(freeze_output: str) -> set:
+    """
+    Return the canonical names of the distributions in a `pip list --format=freeze` output.
+    """
+    names = set()
+    for line in (freeze_output or '').splitlines():
+        name = canonical_name(line)
+        if name:
+            names.add(name)
+    return names
+
+
+class DependencySet:
+    """
+    Track what is installed in ONE session, so that we only ask pip for what is missing.
+
+    `installed` is None until the session has been inspected (see `seed`), so that the
+    (one-off) cost of listing installed distributions is paid at the first install only.
+    """
+
+    def __init__(self):
+        self.installed = None
+        self.requirements = set()
+
+    def seed(self, freeze_output: str):
+        self.installed = parse_freeze(freeze_output)
+
+    def pending(self, packages) -> list:
+        """
+        Return the requirements in `packages` that still need to be installed in the session.
+        """
+        pending = []
+        for requirement in normalize_packages(packages):
+            if requirement in self.requirements:
+                continue
+            # a version constraint is left for pip to check, a bare name is enough as it is
+            bare = re.fullmatch(r"[a-z0-9._-]+", requirement) is not None
+            if bare and self.installed is not None and canonical_name(requirement) in self.installed:
+                continue
+            pending.append(requirement)
+        return pending
+
+    def mark_installed(self, requirements: list):
+        self.requirements.update(requirements)
+        if self.installed is not None:
+            self.installed.update(canonical_name(r) for r in requirements)
+
+
+def pip_install_command(
+    requirements: list,
+    python_executable: str = 'python',
+    find_links: str = None
+) -> list:
+    """
+    The argv of a single, quiet pip call installing all the requirements: if `find_links` is a folder
+    of pre-built wheels, pip does not touch the network at all.
+    """
+    command = [python_executable, '-m', 'pip', 'install', '-q', '--disable-pip-version-check']
+    if find_links:
+        command += ['--no-index', '--find-links', find_links]
+    return command + list(requirements)
+
+
+class WheelCache:
+    """
+    A local folder of wheels for each package set, keyed by package_set_key: wheels are built
+    (and downloaded) once with `pip wheel`, and later installs are resolved offline from there.
+    """
+
+    def __init__(self, root: str = DEFAULT_WHEEL_CACHE, python_executable: str = None):
+        self.root = root
+        self.python_executable = python_executable or sys.executable
+
+    def folder(self, requirements: list) -> str:
+        return os.path.join(self.root, package_set_key(requirements))
+
+    def ensure(self, requirements: list) -> str:
+        """
+        Return the wheel folder for the requirements, building it if needed, or None if the
+        wheels could not be built (the caller should then fall back to a plain install).
+        """
+        folder = self.folder(requirements)
+        marker = os.path.join(folder, '.complete')
+        if os.path.exists(marker):
+            return folder
+        os.makedirs(folder, exist_ok=True)
+        build = subprocess.run(
+            [self.python_executable, '-m', 'pip', 'wheel', '-q', '--disable-pip-version-check',
+             '-w', folder, *requirements],
+            capture_output=True,
+            text=True
+        )
+        if build.returncode != 0:
+            print(f"Could not build wheels for {requirements}: {build.stderr.strip()[-500:]}")
+            return None
+        with open(marker, 'w') as f:
+            f.write("\n".join(requirements))
+        return folder
@@ -6,22 +6,37 @@ fix its own mistakes based on the output of executing the actual code.
 """
 
 
+import argparse
 import os
-from litellm import completion
-from utils import parse_response, ParsedResponse, E2BCodeExecutor, ExecutorResponse
-from dotenv import load_dotenv
+import time
+from utils import IncrementalResponseParser, ParsedResponse, ResponseFormatError, CodeExecutor, ExecutorResponse
+from llm import stream_into_parser, litellm_completion
+from sandbox import e2b_pooled_executor
+from context import ContextManager, approx_tokens
+from tracing import get_tracer, configure_tracing
+from llm_cache import CachedCompletion, CachedExecutor, CompletionCache, DEFAULT_CACHE_PATH, CACHE_MODES, cached_value, record_key
+from config import load_env, check_env, completion_from_env, LLM_BACKENDS
 from verifier import verify_etl_process
-from prompts import SYSTEM_PROMPT, USER_PROMPT_TEMPLATE
-load_dotenv()
-# check the basic envs are here, Bauplan, Together API, E2B
-assert 'BAUPLAN_API_KEY' in os.environ, "BAUPLAN_API_KEY not set in environment variables"
-assert 'E2B_API_KEY' in os.environ, "E2B_API_KEY not set in environment variables"
-assert 'TOGETHER_API_KEY' in os.environ, "TOGETHER_API_KEY not set in environment variables"
+from catalog import catalog_for_prompt
+from wap import sandbox_install_code
+from preflight import Preflight, bauplan_requirement, format_issues
+from routing import ModelRouter, ModelTier, TurnOutcome
+from checkpoints import RunCheckpoint, DEFAULT_CHECKPOINT_FOLDER, detect_branches, user_branches, is_transient_error, existing_branches, cleanup_branches
+from prompts import system_prompt, USER_PROMPT_TEMPLATE, RAW_DATA_CATALOG_TEMPLATE
 # model specific "global" variables
 # you can change them or abstract them away in a config file
-MAX_TOKENS = 1000
+# responses are cut by stop sequences right after </code> or </done>, so a larger limit only
+# makes room for longer code, instead of silently truncating it
+MAX_TOKENS = 4000
 TEMPERATURE = 0.7
 MAX_ITERATIONS = 5
+# with model routing, most turns go to the fast model, and runs escalate to the strong one when stuck
+FAST_MODEL = "together_ai/Qwen/Qwen2.5-Coder-32B-Instruct"
+STRONG_MODEL = "together_ai/deepseek-ai/DeepSeek-V3"
+# after a transient error (rate limit, timeout...), wait before the next iteration: doubled at every
+# consecutive error, up to the maximum
+TRANSIENT_RETRY_DELAY = 1.0
+TRANSIENT_MAX_DELAY = 30.0
 
 
 def run_react_loop(
@@ -35,11 +50,26 @@ def run_react_loop(
     system_prompt: str,
     max_iterations: int, 
     llm_folder: str,
-    verbose: bool = False
+    verbose: bool = False,
+    executor: CodeExecutor = None,
+    completion_fn=None,
+    stop_event=None,
+    prompt_variables: dict = None,
+    context_manager: ContextManager = None,
+    catalog: str = None,
+    preflight: Preflight = None,
+    checkpoint_folder: str = None,
+    run_id: str = None,
+    bauplan_client=None,
+    cleanup_failed_branches: bool = True,
+    router: ModelRouter = None
 ):
     """
         Run the main ReAct reasoning and acting loop: we return the final answer
         if we have one, or None if we reach the maximum number of iterations without a valid answer.
+
+        Every step is checkpointed (see checkpoints.py): an interrupted run can be continued with
+        resume_react_loop.
         
         Parameters:
         - templated_user_input: A string template for the user input, which will be formatted with the S3 bucket name.
@@ -53,113 +83,560 @@ def run_react_loop(
         - max_iterations: The maximum number of iterations to run the loop.
         - llm_folder: The folder where the generated code will be stored for human inspection.
         - verbose: Whether to print detailed logs during execution.
+        - executor: The CodeExecutor to run the code with: if None, we use a pooled E2B sandbox kept
+          alive for all the iterations of this run, and closed when the run is over.
+        - completion_fn: The function to get LLM completions with, following the litellm `completion` signature
+          (litellm's own by default): pass a fake one to run the loop offline.
+        - stop_event: An optional threading.Event: when set, the loop stops at the next stage and returns None
+          (e.g. because another agent already solved the task).
+        - prompt_variables: Additional variables to format the user input template with.
+        - context_manager: The ContextManager keeping each prompt within a token budget (default settings if None).
+        - catalog: A summary of the raw data (see catalog.py), added to the task in place of {raw_data_catalog}.
+        - preflight: The Preflight checking the code locally before it is executed (default checks if None).
+        - checkpoint_folder: Where to save the checkpoint of the run (llm_folder/checkpoints if None).
+        - run_id: The id of the run, i.e. the name of its checkpoint (a new one if None).
+        - bauplan_client: A Bauplan client, to check which of the data branches created by the run exist, and
+          to find the ones its code creates at runtime (if no branch_name is assigned in prompt_variables):
+          if None, the branches are only detected from the code, and never deleted.
+        - cleanup_failed_branches: Delete the data branches of the run if it fails (i.e. if it reaches the
+          maximum number of iterations): the ones of an interrupted run are kept, to resume it.
+        - router: The ModelRouter picking the model of every turn (see routing.py): if None, every turn
+          uses model_name, temperature and max_tokens.
     """
     # start the message history with the system prompt and user input
     user_input = templated_user_input.format(
         s3_raw_bucket=s3_raw_bucket,
+        raw_data_catalog=RAW_DATA_CATALOG_TEMPLATE.format(catalog=catalog) if catalog else '',
+        **(prompt_variables or {})
     )
     history = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_input}
     ]
-    
-    print("🚀 Starting the Agent")
+    checkpoint = RunCheckpoint.create(
+        checkpoint_folder or os.path.join(llm_folder, 'checkpoints'),
+        # what resume_react_loop needs, besides the history: no secrets here
+        config={
+            's3_raw_bucket': s3_raw_bucket,
+            'model_name': model_name,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'max_iterations': max_iterations,
+            'llm_folder': llm_folder,
+            'verbose': verbose,
+            'branch_name': (prompt_variables or {}).get('branch_name')
+        },
+        history=history,
+        run_id=run_id
+    )
+    # the branch assigned to the run, if any (e.g. by fanout.py), is one of its branches
+    if (prompt_variables or {}).get('branch_name'):
+        checkpoint.add_branches([prompt_variables['branch_name']])
+
+    print(f"🚀 Starting the Agent (run {checkpoint.run_id})")
     print(f"📝 Task: {user_input}")
     print("="*50)
-    current_iteration = 0
+    return _run_checkpointed(
+        checkpoint=checkpoint,
+        bauplan_api_key=bauplan_api_key,
+        eb2_api_key=eb2_api_key,
+        max_iterations=max_iterations,
+        executor=executor,
+        completion_fn=completion_fn,
+        stop_event=stop_event,
+        context_manager=context_manager,
+        preflight=preflight,
+        bauplan_client=bauplan_client,
+        cleanup_failed_branches=cleanup_failed_branches,
+        router=router or ModelRouter.single(model_name, temperature, max_tokens)
+    )
+
+
+def resume_react_loop(
+    run_id: str = None,
+    checkpoint_folder: str = DEFAULT_CHECKPOINT_FOLDER,
+    bauplan_api_key: str = None,
+    eb2_api_key: str = None,
+    max_iterations: int = None,
+    executor: CodeExecutor = None,
+    completion_fn=None,
+    stop_event=None,
+    context_manager: ContextManager = None,
+    preflight: Preflight = None,
+    bauplan_client=None,
+    cleanup_failed_branches: bool = True,
+    router: ModelRouter = None
+):
+    """
+        Continue a checkpointed run from its last good step: the history is restored, a response which was
+        received but never executed is executed without asking the model again, and the model is told which
+        of the data branches of the run still exist, to reuse them. Return the final answer, or None.
+
+        Parameters:
+        - run_id: The run to resume: the most recent one if None.
+        - checkpoint_folder: The folder of the checkpoints.
+        - bauplan_api_key, eb2_api_key: As in run_react_loop (from the environment if None).
+        - max_iterations: The new maximum number of iterations, counting the ones already done: the one of
+          the run if None (pass a larger one to continue a run which reached it).
+        - the other parameters are the ones of run_react_loop.
+    """
+    checkpoint = RunCheckpoint.load(checkpoint_folder, run_id)
+    config = checkpoint.data['config']
+    if checkpoint.data['status'] == 'done':
+        print(f"✅ Run {checkpoint.run_id} is already done: {checkpoint.data['answer']}")
+        return checkpoint.data['answer']
+    max_iterations = max_iterations or config['max_iterations']
+    checkpoint.data['config']['max_iterations'] = max_iterations
+    print(f"♻️ Resuming run {checkpoint.run_id} ({checkpoint.data['status']}) from iteration {checkpoint.next_iteration}")
+    history = checkpoint.history
+    if checkpoint.pending_response(checkpoint.next_iteration) is None and history[-1]['role'] == 'user':
+        # the model is asked for the next step: tell it what survived the interruption
+        branches = checkpoint.branches
+        if bauplan_client is not None:
+            branches = existing_branches(bauplan_client, branches)
+        note = (
+            "\n\nNOTE: the run was interrupted and resumed in a NEW sandbox session: variables and packages of the "
+            "previous iterations are gone, the data in the lakehouse is not."
+        )
+        if branches:
+            note += f" These data branches were created by this run, and still exist: {', '.join(branches)}. Reuse them instead of creating new ones."
+        history[-1] = {'role': 'user', 'content': history[-1]['content'] + note}
+    checkpoint.data.update(history=history, status='running', error=None)
+    checkpoint.save()
+    return _run_checkpointed(
+        checkpoint=checkpoint,
+        bauplan_api_key=bauplan_api_key or os.environ.get('BAUPLAN_API_KEY'),
+        eb2_api_key=eb2_api_key or os.environ.get('E2B_API_KEY'),
+        max_iterations=max_iterations,
+        executor=executor,
+        completion_fn=completion_fn,
+        stop_event=stop_event,
+        context_manager=context_manager,
+        preflight=preflight,
+        bauplan_client=bauplan_client,
+        cleanup_failed_branches=cleanup_failed_branches,
+        router=router or ModelRouter.single(config['model_name'], config['temperature'], config['max_tokens'])
+    )
+
+
+def _run_checkpointed(
+    checkpoint: RunCheckpoint,
+    bauplan_api_key: str,
+    eb2_api_key: str,
+    max_iterations: int,
+    executor: CodeExecutor,
+    completion_fn,
+    stop_event,
+    context_manager: ContextManager,
+    preflight: Preflight,
+    bauplan_client,
+    cleanup_failed_branches: bool,
+    router: ModelRouter
+):
+    """
+        Run (or continue) the iterations of a checkpointed run, and clean up after it.
+    """
+    config = checkpoint.data['config']
+    # one executor (and so one warm sandbox session) for the entire run: state and installed
+    # packages are kept across iterations, instead of booting a new sandbox at every retry
+    owns_executor = executor is None
+    if owns_executor:
+        executor = default_executor(bauplan_api_key, eb2_api_key)
+    tracer = get_tracer()
+    runs = tracer.counter('agent_runs_total', 'Runs of the agent loop, by outcome')
+    try:
+        with tracer.span('agent.run', model=config['model_name'], max_iterations=max_iterations, run_id=checkpoint.run_id) as run_span:
+            answer = _react_iterations(
+                history=checkpoint.history,
+                executor=executor,
+                router=router,
+                max_iterations=max_iterations,
+                llm_folder=config['llm_folder'],
+                verbose=config['verbose'],
+                completion_fn=completion_fn or litellm_completion,
+                stop_event=stop_event,
+                context_manager=context_manager or ContextManager(),
+                preflight=preflight or Preflight(),
+                checkpoint=checkpoint,
+                # runs with an assigned branch (e.g. fanout.py) work next to each other as the same user:
+                # the new branches of the user are theirs only when nothing else is running
+                branch_client=None if config.get('branch_name') else bauplan_client
+            )
+            run_span.set_attributes(success=answer is not None, messages=len(checkpoint.data['history']))
+        runs.inc(outcome='success' if answer is not None else 'failure')
+    finally:
+        if owns_executor:
+            executor.close()
+    status = checkpoint.data['status']
+    if status == 'failed' and cleanup_failed_branches and bauplan_client is not None:
+        # nothing will come out of this run: its branches would only be leaked
+        deleted = cleanup_branches(bauplan_client, checkpoint.branches)
+        checkpoint.remove_branches(deleted)
+        if deleted:
+            print(f"🧹 Deleted the branches of the failed run: {', '.join(deleted)}")
+    elif status == 'error':
+        print(f"💾 Run {checkpoint.run_id} interrupted: resume it with `uv run etl_agent_loop.py --resume {checkpoint.run_id}`")
+
+    return answer
+
+
+def default_executor(bauplan_api_key: str, eb2_api_key: str) -> CodeExecutor:
+    """
+    The executor of a run: a warm E2B sandbox, with bauplan and the WAP tool installed, kept for the whole run.
+    """
+    return e2b_pooled_executor(
+        api_key=eb2_api_key,
+        envs={'BAUPLAN_API_KEY': bauplan_api_key},
+        # the bauplan version the pre-flight checks know the Client methods of
+        warm_packages=[bauplan_requirement()],
+        # the WAP tool the prompt tells the model about is installed with the warm-up
+        warmup_code='import bauplan\n' + sandbox_install_code(),
+        # optional: a custom E2B template with the dependencies pre-baked, e.g. "etl-agent-{key}" to
+        # pick the one built for this package set
+        template=os.environ.get('E2B_TEMPLATE')
+    )
+
+
+def _error_text(error) -> str:
+    # E2B execution errors have a name, a value and a traceback: anything else is turned into a string
+    if error is None:
+        return None
+    if hasattr(error, 'traceback'):
+        return f"{getattr(error, 'name', '')}: {getattr(error, 'value', '')}\n{error.traceback}"
+    return str(error)
+
+
+def _react_iterations(
+    history: list,
+    executor: CodeExecutor,
+    router: ModelRouter,
+    max_iterations: int,
+    llm_folder: str,
+    verbose: bool,
+    completion_fn,
+    stop_event,
+    context_manager: ContextManager,
+    preflight: Preflight,
+    checkpoint: RunCheckpoint,
+    branch_client=None
+):
+    """
+        The actual ReAct iterations of run_react_loop, given the starting history and the executor:
+        every iteration is saved to the checkpoint, which also gets the final status of the run, and
+        the router picks the model of every iteration from the outcomes of the previous ones. With a
+        branch_client, the branches of the user which appear while the code runs are the run's too.
+    """
+    tracer = get_tracer()
+    iterations = tracer.counter('agent_iterations_total', 'Iterations of the agent loop, by outcome')
+    tokens = tracer.counter('agent_llm_tokens_total', 'Tokens sent to and received from the LLM (estimated)')
+    output_bytes = tracer.counter('agent_sandbox_output_bytes_total', 'Bytes of output produced by the sandbox')
+    current_iteration = checkpoint.next_iteration
+    consecutive_transient_errors = 0
+    # the outcomes of the previous turns, for the router: restored from the checkpoint when resuming
+    turns = [TurnOutcome(i.get('tier'), i['outcome'], i['error']) for i in checkpoint.data['iterations']]
+    username = branch_client.info().user.username if branch_client is not None else None
+
+    def end_turn(iteration, decision, outcome, started, usage, response=None, execution_result=None, error=None):
+        # the turn is saved to the checkpoint, to the outcomes the router sees, and to the routing log
+        seconds = time.perf_counter() - started
+        checkpoint.record_iteration(
+            iteration, outcome, history, response=response, execution_result=execution_result,
+            error=error, seconds=seconds, tier=decision.tier
+        )
+        turns.append(TurnOutcome(decision.tier, outcome, error))
+        router.record(
+            checkpoint.run_id, iteration, decision, outcome, error=error, seconds=seconds,
+            prompt_tokens=usage[0], completion_tokens=usage[1]
+        )
+
     while current_iteration < max_iterations:
-        try:
-            print("\n Getting LLM completion...")
-            # 1. Get LLM response
-            response = completion(
-                # change here to use OpenAI models, but make sure the relevant env is set
-                # by default, we use Together AI: note we checked at the start
-                # that the relevant env is set
-                model=model_name,
-                messages=history,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )            
-            response_text = response.choices[0].message.content
-            # 2. Parse response
-            response: ParsedResponse = parse_response(response_text)
-            if response.done:
-                print(f"\n✅ Done! Final result: {response_text}")
-                # we are done, return the final answer
-                return response_text
-            
-            if verbose:
-                print(f"\nIteration {current_iteration + 1} response:")
-                print(f"\n📦 Packages to install: {response.packages}")
-                print(f"\n🤔 Reasoning: {response.reasoning}")
-                print(f"\n🛠️ Code: {response.code[:500]}")
-            
-            # Store the code in a file for human inspection
-            code_file_path = os.path.join(llm_folder, 'etl_agent', f"iteration_{current_iteration}_code.py")
-            with open(code_file_path, 'w') as code_file:
-                code_file.write(response.code)
+        if stop_event is not None and stop_event.is_set():
+            print("\n🛑 Stop requested, leaving the loop")
+            checkpoint.finish('stopped')
+            return None
+        iteration_start = time.perf_counter()
+        response_text = None
+        usage = (0, 0)
+        decision = router.route(turns)
+        with tracer.span('agent.iteration', iteration=current_iteration, tier=decision.tier, route=decision.reason) as iteration_span:
+            try:
+                # the full history stays here: what we send is compacted to fit the token budget
+                messages, budget = context_manager.build(history)
+                # get the sandbox ready while the model is still writing: the packages are installed as
+                # soon as the <packages> section is complete, i.e. before the code arrives
+                executor.prepare()
+                parser = IncrementalResponseParser(
+                    on_section=lambda tag, content: executor.prepare(content.split(',')) if tag == 'packages' else None
+                )
+                pending_text = checkpoint.pending_response(current_iteration)
+                if pending_text is not None:
+                    # a resumed run: this response was already paid for, and never executed
+                    print(f"\n♻️ Reusing the response of iteration {current_iteration} from the checkpoint")
+                    parser.feed(pending_text)
+                    finish_reason = 'stop'
+                else:
+                    print(f"\n Getting LLM completion from {decision.model_name} ({decision.reason})... (prompt ~{budget.total_tokens}/{budget.budget} tokens, "
+                          f"{budget.prefix_tokens} in the cacheable prefix, {budget.collapsed} collapsed, {budget.dropped} dropped)")
+                    # 1. Get LLM response, streamed into the parser and cut right after </code> or </done>
+                    with tracer.span('llm.completion', model=decision.model_name, tier=decision.tier, prompt_tokens=budget.total_tokens) as llm_span:
+                        finish_reason = stream_into_parser(
+                            # change here to use OpenAI models, but make sure the relevant env is set
+                            # by default, we use Together AI: note we checked at the start
+                            # that the relevant env is set
+                            completion_fn,
+                            parser,
+                            model=decision.model_name,
+                            messages=messages,
+                            max_tokens=decision.max_tokens,
+                            temperature=decision.temperature
+                        )
+                        completion_tokens = approx_tokens(parser.text)
+                        llm_span.set_attributes(completion_tokens=completion_tokens, finish_reason=finish_reason)
+                    tokens.inc(budget.total_tokens, kind='prompt')
+                    tokens.inc(completion_tokens, kind='completion')
+                    usage = (budget.total_tokens, completion_tokens)
+                # 2. Parse response: a malformed one is sent back to the model, instead of ending the run
+                try:
+                    with tracer.span('response.parse'):
+                        response: ParsedResponse = parser.close(
+                            stopped_by_sequence=finish_reason == 'stop_sequence',
+                            truncated=finish_reason == 'length'
+                        )
+                except ResponseFormatError as e:
+                    print(f"\n⚠️ Malformed response: {e}")
+                    iteration_span.set_attributes(outcome='malformed_response', retry_reason=type(e).__name__)
+                    iterations.inc(outcome='malformed_response')
+                    history.append({"role": "assistant", "content": parser.text})
+                    history.append({"role": "user", "content": f"Your response could not be parsed: {e}. Follow the CRITICAL FORMAT RULES and try again."})
+                    end_turn(current_iteration, decision, 'malformed_response', iteration_start, usage, error=f"{type(e).__name__}: {e}")
+                    current_iteration += 1
+                    continue
+                # the full text, including the closing tag the provider cut as a stop sequence
+                response_text = parser.text
+                consecutive_transient_errors = 0
+                if response.done:
+                    print(f"\n✅ Done! Final result: {response_text}")
+                    iteration_span.set_attribute('outcome', 'done')
+                    iterations.inc(outcome='done')
+                    end_turn(current_iteration, decision, 'done', iteration_start, usage, response=response)
+                    checkpoint.finish('done', answer=response_text)
+                    # we are done, return the final answer
+                    return response_text
+                # from now on, an interruption does not cost this completion again
+                checkpoint.record_response(current_iteration, response_text)
                 
-            # 3. Execute the code
-            # Replace this with your own code executor or implement something like 
-            # a factory pattern to use different executors
-            
-            print("\n Running the code...")
-            executor = E2BCodeExecutor(
-                api_key=eb2_api_key, 
-                envs={'BAUPLAN_API_KEY': bauplan_api_key}
-            )
-            execution_result: ExecutorResponse = executor.run_code(
-                code=response.code, 
-                python_packages=response.packages
-            )
-            if verbose:
-                print(f"\n📊 Result: {execution_result}")
-            # If we are not done, we add the response to the conversation history
-            content = f"Result:{execution_result.result} \nStandard output: {execution_result.stdout} \nError output if any: {execution_result.stderr} \nSandbox error if any: {execution_result.error}"
-            history.append({"role": "assistant", "content": response_text})
-            history.append({"role": "user", "content": content})
-            # Go to the next iteration
-            current_iteration += 1
-            print("\n" + "-"*50)
-            
-        except Exception as e:
-            print(f"Error in iteration {current_iteration}: {e}")
-            break
+                if verbose:
+                    print(f"\nIteration {current_iteration + 1} response:")
+                    print(f"\n📦 Packages to install: {response.packages}")
+                    print(f"\n🤔 Reasoning: {response.reasoning}")
+                    print(f"\n🛠️ Code: {response.code[:500]}")
+                
+                # Store the code in a file for human inspection
+                with tracer.span('code.write', code_bytes=len(response.code)):
+                    code_file_path = os.path.join(llm_folder, 'etl_agent', f"iteration_{current_iteration}_code.py")
+                    with open(code_file_path, 'w') as code_file:
+                        code_file.write(response.code)
+                    
+                # 3. Check the code locally: what would surely fail goes back to the model, not to the sandbox
+                with tracer.span('code.preflight') as preflight_span:
+                    issues = preflight.check(response.code, response.packages)
+                    preflight_span.set_attribute('issues', len(issues))
+                if issues:
+                    feedback = format_issues(issues)
+                    print(f"\n🛫 Pre-flight checks failed, the code is not executed:\n{feedback}")
+                    iteration_span.set_attributes(outcome='preflight_rejected', retry_reason=issues[0].kind)
+                    iterations.inc(outcome='preflight_rejected')
+                    history.append({"role": "assistant", "content": response_text})
+                    history.append({"role": "user", "content": feedback})
+                    end_turn(current_iteration, decision, 'preflight_rejected', iteration_start, usage, response=response, error=feedback)
+                    current_iteration += 1
+                    continue
+
+                # 4. Execute the code
+                # Pass your own CodeExecutor to run_react_loop to use a different provider / method
+                if stop_event is not None and stop_event.is_set():
+                    print("\n🛑 Stop requested, skipping the execution")
+                    checkpoint.finish('stopped')
+                    return None
+                print("\n Running the code...")
+                branches_before = user_branches(branch_client, username) if branch_client is not None else None
+                with tracer.span('sandbox.run') as run_span:
+                    execution_result: ExecutorResponse = executor.run_code(
+                        code=response.code, 
+                        python_packages=response.packages
+                    )
+                    stdout_text = ''.join(str(o) for o in execution_result.stdout or [])
+                    stdout_bytes = len(stdout_text)
+                    stderr_bytes = len(''.join(str(o) for o in execution_result.stderr or []))
+                    run_span.set_attributes(
+                        stdout_bytes=stdout_bytes,
+                        stderr_bytes=stderr_bytes,
+                        error=execution_result.error is not None
+                    )
+                output_bytes.inc(stdout_bytes, stream='stdout')
+                output_bytes.inc(stderr_bytes, stream='stderr')
+                if verbose:
+                    print(f"\n📊 Result: {execution_result}")
+                outcome = 'execution_error' if execution_result.error is not None else 'executed'
+                iteration_span.set_attribute('outcome', outcome)
+                if execution_result.error is not None:
+                    iteration_span.set_attribute('retry_reason', (str(execution_result.error).splitlines() or [''])[0][:200])
+                iterations.inc(outcome=outcome)
+                # If we are not done, we add the response to the conversation history
+                content = context_manager.format_execution_result(execution_result)
+                history.append({"role": "assistant", "content": response_text})
+                history.append({"role": "user", "content": content})
+                # the branches the code created, to reuse them when resuming, or to clean them up
+                checkpoint.add_branches(detect_branches(response.code))
+                if branches_before is not None:
+                    checkpoint.add_branches(user_branches(branch_client, username) - branches_before)
+                end_turn(
+                    current_iteration, decision, outcome, iteration_start, usage, response=response,
+                    execution_result=execution_result, error=_error_text(execution_result.error)
+                )
+                # Go to the next iteration
+                current_iteration += 1
+                print("\n" + "-"*50)
+                
+            except Exception as e:
+                print(f"Error in iteration {current_iteration}: {e}")
+                if not is_transient_error(e):
+                    iteration_span.set_attributes(outcome='exception', retry_reason=f"{type(e).__name__}: {e}")
+                    iterations.inc(outcome='exception')
+                    # the checkpoint has everything up to the last good step: the run can be resumed
+                    checkpoint.finish('error', error=f"{type(e).__name__}: {e}")
+                    return None
+                # a rate limit, a timeout, a dropped connection...: it costs this iteration, not the run
+                iteration_span.set_attributes(outcome='transient_error', retry_reason=f"{type(e).__name__}: {e}")
+                iterations.inc(outcome='transient_error')
+                if response_text is not None:
+                    # the model must know its code did not run to the end
+                    history.append({"role": "assistant", "content": response_text})
+                    history.append({"role": "user", "content": f"Running your code failed with a transient error: {type(e).__name__}: {e}. Try again."})
+                end_turn(current_iteration, decision, 'transient_error', iteration_start, usage, error=f"{type(e).__name__}: {e}")
+                current_iteration += 1
+                delay = min(TRANSIENT_MAX_DELAY, TRANSIENT_RETRY_DELAY * 2 ** consecutive_transient_errors)
+                consecutive_transient_errors += 1
+                if current_iteration < max_iterations:
+                    print(f"⏳ Transient error, retrying in {delay:.0f}s")
+                    if stop_event is not None:
+                        stop_event.wait(delay)
+                    else:
+                        time.sleep(delay)
     
     if current_iteration >= max_iterations:
         print(f"\n⚠️ Reached maximum iterations ({max_iterations})")
+    checkpoint.finish('failed')
         
     # we failed, return None
     return None
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the ETL agent")
+    parser.add_argument(
+        '--resume', nargs='?', const='latest', default=None, metavar='RUN_ID',
+        help="continue a checkpointed run from its last good step (the most recent one, without RUN_ID)"
+    )
+    args = parser.parse_args()
+    load_env()
+    # LLM completions can be cached on disk: off, read_write, record, or replay (no calls to the provider)
+    cache_mode = os.environ.get('LLM_CACHE_MODE', 'off')
+    # check the basic envs are here, Bauplan, Together API (not for replays, or a custom endpoint), E2B
+    # (not for replays): all the problems are reported at once
+    replay = cache_mode == 'replay'
+    own_endpoint = os.environ.get('LLM_BACKEND') == 'http' and os.environ.get('LLM_BASE_URL')
+    check_env(
+        ([] if replay else ['BAUPLAN_API_KEY', 'E2B_API_KEY']) + ([] if args.resume is not None else ['S3_BUCKET_RAW_DATA'])
+        + ([] if replay or own_endpoint else ['TOGETHER_API_KEY']),
+        choices={'LLM_CACHE_MODE': CACHE_MODES, 'LLM_BACKEND': LLM_BACKENDS, 'MODEL_ROUTING': ('on', 'off'), 'RAW_DATA_CATALOG': ('on', 'off')}
+    )
+    # spans of every run / iteration / stage go to a JSONL file, metrics to a Prometheus text file or endpoint
+    tracer = configure_tracing(jsonl_path=os.environ.get('TRACE_JSONL'))
+    if os.environ.get('METRICS_PORT'):
+        tracer.metrics.serve(int(os.environ['METRICS_PORT']))
+    cache = CompletionCache(os.environ.get('LLM_CACHE_PATH', DEFAULT_CACHE_PATH))
+    # litellm (imported on the first call), or the built-in HTTP client: see LLM_BACKEND in local.env
+    completion_fn = CachedCompletion(completion_from_env(), cache, mode=cache_mode)
+    # the executions of the code are recorded with the completions, and replayed without any sandbox
+    executor = None
+    if cache_mode != 'off':
+        executor = CachedExecutor(
+            None if replay else default_executor(os.environ['BAUPLAN_API_KEY'], os.environ['E2B_API_KEY']),
+            cache,
+            mode=cache_mode
+        )
+    # a local client to find the data branches of the run: reused when resuming, deleted if the run fails
+    bauplan_client = None
+    if not replay:
+        import bauplan
+        bauplan_client = bauplan.Client(api_key=os.environ['BAUPLAN_API_KEY'])
     # the llm_code folder is used for human inspection of the code generated by the agents
     llm_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), "llm_code")
-    
-    # As mentioned in the blog post, an alternative setup would be to use a
-    # a loop over models here (for model in models_list) and run more than one agent
-    # over the lakehouse, sandboxed using data branches - the verifier would then
-    # check + merge the most promising results from the different agents.
-    # We leave this extension as an exercise for the reader ;-)
-    answer = run_react_loop(
-        templated_user_input=USER_PROMPT_TEMPLATE,
-        s3_raw_bucket=os.environ['S3_BUCKET_RAW_DATA'],
-        model_name="together_ai/deepseek-ai/DeepSeek-V3",
-        bauplan_api_key=os.environ['BAUPLAN_API_KEY'],
-        eb2_api_key=os.environ['E2B_API_KEY'],
-        system_prompt=SYSTEM_PROMPT,
-        max_iterations=MAX_ITERATIONS,
-        max_tokens=MAX_TOKENS,
-        temperature=TEMPERATURE,
-        llm_folder=llm_folder,
-        verbose=True
-    )
+    # the fast model writes most turns, the strong one takes over when the run is stuck: decisions and
+    # outcomes are logged to tune the policy (see routing.py)
+    router = None
+    if os.environ.get('MODEL_ROUTING', 'on') != 'off':
+        router = ModelRouter(
+            [ModelTier('fast', FAST_MODEL, TEMPERATURE, MAX_TOKENS), ModelTier('strong', STRONG_MODEL, TEMPERATURE, MAX_TOKENS)],
+            log_path=os.environ.get('ROUTING_LOG') or None
+        )
+
+    try:
+        if args.resume is not None:
+            answer = resume_react_loop(
+                run_id=None if args.resume == 'latest' else args.resume,
+                checkpoint_folder=os.path.join(llm_folder, 'checkpoints'),
+                executor=executor,
+                completion_fn=completion_fn,
+                bauplan_client=bauplan_client,
+                router=router
+            )
+        else:
+            # the catalog of the raw data, read from the parquet footers, saves the agent the exploratory
+            # turns: it is part of the prompt, so it is recorded (and replayed) too
+            catalog = None
+            if os.environ.get('RAW_DATA_CATALOG', 'on') != 'off':
+                catalog = cached_value(
+                    cache, cache_mode, record_key('raw_data_catalog', bucket=os.environ['S3_BUCKET_RAW_DATA']),
+                    'raw data catalog', lambda: catalog_for_prompt(os.environ['S3_BUCKET_RAW_DATA'])
+                )
+            # As mentioned in the blog post, an alternative setup is to run more than one agent
+            # over the lakehouse, sandboxed using data branches, with the verifier checking and
+            # merging the most promising result: see fanout.py for that setup.
+            answer = run_react_loop(
+                templated_user_input=USER_PROMPT_TEMPLATE,
+                s3_raw_bucket=os.environ['S3_BUCKET_RAW_DATA'],
+                model_name=STRONG_MODEL,
+                bauplan_api_key=os.environ.get('BAUPLAN_API_KEY'),
+                eb2_api_key=os.environ.get('E2B_API_KEY'),
+                system_prompt=system_prompt(),
+                max_iterations=MAX_ITERATIONS,
+                max_tokens=MAX_TOKENS,
+                temperature=TEMPERATURE,
+                llm_folder=llm_folder,
+                verbose=True,
+                executor=executor,
+                completion_fn=completion_fn,
+                catalog=catalog,
+                bauplan_client=bauplan_client,
+                router=router
+            )
+    finally:
+        if executor is not None:
+            executor.close()
+    if os.environ.get('METRICS_FILE'):
+        tracer.metrics.write(os.environ['METRICS_FILE'])
+    if cache_mode != 'off':
+        print(f"💾 LLM cache ({cache_mode}): {completion_fn.hits} hits, {completion_fn.misses} misses, "
+              f"{executor.hits} replayed executions")
     if answer is None:
         print("❌ Failed to get a valid answer from the agent.")
+    elif replay:
+        print("✅ Replayed the recorded run: nothing was written to the lakehouse, so there is nothing to verify.")
     else:
         # if we have an answer, we can run the human-in-the-loop verifier function
         if verify_etl_process():
             print("✅ ETL process verified successfully, we can go to the next step!")
         else:
-            print("❌ ETL process verification failed.")
\ No newline at end of file
+            print("❌ ETL process verification failed.")
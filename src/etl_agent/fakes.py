@@ -0,0 +1,275 @@
+"""
+
+Deterministic, local stand-ins for the remote services used by the agent: the LLM provider, the code
+executor and the Bauplan client. They make it possible to run (and time) the agent machinery offline,
+with zero network calls.
+
+"""
+
+import re
+import threading
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+from utils import CodeExecutor, ExecutorResponse
+from llm import completion_response, stream_chunk
+
+
+class ScriptedLLM:
+    """
+    A completion function (same signature as litellm's `completion`) replaying fixed responses,
+    one per call, in order: after the last one, the last response is repeated. Responses which are
+    exceptions are raised instead.
+
+    Like a real provider, it honors `stop` sequences (cutting the text before them, and reporting the one
+    which matched as stop_reason, like vLLM does), truncates the text
+    after roughly `max_tokens` tokens (4 characters each), and streams chunks of `chunk_size` characters
+    when `stream=True`. Every call is recorded in `calls`, and can be delayed by `delay` seconds.
+    """
+
+    def __init__(self, responses: list, delay: float = 0.0, chunk_size: int = 16):
+        assert responses, "ScriptedLLM needs at least one response"
+        self.responses = list(responses)
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(
+        self,
+        model: str,
+        messages: list,
+        max_tokens: int = None,
+        temperature: float = None,
+        stream: bool = False,
+        stop: list = None,
+        **kwargs
+    ):
+        with self._lock:
+            idx = min(len(self.calls), len(self.responses) - 1)
+            self.calls.append({'model': model, 'messages': list(messages), 'max_tokens': max_tokens, 'temperature': temperature})
+        if self.delay:
+            time.sleep(self.delay)
+        response = self.responses[idx]
+        if isinstance(response, Exception):
+            raise response
+        text, finish_reason, stop_reason = response, 'stop', None
+        cuts = sorted((text.find(s), s) for s in (stop or []) if s in text)
+        if cuts:
+            text, stop_reason = text[:cuts[0][0]], cuts[0][1]
+        if max_tokens and len(text) > max_tokens * 4:
+            text, finish_reason, stop_reason = text[:max_tokens * 4], 'length', None
+        if not stream:
+            return completion_response(text, model=model, finish_reason=finish_reason, stop_reason=stop_reason)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or ['']
+        last = len(chunks) - 1
+        return (
+            stream_chunk(c, finish_reason=finish_reason if i == last else None, stop_reason=stop_reason if i == last else None)
+            for i, c in enumerate(chunks)
+        )
+
+
+class ScriptedModels:
+    """
+    A completion function dispatching each call to the ScriptedLLM of its model, e.g. a cheap and a strong
+    one with different scripts. `calls` records the model of every call, in order.
+    """
+
+    def __init__(self, models: dict):
+        self.models = models
+        self.calls = []
+
+    def __call__(self, model: str, **kwargs):
+        assert model in self.models, f"No scripted responses for model {model}"
+        self.calls.append(model)
+        return self.models[model](model=model, **kwargs)
+
+
+class FakeRateLimitError(Exception):
+    """
+    Shaped like the rate limit errors of the providers: a 429 status code, and a Retry-After in seconds.
+    """
+
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitedProvider:
+    """
+    Wrap a completion function like a provider with a rate limit would: more than `requests_per_second`
+    calls in the last second fail with FakeRateLimitError. `rejected` counts the failed calls.
+    """
+
+    def __init__(self, completion_fn, requests_per_second: float):
+        self.completion_fn = completion_fn
+        self.requests_per_second = requests_per_second
+        self.rejected = 0
+        self._calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            now = time.monotonic()
+            self._calls = [t for t in self._calls if now - t < 1.0]
+            if len(self._calls) >= self.requests_per_second:
+                self.rejected += 1
+                raise FakeRateLimitError("Rate limit exceeded", retry_after=1.0 - (now - self._calls[0]))
+            self._calls.append(now)
+        return self.completion_fn(**kwargs)
+
+
+class FakeCodeExecutor(CodeExecutor):
+    """
+    A CodeExecutor that does not run anything: it records the code and returns what `on_run(code, packages)`
+    returns, or a plain successful response if `on_run` is None. Use `on_run` to mimic the side effects
+    of the code on a FakeBauplanClient.
+    """
+
+    def __init__(self, on_run=None, delay: float = 0.0):
+        self.on_run = on_run
+        self.delay = delay
+        self.calls = []
+        self.closed = False
+
+    def run_code(self, code: str, python_packages: list = None) -> ExecutorResponse:
+        self.calls.append({'code': code, 'packages': python_packages})
+        if self.delay:
+            time.sleep(self.delay)
+        if self.on_run is not None:
+            return self.on_run(code, python_packages)
+        return ExecutorResponse(result=[], stdout=['ok\n'], stderr=[], error=None)
+
+    def close(self):
+        self.closed = True
+
+
+# a table in the fake lakehouse: column names, and number of rows
+FakeTable = namedtuple('FakeTable', ['column_names', 'num_rows'])
+FakeField = namedtuple('FakeField', ['name', 'required', 'type'])
+
+
+class FakeQueryResult:
+    """
+    The few bits of a pyarrow.Table used on query results.
+    """
+
+    def __init__(self, column_names: list, rows: list):
+        self.column_names = column_names
+        self.rows = rows
+        self.num_rows = len(rows)
+
+    def to_pylist(self) -> list:
+        return list(self.rows)
+
+
+class FakeBauplanClient:
+    """
+    An in-memory imitation of the subset of bauplan.Client used by the agents, the verifier
+    and the fan-out runner: branches are full copies of their tables, merges overwrite.
+
+    `schemas` maps table names to the columns tables get when created: data is never read, so
+    this is the only way to know them. Each import takes `import_delay` seconds, like a real one would.
+    """
+
+    def __init__(self, username: str = 'fake_user', tables: dict = None, schemas: dict = None, import_delay: float = 0.0):
+        self.username = username
+        self.schemas = dict(schemas or {})
+        self.import_delay = import_delay
+        self.branches = {'main': dict(tables or {})}
+        self._lock = threading.Lock()
+
+    def info(self):
+        return SimpleNamespace(user=SimpleNamespace(username=self.username))
+
+    def has_branch(self, branch: str) -> bool:
+        with self._lock:
+            return branch in self.branches
+
+    def get_branches(self, name: str = None, user: str = None):
+        with self._lock:
+            names = list(self.branches)
+        return [
+            SimpleNamespace(name=b) for b in names
+            if (name is None or name in b) and (user is None or b.startswith(f"{user}."))
+        ]
+
+    def create_branch(self, branch: str, from_ref: str = 'main'):
+        with self._lock:
+            if branch in self.branches:
+                raise ValueError(f"Branch {branch} already exists")
+            self.branches[branch] = dict(self.branches[from_ref])
+        return branch
+
+    def delete_branch(self, branch: str):
+        with self._lock:
+            if branch == 'main' or branch not in self.branches:
+                raise ValueError(f"Cannot delete branch {branch}")
+            del self.branches[branch]
+        return True
+
+    def merge_branch(self, source_ref: str, into_branch: str = 'main'):
+        with self._lock:
+            self.branches[into_branch].update(self.branches[source_ref])
+        return True
+
+    def create_table(self, table: str, search_uri: str, branch: str, replace: bool = False):
+        with self._lock:
+            tables = self.branches[branch]
+            if table in tables and not replace:
+                raise ValueError(f"Table {table} already exists")
+            tables[table] = FakeTable(column_names=list(self.schemas.get(table, ['ID', 'value'])), num_rows=0)
+        return table
+
+    def import_data(self, table: str, search_uri: str, branch: str, num_rows: int = 10):
+        if self.import_delay:
+            time.sleep(self.import_delay)
+        with self._lock:
+            current = self.branches[branch][table]
+            self.branches[branch][table] = current._replace(num_rows=current.num_rows + num_rows)
+        return SimpleNamespace(error=None)
+
+    def has_table(self, table: str, ref: str = 'main') -> bool:
+        with self._lock:
+            return table in self.branches.get(ref, {})
+
+    def get_table(self, table: str, ref: str = 'main'):
+        with self._lock:
+            t = self.branches[ref][table]
+        return SimpleNamespace(
+            name=table,
+            records=t.num_rows,
+            fields=[FakeField(name=c, required=False, type='string') for c in t.column_names]
+        )
+
+    def query(self, query: str, ref: str = 'main'):
+        # only "SELECT ... FROM table [LIMIT n]" is understood, and UNION ALL of those: aggregates
+        # (COUNT ... AS alias) return one row, in which every alias is the number of rows (unique,
+        # non null values), 'literal' AS alias the literal, NULL AS alias None
+        if re.search(r"\bUNION\s+ALL\b", query, re.IGNORECASE):
+            results = [self.query(q.strip(), ref) for q in re.split(r"\bUNION\s+ALL\b", query, flags=re.IGNORECASE)]
+            return FakeQueryResult(column_names=results[0].column_names, rows=[r for res in results for r in res.rows])
+        match = re.search(r"FROM\s+(\w+)(?:.*?LIMIT\s+(\d+))?", query, re.IGNORECASE | re.DOTALL)
+        assert match, f"Unsupported query: {query}"
+        with self._lock:
+            t = self.branches[ref][match.group(1)]
+        if 'COUNT(' in query.upper():
+            items = re.findall(r"('[^']*'|NULL|COUNT\([^)]*\))\s+AS\s+(\w+)", query, re.IGNORECASE)
+            row = {}
+            for expression, alias in items:
+                # like a real engine, fail on unknown columns
+                for column in re.findall(r'"(\w+)"', expression):
+                    if column not in t.column_names:
+                        raise ValueError(f"Column {column} not found in {match.group(1)}")
+                if expression.startswith("'"):
+                    row[alias] = expression.strip("'")
+                elif expression.upper() == 'NULL':
+                    row[alias] = None
+                else:
+                    row[alias] = t.num_rows
+            return FakeQueryResult(column_names=[a for _, a in items], rows=[row])
+        limit = int(match.group(2)) if match.group(2) else t.num_rows
+        rows = [{c: i for c in t.column_names} for i in range(min(limit, t.num_rows))]
+        return FakeQueryResult(column_names=t.column_names, rows=rows)
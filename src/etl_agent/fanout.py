@@ -0,0 +1,306 @@
+"""
+
+Run several ETL agents at the same time over the lakehouse, each one sandboxed in its own data branch,
+and publish the first one that passes the verifier.
+
+Each variant of the agent (a different model, temperature or prompt) runs the ReAct loop in a worker
+thread, with at most N agents per LLM provider running at any given time. As soon as one candidate
+passes verify_etl_process on its branch, the winning branch is merged into main and fan_out returns, while
+the others are stopped, and all candidate branches deleted, in the background: the time to the first
+verified result is the time of the fastest agent, not the sum of sequential retries.
+
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# one agent configuration to try: None values fall back to the defaults of the runner
+AgentVariant = namedtuple(
+    'AgentVariant',
+    ['name', 'model_name', 'temperature', 'system_prompt', 'user_prompt_template'],
+    defaults=(0.7, None, None)
+)
+# the outcome of one variant: answer is None if the agent failed (or was stopped)
+CandidateResult = namedtuple('CandidateResult', ['variant', 'branch', 'answer', 'verified', 'elapsed', 'error'])
+# candidates are the results gathered until the winner was found: join cleanup (a thread) to wait for the
+# other agents to stop, and for all the candidate branches to be deleted
+FanOutResult = namedtuple('FanOutResult', ['winner', 'candidates', 'time_to_first_verified', 'cleanup'], defaults=(None,))
+
+
+def provider_of(model_name: str) -> str:
+    """
+    The provider of a litellm model name, e.g. together_ai for together_ai/deepseek-ai/DeepSeek-V3.
+    """
+    return model_name.split('/')[0] if '/' in model_name else 'default'
+
+
+async def fan_out(
+    variants: list,
+    run_agent,
+    client,
+    verify=None,
+    provider_limits: dict = None,
+    default_limit: int = 2,
+    branch_prefix: str = 'fanout'
+) -> FanOutResult:
+    """
+    Run all the variants concurrently, merge the first verified one into main and return right away:
+    the other agents are stopped, and the candidate branches deleted, in the background (see FanOutResult).
+
+    Parameters:
+    - variants: The list of AgentVariant to run.
+    - run_agent: A (blocking) function run_agent(variant, branch, stop_event) running the agent on the
+      given branch, and returning its final answer, or None; it should return as soon as stop_event is set.
+    - client: The Bauplan client used to verify, merge and clean up branches.
+    - verify: A function verify(branch, client) -> bool, verify_etl_process by default.
+    - provider_limits: The maximum number of concurrent agents per provider, e.g. {'together_ai': 2}.
+    - default_limit: The limit for providers not in provider_limits.
+    - branch_prefix: The prefix of the candidate branches, which are named username.prefix_run_i.
+    """
+    if verify is None:
+        from verifier import verify_etl_process
+        verify = lambda branch, client: verify_etl_process(branch=branch, client=client)
+    provider_limits = provider_limits or {}
+    semaphores = {}
+    for variant in variants:
+        provider = provider_of(variant.model_name)
+        if provider not in semaphores:
+            semaphores[provider] = asyncio.Semaphore(provider_limits.get(provider, default_limit))
+    username = client.info().user.username
+    run_id = uuid.uuid4().hex[:8]
+    branches = [f"{username}.{branch_prefix}_{run_id}_{idx}" for idx in range(len(variants))]
+    stop_events = [threading.Event() for _ in variants]
+    # the agents run in threads of our own, so that the cleanup can wait for them after we return
+    workers = ThreadPoolExecutor(max_workers=max(len(variants), 1), thread_name_prefix='fanout-agent')
+    start = time.perf_counter()
+
+    async def run_candidate(idx: int, variant: AgentVariant) -> CandidateResult:
+        branch = branches[idx]
+        stop_event = stop_events[idx]
+        answer, verified, error = None, False, None
+        async with semaphores[provider_of(variant.model_name)]:
+            if stop_event.is_set():
+                error = 'cancelled before starting'
+            else:
+                try:
+                    # like asyncio.to_thread, in a copy of the current context
+                    call = functools.partial(contextvars.copy_context().run, run_agent, variant, branch, stop_event)
+                    answer = await asyncio.get_running_loop().run_in_executor(workers, call)
+                except Exception as e:
+                    error = str(e)
+        # no need to verify a loser, once we have a winner
+        if answer is not None and not stop_event.is_set():
+            try:
+                verified = await asyncio.to_thread(verify, branch, client)
+            except Exception as e:
+                error = f"verification error: {e}"
+        return CandidateResult(
+            variant=variant,
+            branch=branch,
+            answer=answer,
+            verified=verified,
+            elapsed=time.perf_counter() - start,
+            error=error
+        )
+
+    def delete_branches():
+        # every candidate branch goes away, once no agent can write to it anymore: the winner has been
+        # merged, the others lost
+        workers.shutdown(wait=True, cancel_futures=True)
+        for branch in branches:
+            try:
+                if client.has_branch(branch):
+                    client.delete_branch(branch)
+            except Exception as e:
+                print(f"Could not delete branch {branch}: {e}")
+
+    tasks = [asyncio.create_task(run_candidate(idx, v)) for idx, v in enumerate(variants)]
+    cleanup = threading.Thread(target=delete_branches, name='fanout-cleanup')
+    winner, time_to_first_verified, candidates = None, None, []
+    merge_error = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            candidates.append(result)
+            if result.verified:
+                winner, time_to_first_verified = result, result.elapsed
+                print(f"🏆 {result.variant.name} verified on {result.branch} after {result.elapsed:.1f}s, stopping the others")
+                for e in stop_events:
+                    e.set()
+                # merged before the cleanup starts, as the cleanup deletes the winning branch too
+                try:
+                    await asyncio.to_thread(client.merge_branch, source_ref=winner.branch, into_branch='main')
+                    print(f"✅ Merged {winner.branch} into main")
+                except Exception as e:
+                    print(f"❌ Could not merge {winner.branch} into main: {e}")
+                    merge_error = e
+                break
+    finally:
+        # whatever happened, stop the agents still running, drop the ones waiting for their provider
+        for e in stop_events:
+            e.set()
+        for task in tasks:
+            task.cancel()
+        cleanup.start()
+    if merge_error is not None:
+        # wait for the others to stop, so that their branches are cleaned up too, then raise
+        await asyncio.to_thread(cleanup.join)
+        raise merge_error
+
+    return FanOutResult(winner=winner, candidates=candidates, time_to_first_verified=time_to_first_verified, cleanup=cleanup)
+
+
+def react_agent_runner(
+    s3_raw_bucket: str,
+    bauplan_api_key: str,
+    eb2_api_key: str,
+    max_tokens: int,
+    max_iterations: int,
+    llm_folder: str,
+    verbose: bool = False,
+    **loop_kwargs
+):
+    """
+    Build a run_agent function for fan_out running run_react_loop, with the fan-out prompt asking the
+    model to work on the assigned branch and not to merge it. Generated code is stored per variant.
+    """
+    from etl_agent_loop import run_react_loop
+    from prompts import system_prompt, FANOUT_USER_PROMPT_TEMPLATE
+
+    def run_agent(variant: AgentVariant, branch: str, stop_event: threading.Event):
+        variant_folder = os.path.join(llm_folder, 'fanout', variant.name)
+        os.makedirs(os.path.join(variant_folder, 'etl_agent'), exist_ok=True)
+        return run_react_loop(
+            templated_user_input=variant.user_prompt_template or FANOUT_USER_PROMPT_TEMPLATE,
+            s3_raw_bucket=s3_raw_bucket,
+            bauplan_api_key=bauplan_api_key,
+            model_name=variant.model_name,
+            max_tokens=max_tokens,
+            temperature=variant.temperature,
+            eb2_api_key=eb2_api_key,
+            system_prompt=variant.system_prompt or system_prompt(),
+            max_iterations=max_iterations,
+            llm_folder=variant_folder,
+            verbose=verbose,
+            stop_event=stop_event,
+            prompt_variables={'branch_name': branch},
+            **loop_kwargs
+        )
+
+    return run_agent
+
+
+# the response delay of the scripted model of each offline variant, in seconds
+OFFLINE_DELAYS = {'fast': 0.1, 'medium': 0.5, 'slow': 2.0}
+
+
+def _offline_agents(client=None, delays: dict = None, llm_folder: str = None) -> tuple:
+    """
+    Three scripted agents of different speeds over a fake lakehouse (a FakeBauplanClient, unless one is
+    given), importing every table in their branch: return (client, run_agent, variants) for fan_out.
+    """
+    import tempfile
+    from etl_agent_loop import run_react_loop
+    from fakes import ScriptedLLM, FakeBauplanClient, FakeCodeExecutor
+    from utils import ExecutorResponse
+    from verifier import EXPECTED_TABLES
+
+    if client is None:
+        client = FakeBauplanClient(schemas={t.name: t.expected_columns for t in EXPECTED_TABLES})
+    delays = delays or OFFLINE_DELAYS
+    llm_folder = llm_folder or tempfile.mkdtemp()
+    os.makedirs(os.path.join(llm_folder, 'etl_agent'), exist_ok=True)
+    tables = ['acquirer_countries', 'payments', 'merchant_category_codes', 'fees', 'merchant_data']
+    responses = [
+        "<reasoning>Import the files in the branch</reasoning><packages>bauplan</packages>"
+        "<code>try:\n    print('importing')\nexcept Exception as e:\n    print(e)</code>",
+        "<done>Branch ready</done>"
+    ]
+
+    def run_agent(variant: AgentVariant, branch: str, stop_event: threading.Event):
+        # the fake executor mimics the side effects of a successful import on the fake lakehouse
+        def on_run(code, packages):
+            client.create_branch(branch, from_ref='main')
+            for t in tables:
+                client.create_table(t, search_uri=f"s3://raw/{t}.parquet", branch=branch, replace=True)
+                client.import_data(t, search_uri=f"s3://raw/{t}.parquet", branch=branch)
+            return ExecutorResponse(result=[branch], stdout=['imported\n'], stderr=[], error=None)
+
+        return run_react_loop(
+            templated_user_input="ETL from {s3_raw_bucket} on {branch_name}",
+            s3_raw_bucket='s3://raw',
+            bauplan_api_key='fake',
+            model_name=variant.model_name,
+            max_tokens=1000,
+            temperature=variant.temperature,
+            eb2_api_key='fake',
+            system_prompt='fake system prompt',
+            max_iterations=3,
+            llm_folder=llm_folder,
+            executor=FakeCodeExecutor(on_run=on_run),
+            completion_fn=ScriptedLLM(responses, delay=delays[variant.name]),
+            stop_event=stop_event,
+            prompt_variables={'branch_name': branch}
+        )
+
+    variants = [
+        AgentVariant('slow', 'together_ai/slow-model'),
+        AgentVariant('medium', 'openai/medium-model'),
+        AgentVariant('fast', 'together_ai/fast-model'),
+    ]
+    return client, run_agent, variants
+
+
+def _offline_demo() -> FanOutResult:
+    """
+    Fan out the offline agents: no network involved.
+    """
+    client, run_agent, variants = _offline_agents()
+    return asyncio.run(fan_out(variants, run_agent, client=client, provider_limits={'together_ai': 2}))
+
+
+if __name__ == "__main__":
+    import sys
+    if '--offline' in sys.argv:
+        result = _offline_demo()
+    else:
+        llm_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_code")
+        from config import load_env, check_env
+        from etl_agent_loop import MAX_TOKENS, MAX_ITERATIONS
+        from catalog import catalog_for_prompt
+        import bauplan
+        load_env()
+        check_env(['BAUPLAN_API_KEY', 'E2B_API_KEY', 'TOGETHER_API_KEY', 'S3_BUCKET_RAW_DATA'])
+        variants = [
+            AgentVariant('deepseek_v3', 'together_ai/deepseek-ai/DeepSeek-V3', temperature=0.7),
+            AgentVariant('deepseek_v3_cold', 'together_ai/deepseek-ai/DeepSeek-V3', temperature=0.2),
+            AgentVariant('qwen_coder', 'together_ai/Qwen/Qwen2.5-Coder-32B-Instruct', temperature=0.7),
+        ]
+        run_agent = react_agent_runner(
+            s3_raw_bucket=os.environ['S3_BUCKET_RAW_DATA'],
+            bauplan_api_key=os.environ['BAUPLAN_API_KEY'],
+            eb2_api_key=os.environ['E2B_API_KEY'],
+            max_tokens=MAX_TOKENS,
+            max_iterations=MAX_ITERATIONS,
+            llm_folder=llm_folder,
+            # the catalog is built once, and shared by all the variants
+            catalog=catalog_for_prompt(os.environ['S3_BUCKET_RAW_DATA'])
+        )
+        profile = os.environ.get('BAUPLAN_PROFILE', 'default')
+        result = asyncio.run(fan_out(variants, run_agent, client=bauplan.Client(profile=profile), provider_limits={'together_ai': 2}))
+    for c in result.candidates:
+        print(f"{c.variant.name}: verified={c.verified} elapsed={c.elapsed:.1f}s error={c.error}")
+    if result.winner is None:
+        print("❌ No agent produced a verified result.")
+    else:
+        print(f"✅ Winner: {result.winner.variant.name}, first verified result after {result.time_to_first_verified:.1f}s")
+    result.cleanup.join()
+    print("🧹 The other agents stopped, and the candidate branches were deleted")
@@ -0,0 +1,244 @@
+"""
+
+Helpers to get completions from the LLM through a litellm-shaped completion function, i.e. one with the
+signature of litellm's `completion`, returning objects with the same shape (so that fakes, caches and
+other providers can be swapped in).
+
+Completions are streamed into the IncrementalResponseParser, and cut as soon as the response is complete:
+we stop reading the stream right after </code> or </done>. The closing tags are not sent as stop sequences
+by default: providers drop the stop sequence from the text, and most of them (OpenAI included) report a
+stop sequence and a natural end of the generation alike, as 'stop', so that a response which was never
+closed could not be told apart from a complete one.
+
+Two completion functions are available: litellm_completion, which imports litellm (seconds of startup)
+only when the first completion is requested, and HTTPCompletion, a thin client for OpenAI compatible
+endpoints (OpenAI, Together AI, vLLM...) built on the standard library only.
+
+"""
+
+import json
+import os
+from types import SimpleNamespace
+from utils import IncrementalResponseParser
+
+
+# the closing tags, as stop sequences for the providers which report the one that matched (see stream_into_parser)
+STOP_SEQUENCES = ['</code>', '</done>']
+# where OpenAI compatible servers report the stop sequence which ended a choice (vLLM: stop_reason,
+# SGLang: matched_stop): a 'stop' finish reason alone does not say
+MATCHED_STOP_FIELDS = ('stop_reason', 'matched_stop')
+# the OpenAI compatible endpoint of each litellm provider prefix, and the env variable with its key
+OPENAI_COMPATIBLE_PROVIDERS = {
+    'together_ai': ('https://api.together.xyz/v1', 'TOGETHER_API_KEY'),
+    'openai': ('https://api.openai.com/v1', 'OPENAI_API_KEY'),
+}
+
+
+def litellm_completion(**kwargs):
+    """
+    litellm's `completion`, imported on the first call: importing litellm alone takes seconds, which
+    tools, tests and short-lived workers should not pay unless they actually call a model.
+    """
+    from litellm import completion
+    return completion(**kwargs)
+
+
+class HTTPCompletionError(Exception):
+    """
+    An error response of an OpenAI compatible endpoint: status_code and retry_after (in seconds, if the
+    endpoint sent one) tell the callers whether, and when, to retry.
+    """
+
+    def __init__(self, message: str, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class HTTPCompletion:
+    """
+    A completion function (litellm signature, streaming or not) for OpenAI compatible chat completion
+    endpoints, with no dependencies. Model names keep their litellm provider prefix: with no base_url,
+    the prefix picks the endpoint and the API key (see OPENAI_COMPATIBLE_PROVIDERS), and it is dropped
+    from the model sent to the endpoint.
+
+    Parameters:
+    - base_url: The base URL of the endpoint (e.g. http://localhost:8000/v1): None to use the provider prefix.
+    - api_key: The API key: None to read it from the env variable of the provider.
+    - timeout: The timeout of each request, in seconds.
+    """
+
+    def __init__(self, base_url: str = None, api_key: str = None, timeout: float = 120.0):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def _endpoint(self, model: str) -> tuple:
+        # (url, API key, model name for the endpoint)
+        provider, _, name = model.partition('/')
+        if provider in OPENAI_COMPATIBLE_PROVIDERS and name:
+            base_url, key_env = OPENAI_COMPATIBLE_PROVIDERS[provider]
+            return (self.base_url or base_url).rstrip('/'), self.api_key or os.environ.get(key_env), name
+        assert self.base_url, f"No base_url, and no known provider prefix in {model}"
+        return self.base_url.rstrip('/'), self.api_key, model
+
+    def __call__(
+        self,
+        model: str,
+        messages: list,
+        max_tokens: int = None,
+        temperature: float = None,
+        stream: bool = False,
+        stop: list = None,
+        **kwargs
+    ):
+        # imported here, like litellm in litellm_completion: urllib.request alone is tens of milliseconds
+        import urllib.error
+        import urllib.request
+
+        base_url, api_key, model_name = self._endpoint(model)
+        payload = {'model': model_name, 'messages': _plain_messages(messages), 'stream': stream}
+        for key, value in (('max_tokens', max_tokens), ('temperature', temperature), ('stop', stop)):
+            if value is not None:
+                payload[key] = value
+        headers = {'Content-Type': 'application/json'}
+        if api_key:
+            headers['Authorization'] = f"Bearer {api_key}"
+        request = urllib.request.Request(
+            f"{base_url}/chat/completions", data=json.dumps(payload).encode('utf-8'), headers=headers, method='POST'
+        )
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                retry_after = float(e.headers.get('retry-after'))
+            except (AttributeError, TypeError, ValueError):
+                retry_after = None
+            raise HTTPCompletionError(
+                f"{e.code} from {base_url}: {e.read().decode('utf-8', errors='replace')[:500]}",
+                status_code=e.code,
+                retry_after=retry_after
+            ) from e
+        except urllib.error.URLError as e:
+            # timeouts and refused connections: worth retrying, like the ones of the SDKs
+            raise ConnectionError(f"Could not reach {base_url}: {e.reason}") from e
+        if stream:
+            return self._stream(response)
+        with response:
+            body = json.loads(response.read())
+        choice = body['choices'][0]
+        return completion_response(
+            choice['message'].get('content') or '', model=model, finish_reason=choice.get('finish_reason'),
+            usage=body.get('usage'), stop_reason=_reported_stop(choice)
+        )
+
+    def _stream(self, response):
+        # server-sent events: one "data: {...}" line per chunk, and "data: [DONE]" at the end
+        with response:
+            for raw_line in response:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                chunk = json.loads(data)
+                if not chunk.get('choices'):
+                    continue
+                choice = chunk['choices'][0]
+                yield stream_chunk(
+                    (choice.get('delta') or {}).get('content') or '', finish_reason=choice.get('finish_reason'),
+                    usage=chunk.get('usage'), stop_reason=_reported_stop(choice)
+                )
+
+
+def _reported_stop(choice: dict):
+    # the stop sequence the server says ended the choice, if it says (a token id is not one of ours)
+    for field in MATCHED_STOP_FIELDS:
+        if isinstance(choice.get(field), str):
+            return choice[field]
+    return None
+
+
+def _plain_messages(messages: list) -> list:
+    # content blocks keep only type and text: provider specific fields (e.g. cache_control) are dropped
+    plain = []
+    for message in messages:
+        content = message['content']
+        if isinstance(content, list):
+            content = [{'type': block.get('type', 'text'), 'text': block.get('text', '')} for block in content]
+        plain.append({'role': message['role'], 'content': content})
+    return plain
+
+
+def completion_response(text: str, model: str = None, finish_reason: str = 'stop', usage=None, stop_reason: str = None):
+    """
+    Build an object shaped like a (non streaming) litellm completion response: stop_reason is the stop
+    sequence which ended it, if the provider reported one.
+    """
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason=finish_reason, stop_reason=stop_reason)],
+        usage=usage
+    )
+
+
+def stream_chunk(text: str, finish_reason: str = None, usage=None, stop_reason: str = None):
+    """
+    Build an object shaped like a chunk of a streaming litellm completion response.
+    """
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=finish_reason, stop_reason=stop_reason)],
+        usage=usage
+    )
+
+
+def matched_stop(choice, stop: list) -> str:
+    """
+    The stop sequence (one of `stop`) the provider reports as the end of the choice, or None.
+    """
+    fields = getattr(choice, 'provider_specific_fields', None) or {}
+    for field in MATCHED_STOP_FIELDS:
+        value = getattr(choice, field, None) or fields.get(field)
+        if isinstance(value, str) and value in (stop or []):
+            return value
+    return None
+
+
+def stream_into_parser(
+    completion_fn,
+    parser: IncrementalResponseParser,
+    model: str,
+    messages: list,
+    max_tokens: int,
+    temperature: float,
+    stop: list = None
+) -> str:
+    """
+    Stream a completion into the parser, stopping as soon as the response is complete, and return
+    the finish reason ('stop', 'length', ...). Call parser.close() afterwards to get the parsed response.
+
+    With `stop` (e.g. STOP_SEQUENCES, for a provider which reports the one that matched), the finish
+    reason is 'stop_sequence' only when the provider says one of them ended the text: only then the parser
+    can imply the closing tag, pass stopped_by_sequence=True to parser.close().
+    """
+    request = dict(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True)
+    if stop:
+        request['stop'] = stop
+    stream = completion_fn(**request)
+    finish_reason = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        content = getattr(choice.delta, 'content', None)
+        if content and parser.feed(content):
+            # we got the closing tag: no need to wait for (and pay) anything else
+            finish_reason = 'stop'
+            break
+        if choice.finish_reason:
+            finish_reason = 'stop_sequence' if matched_stop(choice, stop) else choice.finish_reason
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        close()
+    return finish_reason
@@ -0,0 +1,342 @@
+"""
+
+A content-addressed cache for LLM completions (and the code executions between them), with record /
+replay modes.
+
+Completions are keyed on a hash of everything that determines them (model, messages, temperature,
+max_tokens and stop sequences) and stored in a local SQLite file, evicting the least recently used
+entries when the cache grows over its size limit. CachedCompletion wraps any litellm-shaped completion
+function, streaming or not, so that:
+
+* "read_write" reuses cached completions and stores new ones;
+* "record" always calls the provider, and stores (or refreshes) every completion;
+* "replay" never calls the provider, and fails on a cache miss: a recorded agent run can be replayed
+  offline, deterministically, with zero calls to the LLM provider;
+* "off" is a plain pass-through.
+
+The history sent to the model includes the output of the code it wrote, which changes from run to run
+(e.g. the timestamped branch names the prompt asks for): replaying completions alone would miss from the
+second iteration on. CachedExecutor records every execution of the code alongside the completions, and
+replays it without any sandbox, so that a recorded run replays end to end with zero network calls.
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from llm import completion_response, stream_chunk
+from utils import CodeExecutor, ExecutorResponse
+
+
+CACHE_MODES = ('off', 'read_write', 'record', 'replay')
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'data-agents', 'llm_cache.sqlite')
+
+
+class CacheMissError(LookupError):
+    """
+    No cached completion for a request, in replay mode.
+    """
+    pass
+
+
+def cache_key(model: str, messages: list, temperature: float, max_tokens: int, stop: list = None) -> str:
+    """
+    The hash of a completion request: any change in the inputs gives a different key.
+    """
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens, 'stop': stop},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def record_key(kind: str, **inputs) -> str:
+    """
+    The hash of anything else recorded with the completions (an execution, the raw data catalog...).
+    """
+    payload = json.dumps({'kind': kind, **inputs}, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """
+    Completions (and other records, as JSON) stored in a SQLite file, with size-based LRU eviction: when
+    the stored text goes over `max_bytes`, the least recently used entries are deleted.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY, model TEXT, text TEXT, finish_reason TEXT,"
+            " size INTEGER, created_at REAL, last_access REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions(last_access)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " key TEXT PRIMARY KEY, kind TEXT, value TEXT, size INTEGER, created_at REAL, last_access REAL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str):
+        """
+        Return (text, finish_reason) for the key, or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT text, finish_reason FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+        return row
+
+    def put(self, key: str, model: str, text: str, finish_reason: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, text, finish_reason, len(text.encode('utf-8')), now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def get_record(self, key: str):
+        """
+        Return the value recorded for the key, or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM records WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE records SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+        return None if row is None else json.loads(row[0])
+
+    def put_record(self, key: str, kind: str, value):
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, text, len(text.encode('utf-8')), now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = sum(
+            self._db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+            for table in ('completions', 'records')
+        )
+        if total <= self.max_bytes:
+            return
+        entries = self._db.execute(
+            "SELECT 'completions', key, size, last_access FROM completions"
+            " UNION ALL SELECT 'records', key, size, last_access FROM records ORDER BY 4"
+        ).fetchall()
+        for table, key, size, _ in entries:
+            self._db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+            records, records_size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM records").fetchone()
+        return {'entries': count, 'records': records, 'bytes': size + records_size, 'max_bytes': self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CachedCompletion:
+    """
+    A completion function (litellm signature) backed by a CompletionCache: see the module docstring
+    for the modes. Cached completions are returned in the shape requested, i.e. as a single chunk
+    stream when stream=True. `hits` and `misses` count the lookups.
+    """
+
+    def __init__(self, completion_fn, cache: CompletionCache, mode: str = 'read_write'):
+        assert mode in CACHE_MODES, f"Unknown cache mode {mode}, expected one of {CACHE_MODES}"
+        self.completion_fn = completion_fn
+        self.cache = cache
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(
+        self,
+        model: str,
+        messages: list,
+        max_tokens: int = None,
+        temperature: float = None,
+        stream: bool = False,
+        stop: list = None,
+        **kwargs
+    ):
+        if self.mode == 'off':
+            return self.completion_fn(
+                model=model, messages=messages, max_tokens=max_tokens, temperature=temperature,
+                stream=stream, stop=stop, **kwargs
+            )
+        key = cache_key(model, messages, temperature, max_tokens, stop)
+        if self.mode != 'record':
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.hits += 1
+                text, finish_reason = cached
+                if stream:
+                    return iter([stream_chunk(text, finish_reason=finish_reason)])
+                return completion_response(text, model=model, finish_reason=finish_reason)
+        self.misses += 1
+        if self.mode == 'replay':
+            raise CacheMissError(f"No cached completion for model {model} (key {key[:12]}) in replay mode")
+        response = self.completion_fn(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature,
+            stream=stream, stop=stop, **kwargs
+        )
+        if not stream:
+            choice = response.choices[0]
+            self.cache.put(key, model, choice.message.content or '', choice.finish_reason)
+            return response
+        return self._recording_stream(response, key, model)
+
+    def _recording_stream(self, stream, key: str, model: str):
+        # pass the chunks through, and store the text when the stream ends: if the consumer stops
+        # reading early (e.g. after </code>), what it read is what we store, as a complete response
+        parts, finish_reason = [], None
+        try:
+            for chunk in stream:
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    content = getattr(choice.delta, 'content', None)
+                    if content:
+                        parts.append(content)
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+                yield chunk
+        except GeneratorExit:
+            # closed by the consumer: store what it read (a provider error, instead, stores nothing)
+            self.cache.put(key, model, ''.join(parts), finish_reason or 'stop')
+            raise
+        else:
+            self.cache.put(key, model, ''.join(parts), finish_reason or 'stop')
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+
+
+def cached_value(cache: CompletionCache, mode: str, key: str, kind: str, compute):
+    """
+    The JSON friendly value of compute(), through the cache: replay returns the recorded value (and raises
+    CacheMissError if there is none), off only computes it, the other modes compute and record it.
+    """
+    if mode == 'replay':
+        value = cache.get_record(key)
+        if value is None:
+            raise CacheMissError(f"No recorded {kind} (key {key[:12]}) in replay mode")
+        return value
+    value = compute()
+    if mode != 'off':
+        cache.put_record(key, kind, value)
+    return value
+
+
+class RecordedError:
+    """
+    An execution error replayed from the cache: it reads like the original (str), and keeps the name,
+    value and traceback of the E2B errors which had them.
+    """
+
+    def __init__(self, text: str, name: str = None, value: str = None, traceback: str = None):
+        self.text = text
+        if traceback is not None:
+            self.name, self.value, self.traceback = name, value, traceback
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __repr__(self) -> str:
+        return f"RecordedError({self.text!r})"
+
+
+def _execution_record(response: ExecutorResponse) -> dict:
+    # everything the loop reads of a response goes through str(), so that is what we keep
+    error = response.error
+    if error is not None and not isinstance(error, str):
+        error = {
+            'text': str(error), 'name': getattr(error, 'name', None), 'value': getattr(error, 'value', None),
+            'traceback': getattr(error, 'traceback', None)
+        }
+    return {
+        'result': [str(r) for r in response.result or []],
+        'stdout': [str(o) for o in response.stdout or []],
+        'stderr': [str(o) for o in response.stderr or []],
+        'error': error
+    }
+
+
+def _execution_response(record: dict) -> ExecutorResponse:
+    error = record['error']
+    return ExecutorResponse(
+        result=record['result'],
+        stdout=record['stdout'],
+        stderr=record['stderr'],
+        error=RecordedError(**error) if isinstance(error, dict) else error
+    )
+
+
+class CachedExecutor(CodeExecutor):
+    """
+    A CodeExecutor recording every execution in a CompletionCache, keyed on the code, the packages and
+    how many times the same code already ran in this executor. Code always runs in the wrapped executor,
+    except in replay mode, where the recorded responses are returned instead and `executor` can be None:
+    executions have side effects (on the lakehouse), so they are never reused outside replays.
+    """
+
+    def __init__(self, executor: CodeExecutor, cache: CompletionCache, mode: str = 'record'):
+        assert mode in CACHE_MODES, f"Unknown cache mode {mode}, expected one of {CACHE_MODES}"
+        assert executor is not None or mode == 'replay', "Only a replay can do without an executor"
+        self.executor = executor
+        self.cache = cache
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._runs = {}
+
+    def prepare(self, python_packages: list = None):
+        if self.mode != 'replay':
+            self.executor.prepare(python_packages)
+
+    def run_code(self, code: str, python_packages: list = None) -> ExecutorResponse:
+        if self.mode == 'off':
+            return self.executor.run_code(code, python_packages)
+        packages = list(python_packages or [])
+        occurrence = self._runs.get((code, tuple(packages)), 0)
+        self._runs[(code, tuple(packages))] = occurrence + 1
+        key = record_key('execution', code=code, packages=packages, occurrence=occurrence)
+        if self.mode == 'replay':
+            record = self.cache.get_record(key)
+            if record is None:
+                self.misses += 1
+                raise CacheMissError(f"No recorded execution (key {key[:12]}) in replay mode")
+            self.hits += 1
+            return _execution_response(record)
+        response = self.executor.run_code(code, python_packages)
+        self.cache.put_record(key, 'execution', _execution_record(response))
+        return response
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
@@ -0,0 +1,397 @@
+"""
+
+Pre-flight checks of the code written by the model, run locally before anything goes to the sandbox.
+
+A syntax error, an undeclared import or a misspelled Bauplan method costs a full sandbox round trip and
+another LLM turn to be discovered remotely: here we find them in a few milliseconds, with the standard
+library only, and the loop sends them back to the model without executing anything. The checks are:
+
+* the code compiles;
+* the code has the shape required by the system prompt: ONE try / except block, at the top level (or in a
+  `__main__` guard, or in a function called there), with only imports, definitions, constants, the
+  creation of the client and the value of the cell (a name on the last line) outside of it;
+* every imported module is in the standard library, in the <packages> of the response, or pre-installed;
+* every method called on a bauplan.Client (and every function of the `wap` tool) exists, and is called
+  with keyword arguments it accepts.
+
+Only certain problems are reported: when in doubt (e.g. a client passed around in a way we cannot
+follow), the code goes to the sandbox as usual.
+
+"""
+
+import ast
+import difflib
+import inspect
+import sys
+from collections import namedtuple
+from functools import lru_cache
+from dependencies import canonical_name, normalize_packages
+
+
+# one problem found in the code: line is None when it is about the code as a whole
+PreflightIssue = namedtuple('PreflightIssue', ['line', 'kind', 'message'])
+_TRY_NODES = (ast.Try, getattr(ast, 'TryStar', ast.Try))
+
+# the bauplan version installed in the sandbox when the client is not installed locally: the one in uv.lock
+BAUPLAN_VERSION = '0.0.3a395'
+# the methods of bauplan.Client in BAUPLAN_VERSION, with the keyword arguments they accept (None: any),
+# used when bauplan is not importable: otherwise the table is built from the installed client
+_COMMON_KWARGS = {'debug', 'args', 'verbose', 'client_timeout'}
+_QUERY_KWARGS = {
+    'query', 'ref', 'max_rows', 'cache', 'connector', 'connector_config_key', 'connector_config_uri', 'namespace'
+} | _COMMON_KWARGS
+_COMMIT_KWARGS = {'commit_body', 'commit_properties'}
+BAUPLAN_CLIENT_METHODS = {
+    'info': None,
+    'create_branch': {'branch', 'from_ref'},
+    'delete_branch': {'branch'},
+    'has_branch': {'branch'},
+    'get_branch': {'branch'},
+    'get_branches': {'name', 'user', 'limit', 'itersize'},
+    'merge_branch': {'source_ref', 'into_branch', 'commit_message', 'message', 'properties'} | _COMMIT_KWARGS,
+    'create_table': {'table', 'search_uri', 'branch', 'namespace', 'partitioned_by', 'replace'} | _COMMON_KWARGS,
+    'plan_table_creation': {'table', 'search_uri', 'branch', 'namespace', 'partitioned_by', 'replace'} | _COMMON_KWARGS,
+    'apply_table_creation_plan': {'plan'} | _COMMON_KWARGS,
+    'import_data': {
+        'table', 'search_uri', 'branch', 'namespace', 'continue_on_error', 'import_duplicate_files',
+        'best_effort', 'preview'
+    } | _COMMON_KWARGS,
+    'get_table': {'table', 'ref', 'include_raw'},
+    'has_table': {'table', 'ref'},
+    'get_tables': {'ref', 'filter_by_name', 'filter_by_namespace', 'namespace', 'include_raw', 'limit', 'itersize'},
+    'delete_table': {'table', 'branch', 'properties'} | _COMMIT_KWARGS,
+    'revert_table': {'table', 'source_ref', 'into_branch', 'replace'} | _COMMIT_KWARGS,
+    'query': _QUERY_KWARGS,
+    'query_to_generator': _QUERY_KWARGS | {'as_json'},
+    'query_to_parquet_file': None,
+    'query_to_csv_file': None,
+    'query_to_json_file': _QUERY_KWARGS | {'path', 'file_format'},
+    'scan': None,
+    'run': {
+        'project_dir', 'ref', 'namespace', 'parameters', 'cache', 'transaction', 'dry_run', 'strict', 'preview',
+        'detach'
+    } | _COMMON_KWARGS,
+    'rerun': {
+        'job_id', 'ref', 'namespace', 'cache', 'transaction', 'dry_run', 'strict', 'preview'
+    } | _COMMON_KWARGS,
+    'get_commits': {
+        'ref', 'filter_by_message', 'filter_by_author_username', 'filter_by_author_name', 'filter_by_author_email',
+        'filter_by_authored_date', 'filter_by_authored_date_start_at', 'filter_by_authored_date_end_at',
+        'filter_by_parent_hash', 'filter_by_properties', 'filter', 'limit', 'itersize'
+    },
+    'create_namespace': {'namespace', 'branch', 'properties'} | _COMMIT_KWARGS,
+    'delete_namespace': {'namespace', 'branch', 'properties'} | _COMMIT_KWARGS,
+    'has_namespace': {'namespace', 'ref'},
+    'get_namespaces': {'ref', 'filter_by_name', 'limit', 'itersize'},
+    'get_namespace': {'namespace', 'ref'},
+    'create_tag': {'tag', 'from_ref'},
+    'delete_tag': {'tag'},
+    'has_tag': {'tag'},
+    'get_tags': {'filter_by_name', 'limit', 'itersize'},
+    'get_tag': {'tag'},
+    'get_job': {'job_id'},
+    'list_jobs': {'all_users'},
+    'get_job_logs': {'job_id_prefix'},
+    'cancel_job': {'job_id'},
+}
+# modules the sandbox has without listing them in <packages>: bauplan and wap are installed while warming
+# up, the others come with the E2B code interpreter image (pass your own to Preflight with a custom template)
+PREINSTALLED_MODULES = {
+    'bauplan', 'wap', 'aiohttp', 'bs4', 'bokeh', 'cv2', 'dateutil', 'docx', 'gensim', 'imageio', 'joblib',
+    'librosa', 'matplotlib', 'nltk', 'numpy', 'openpyxl', 'pandas', 'plotly', 'pytest', 'pytz', 'requests',
+    'scipy', 'seaborn', 'skimage', 'sklearn', 'soundfile', 'spacy', 'sympy', 'textblob', 'tornado', 'urllib3',
+    'xarray', 'xlrd'
+}
+# modules which come with a package, when their name differs
+PACKAGE_MODULES = {
+    'bauplan': {'pyarrow'},
+    'boto3': {'botocore', 's3transfer'},
+    'pyyaml': {'yaml'},
+    'scikit-learn': {'sklearn'},
+    'pillow': {'PIL'},
+    'python-dateutil': {'dateutil'},
+    'beautifulsoup4': {'bs4'},
+    'duckdb': set(),
+    'pandas': {'dateutil', 'pytz', 'numpy'},
+    'polars': set(),
+}
+
+
+def _signature_kwargs(function):
+    # None if the function accepts any keyword argument (or we cannot tell)
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    if any(p.kind == p.VAR_KEYWORD for p in parameters):
+        return None
+    return {p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)}
+
+
+@lru_cache(maxsize=1)
+def bauplan_client_methods() -> dict:
+    """
+    The methods of bauplan.Client, with the keyword arguments they accept: read from the installed client
+    if bauplan is importable, BAUPLAN_CLIENT_METHODS otherwise.
+    """
+    try:
+        import bauplan
+    except ImportError:
+        return BAUPLAN_CLIENT_METHODS
+    methods = {}
+    for name, method in inspect.getmembers(bauplan.Client, callable):
+        if name.startswith('_'):
+            continue
+        kwargs = _signature_kwargs(method)
+        methods[name] = None if kwargs is None else kwargs - {'self'}
+    return methods
+
+
+def bauplan_requirement() -> str:
+    """
+    The bauplan requirement for the sandbox: the version the Client methods are checked against.
+    """
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        return f"bauplan=={version('bauplan')}"
+    except PackageNotFoundError:
+        return f"bauplan=={BAUPLAN_VERSION}"
+
+
+def _tool_functions() -> dict:
+    # the public functions of the tools pre-installed in the sandbox, with their keyword arguments
+    import wap
+    return {
+        'wap': {
+            name: _signature_kwargs(obj) if callable(obj) else None
+            for name, obj in vars(wap).items()
+            if not name.startswith('_') and not inspect.ismodule(obj)
+        }
+    }
+
+
+def _is_main_guard(node) -> bool:
+    # if __name__ == "__main__": (without an else)
+    if not isinstance(node, ast.If) or node.orelse or not isinstance(node.test, ast.Compare):
+        return False
+    test = node.test
+    return (
+        isinstance(test.left, ast.Name) and test.left.id == '__name__'
+        and len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq)
+        and isinstance(test.comparators[0], ast.Constant) and test.comparators[0].value == '__main__'
+    )
+
+
+def _is_literal(node) -> bool:
+    # a constant, or a list / tuple / set / dict of constants
+    if node is None:
+        return False
+    try:
+        ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False
+    return True
+
+
+def _is_client_call(node) -> bool:
+    # bauplan.Client(...) or Client(...), whatever the arguments
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    return (isinstance(func, ast.Attribute) and func.attr == 'Client') or (isinstance(func, ast.Name) and func.id == 'Client')
+
+
+def _suggest(name: str, candidates) -> str:
+    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.6)
+    return f" Did you mean `{matches[0]}`?" if matches else ''
+
+
+class Preflight:
+    """
+    Check code before it is executed: see the module docstring.
+
+    Parameters:
+    - client_methods: The allowed bauplan.Client methods, as name -> accepted keyword arguments (or None):
+      the methods of the installed client by default (see bauplan_client_methods).
+    - preinstalled: Modules which can be imported without listing them in <packages>.
+    - require_single_try: Enforce the ONE try / except block shape of the system prompt.
+    """
+
+    def __init__(
+        self,
+        client_methods: dict = None,
+        preinstalled: set = None,
+        require_single_try: bool = True
+    ):
+        self.client_methods = bauplan_client_methods() if client_methods is None else client_methods
+        self.preinstalled = PREINSTALLED_MODULES if preinstalled is None else set(preinstalled)
+        self.require_single_try = require_single_try
+        self.tool_functions = _tool_functions()
+
+    def check(self, code: str, packages: list = None) -> list:
+        """
+        Return the PreflightIssues of the code (an empty list if it can run).
+        """
+        try:
+            tree = ast.parse(code)
+            compile(tree, '<agent code>', 'exec')
+        except SyntaxError as e:
+            return [PreflightIssue(e.lineno, 'syntax', f"SyntaxError: {e.msg}")]
+        issues = []
+        if self.require_single_try:
+            issues += self._check_shape(tree)
+        issues += self._check_imports(tree, packages)
+        issues += self._check_calls(tree)
+        return sorted(issues, key=lambda i: (i.line or 0, i.kind))
+
+    def _check_shape(self, tree: ast.Module) -> list:
+        # the body of an `if __name__ == "__main__":` guard runs at the top level too
+        statements = []
+        for node in tree.body:
+            statements += node.body if _is_main_guard(node) else [node]
+        functions = {
+            node.name: node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        }
+        # a function called at the top level, e.g. main(), may hold the block: what else it does is not checked
+        tries, callers = [], set()
+        for node in statements:
+            if isinstance(node, _TRY_NODES):
+                tries.append(node)
+            elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Name):
+                function = functions.get(node.value.func.id)
+                blocks = [n for n in function.body if isinstance(n, _TRY_NODES)] if function else []
+                if blocks:
+                    callers.add(node)
+                    tries += [n for n in blocks if n not in tries]
+        if not tries:
+            return [PreflightIssue(None, 'shape', "The code must be inside ONE try / except block, and it has none.")]
+        issues = []
+        if len(tries) > 1:
+            issues.append(PreflightIssue(
+                tries[1].lineno, 'shape', f"The code must be inside ONE try / except block, and it has {len(tries)}."
+            ))
+        for node in tries:
+            if not node.handlers:
+                issues.append(PreflightIssue(node.lineno, 'shape', "The try block has no except clause."))
+        allowed = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        for node in statements:
+            if node in tries or node in callers or isinstance(node, allowed):
+                continue
+            # docstrings and constants, e.g. BUCKET = 's3://...' or TABLES = ['fees', 'payments'], are fine
+            # outside of the block
+            if isinstance(node, (ast.Expr, ast.Assign, ast.AnnAssign)) and _is_literal(node.value):
+                continue
+            # and so is the value of the cell on the last line, e.g. `branch`
+            if node is statements[-1] and isinstance(node, ast.Expr) and isinstance(node.value, (ast.Name, ast.Attribute)):
+                continue
+            # and so is creating the client, e.g. client = bauplan.Client()
+            if isinstance(node, (ast.Assign, ast.AnnAssign)) and _is_client_call(node.value):
+                continue
+            issues.append(PreflightIssue(
+                node.lineno, 'shape', "This statement is outside of the try / except block: move it inside."
+            ))
+        return issues
+
+    def _check_imports(self, tree: ast.Module, packages: list) -> list:
+        available = set(self.preinstalled)
+        for requirement in normalize_packages(packages):
+            name = canonical_name(requirement)
+            available |= {name, name.replace('-', '_')} | PACKAGE_MODULES.get(name, set())
+        available |= {m for p in self.preinstalled for m in PACKAGE_MODULES.get(p, set())}
+        issues = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    issues.append(PreflightIssue(node.lineno, 'import', "Relative imports do not work in the sandbox."))
+                    continue
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                top = module.split('.')[0]
+                if top in sys.stdlib_module_names or top in available or top.lower() in available:
+                    continue
+                issues.append(PreflightIssue(
+                    node.lineno, 'import',
+                    f"`{module}` is imported but `{top}` is not in <packages>: add it there, or do not use it."
+                ))
+        return issues
+
+    def _check_calls(self, tree: ast.Module) -> list:
+        # the names bound to the bauplan module, to bauplan.Client, to client instances and to the tools
+        bauplan_names, client_classes, clients, tools = set(), set(), set(), {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    if alias.name == 'bauplan':
+                        bauplan_names.add(alias.asname or 'bauplan')
+                    elif alias.name in self.tool_functions:
+                        tools[alias.asname or alias.name] = alias.name
+            elif isinstance(node, ast.ImportFrom) and node.module == 'bauplan':
+                client_classes |= {alias.asname or alias.name for alias in node.names if alias.name == 'Client'}
+
+        def is_client_constructor(call) -> bool:
+            func = call.func
+            if isinstance(func, ast.Attribute) and func.attr == 'Client':
+                return isinstance(func.value, ast.Name) and func.value.id in bauplan_names
+            return isinstance(func, ast.Name) and func.id in client_classes
+
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Assign, ast.AnnAssign)) and isinstance(node.value, ast.Call):
+                if is_client_constructor(node.value):
+                    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                    clients |= {t.id for t in targets if isinstance(t, ast.Name)}
+
+        issues = []
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Attribute):
+                continue
+            owner = node.value
+            if isinstance(owner, ast.Name) and owner.id in clients:
+                allowed, what = self.client_methods, 'bauplan.Client'
+            elif isinstance(owner, ast.Call) and is_client_constructor(owner):
+                allowed, what = self.client_methods, 'bauplan.Client'
+            elif isinstance(owner, ast.Name) and owner.id in tools:
+                allowed, what = self.tool_functions[tools[owner.id]], f"the `{tools[owner.id]}` tool"
+            else:
+                continue
+            if node.attr not in allowed:
+                issues.append(PreflightIssue(
+                    node.lineno, 'api',
+                    f"{what} has no `{node.attr}`: use one of its documented methods.{_suggest(node.attr, allowed)}"
+                ))
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+                continue
+            owner, method = node.func.value, node.func.attr
+            if (isinstance(owner, ast.Name) and owner.id in clients) or (isinstance(owner, ast.Call) and is_client_constructor(owner)):
+                accepted = self.client_methods.get(method)
+                what = f"Client.{method}"
+            elif isinstance(owner, ast.Name) and owner.id in tools:
+                accepted = self.tool_functions[tools[owner.id]].get(method)
+                what = f"{tools[owner.id]}.{method}"
+            else:
+                continue
+            if accepted is None:
+                continue
+            for keyword in node.keywords:
+                if keyword.arg is not None and keyword.arg not in accepted:
+                    issues.append(PreflightIssue(
+                        node.lineno, 'api',
+                        f"{what}() has no argument `{keyword.arg}`.{_suggest(keyword.arg, accepted)}"
+                    ))
+        return issues
+
+
+def format_issues(issues: list) -> str:
+    """
+    The feedback for the model: one line per issue.
+    """
+    lines = [f"- line {i.line}: {i.message}" if i.line else f"- {i.message}" for i in issues]
+    return (
+        "Your code was NOT executed: the pre-flight checks found these problems.\n"
+        + "\n".join(lines)
+        + "\nFix all of them, follow the CRITICAL FORMAT RULES and the API documentation, and try again."
+    )
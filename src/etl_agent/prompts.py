@@ -4,12 +4,13 @@ Collect here the basic prompts for the ETL agent.
 
 """
 
-# get the Bauplan API usage documentation from the relevant file
 import os
-with open(os.path.join(os.path.dirname(__file__), 'llm_etl.txt'), 'r') as f:
-    bauplan_api_usage = f.read().strip()
+from functools import lru_cache
+from wap import WAP_TOOL_USAGE
 
-SYSTEM_PROMPT = f"""You are a top tier data agent in charge of using Bauplan Python SDK to load raw files from S3 into the Bauplan lakehouse. You will 
+
+# the system prompt, without the Bauplan API usage documentation: see system_prompt()
+_SYSTEM_PROMPT_TEMPLATE = """You are a top tier data agent in charge of using Bauplan Python SDK to load raw files from S3 into the Bauplan lakehouse. You will 
 produce working Python code that performs the ETL process safely, using Bauplan's Python SDK, based on the user request.
 
 CRITICAL FORMAT RULES:
@@ -53,21 +54,72 @@ REMEMBER: include both <reasoning> and <code> sections in every response unless
 
 BAUPLAN API USAGE: 
 {bauplan_api_usage}
+
+WAP TOOL:
+{WAP_TOOL_USAGE}
 """
 
+
+@lru_cache(maxsize=1)
+def system_prompt() -> str:
+    """
+    The system prompt, with the Bauplan API usage documentation read from llm_etl.txt the first time
+    it is needed, instead of when the module is imported.
+    """
+    with open(os.path.join(os.path.dirname(__file__), 'llm_etl.txt'), 'r') as f:
+        bauplan_api_usage = f.read().strip()
+    return _SYSTEM_PROMPT_TEMPLATE.format(bauplan_api_usage=bauplan_api_usage, WAP_TOOL_USAGE=WAP_TOOL_USAGE)
+
+
+def __getattr__(name: str):
+    # `from prompts import SYSTEM_PROMPT` still works, and reads the documentation at that point
+    if name == 'SYSTEM_PROMPT':
+        return system_prompt()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 USER_PROMPT_TEMPLATE = (
     "You will be performing an ETL process on the data stored in a publicly readable S3 bucket: {s3_raw_bucket}."
     " No credentials are needed to list files in the bucket and you can assume Bauplan can read from it. The BAUPLAN API key is provided in the environment variable BAUPLAN_API_KEY."
     " You can use the Bauplan client to retrieve the username you need to create a new branch."
     " You are tasked to run a Write-Audit-Publish (WAP) process on raw data, leveraging branches to sandbox the import and run data quality checks before publishing to the main branch."
     " In particular, you will:"
-    " \n1. List all the parquet files in the S3 bucket."
+    " \n1. List all the parquet files in the S3 bucket. Files under a folder (e.g. payments/) are the parts of ONE table, named after the folder:"
+    " import them together with the * pattern (e.g. s3://{s3_raw_bucket}/payments/*), not one by one."
     " \n2. Create a new temporary branch for the ETL process, using the timestamp to randomize the branch name. "
     " \n3. For each file, create a table (replace if it exists) in the temporary branch with the same name as the file using Bauplan APIs, and import the data from the S3 bucket using Bauplan APIs."
     " \n4. Remember to run a basic data quality check on each table after importing. In particular, use Bauplan APIs to check for the existence of an ID column in the schema."
     " If it exists, add a simple SQL query to check that the ID column has all unique values." 
     " \n5. If all the data quality checks pass, merge the branch into main and return the temporary branch name." 
+    "\n The `wap` tool described in the system prompt does steps 2 to 5 in ONE call (wap.run_wap with merge=True): use it, and return result.branch if result.ok."
     "\n Try to be concise: do not add comments, include all commands inside ONE try and except block, use print statements sparingly only to communicate progress. "
     " If an error occurs, catch it and print a clear console message. "
     " Make sure the script returns the temporary branch name that was used in case of success, or None in case of any failure."
-)
\ No newline at end of file
+    "{raw_data_catalog}"
+)
+# the summary of the raw data, read upfront from the parquet footers (see catalog.py), which goes in
+# the {raw_data_catalog} slot of the user prompts: empty if there is no catalog
+RAW_DATA_CATALOG_TEMPLATE = (
+    "\n\nRAW DATA CATALOG: the bucket has already been inspected for you (from the parquet metadata), so you do not need to"
+    " list it, read the files or guess the schemas. Use these tables, import URIs and ID columns directly:\n{catalog}"
+)
+# when several agents run at the same time (see fanout.py), each one works on its own data branch,
+# assigned upfront, and never merges: the runner verifies the candidates and merges the winner
+FANOUT_USER_PROMPT_TEMPLATE = (
+    "You will be performing an ETL process on the data stored in a publicly readable S3 bucket: {s3_raw_bucket}."
+    " No credentials are needed to list files in the bucket and you can assume Bauplan can read from it. The BAUPLAN API key is provided in the environment variable BAUPLAN_API_KEY."
+    " You are tasked to run the Write and Audit steps of a Write-Audit-Publish (WAP) process on raw data, leveraging a branch to sandbox the import and run data quality checks."
+    " In particular, you will:"
+    " \n1. List all the parquet files in the S3 bucket. Files under a folder (e.g. payments/) are the parts of ONE table, named after the folder:"
+    " import them together with the * pattern (e.g. s3://{s3_raw_bucket}/payments/*), not one by one."
+    " \n2. Create a new branch named exactly {branch_name} from main (if it already exists, delete it and create it again)."
+    " \n3. For each file, create a table (replace if it exists) in that branch with the same name as the file using Bauplan APIs, and import the data from the S3 bucket using Bauplan APIs."
+    " \n4. Remember to run a basic data quality check on each table after importing. In particular, use Bauplan APIs to check for the existence of an ID column in the schema."
+    " If it exists, add a simple SQL query to check that the ID column has all unique values."
+    " \n5. Do NOT merge the branch into main: if all the data quality checks pass, return the branch name."
+    "\n The `wap` tool described in the system prompt does steps 2 to 5 in ONE call: use it with branch='{branch_name}', replace=True and merge=False, and return the branch name if result.ok."
+    "\n Try to be concise: do not add comments, include all commands inside ONE try and except block, use print statements sparingly only to communicate progress. "
+    " If an error occurs, catch it and print a clear console message. "
+    " Make sure the script returns the branch name in case of success, or None in case of any failure."
+    "{raw_data_catalog}"
+)
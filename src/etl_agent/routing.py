@@ -0,0 +1,222 @@
+"""
+
+Route every turn of the ReAct loop to a model: most turns (a first draft, a small repair after a short
+traceback, the final answer) do not need the biggest model, so they go to a fast, cheap one, and the run
+escalates to a stronger one only when the cheap one is not making progress:
+
+* after `escalate_after` consecutive failed turns (malformed response, code rejected by the pre-flight
+  checks, or failed execution) on the same model;
+* right away, on the error classes which small models rarely repair (e.g. a truncated response, errors
+  from the lakehouse), or after a long traceback.
+
+Escalation is sticky: once on a stronger model, the run stays there. Transient errors (rate limits,
+timeouts) are the provider's fault, not the model's, and are not counted.
+
+Every decision is logged with the outcome of its turn, as one JSON line, so that the policy can be tuned
+from the outcomes of real runs:
+
+    uv run routing.py --summary routing.jsonl
+
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from tracing import get_tracer
+
+
+# a model the router can pick, from the cheapest to the strongest
+ModelTier = namedtuple('ModelTier', ['name', 'model_name', 'temperature', 'max_tokens'], defaults=(0.7, 4000))
+# what happened in a past turn of the run: tier is the name of the ModelTier used
+TurnOutcome = namedtuple('TurnOutcome', ['tier', 'outcome', 'error'])
+RoutingDecision = namedtuple('RoutingDecision', ['tier', 'model_name', 'temperature', 'max_tokens', 'reason'])
+# the outcomes of the loop which count as a failure of the model
+FAILED_OUTCOMES = ('malformed_response', 'preflight_rejected', 'execution_error')
+# errors which are worth a stronger model at once
+ESCALATE_ON = (
+    'TruncatedResponseError', 'BauplanError', 'BauplanQueryError', 'InvalidPlanError', 'BinderException',
+    'CatalogException', 'ArrowInvalid', 'ArrowTypeError', 'RecursionError'
+)
+_ERROR_CLASS = re.compile(r"\b([A-Z]\w*(?:Error|Exception|Invalid))\b")
+
+
+def error_class(error: str) -> str:
+    """
+    The name of the (last) exception class in an error text, e.g. KeyError in a traceback, or None.
+    """
+    matches = _ERROR_CLASS.findall(error or '')
+    return matches[-1] if matches else None
+
+
+class ModelRouter:
+    """
+    Pick the model of every turn from the outcomes of the previous turns of the run: see the module
+    docstring. The router keeps no state about the runs, so one router can be shared by many of them.
+
+    Parameters:
+    - tiers: The ModelTiers, from the cheapest to the strongest.
+    - escalate_after: Consecutive failed turns on a tier after which the run goes to the next one.
+    - escalate_on: Error classes after which the run goes to the next tier at once.
+    - long_traceback_lines: Tracebacks longer than this are not a small repair.
+    - log_path: A JSONL file to append every decision to, with the outcome of its turn.
+    """
+
+    def __init__(
+        self,
+        tiers: list,
+        escalate_after: int = 2,
+        escalate_on: tuple = ESCALATE_ON,
+        long_traceback_lines: int = 30,
+        log_path: str = None
+    ):
+        assert tiers, "The router needs at least one model"
+        self.tiers = list(tiers)
+        self.escalate_after = escalate_after
+        self.escalate_on = set(escalate_on)
+        self.long_traceback_lines = long_traceback_lines
+        self.log_path = log_path
+        self._lock = threading.Lock()
+
+    @classmethod
+    def single(cls, model_name: str, temperature: float, max_tokens: int, log_path: str = None) -> 'ModelRouter':
+        """
+        A router always picking the same model.
+        """
+        return cls([ModelTier('default', model_name, temperature, max_tokens)], log_path=log_path)
+
+    def _tier_index(self, name: str) -> int:
+        for i, tier in enumerate(self.tiers):
+            if tier.name == name:
+                return i
+        return 0
+
+    def _decision(self, index: int, reason: str) -> RoutingDecision:
+        tier = self.tiers[index]
+        return RoutingDecision(tier.name, tier.model_name, tier.temperature, tier.max_tokens, reason)
+
+    def route(self, turns: list) -> RoutingDecision:
+        """
+        The model for the next turn, given the TurnOutcomes of the run so far.
+        """
+        turns = [t for t in turns if t.outcome != 'transient_error']
+        if not turns:
+            return self._decision(0, 'first_draft')
+        # sticky: the strongest tier used so far
+        current = max(self._tier_index(t.tier) for t in turns)
+        last = turns[-1]
+        if last.outcome not in FAILED_OUTCOMES:
+            return self._decision(current, 'progress')
+        failures = 0
+        for turn in reversed(turns):
+            if turn.outcome not in FAILED_OUTCOMES or self._tier_index(turn.tier) != current:
+                break
+            failures += 1
+        cls = error_class(last.error)
+        if cls in self.escalate_on:
+            reason = f"error_class:{cls}"
+        elif failures >= self.escalate_after:
+            reason = f"failures:{failures}"
+        elif last.outcome == 'execution_error' and (last.error or '').count('\n') >= self.long_traceback_lines:
+            reason = 'long_traceback'
+        else:
+            return self._decision(current, 'small_repair')
+        if current == len(self.tiers) - 1:
+            return self._decision(current, f"top_tier:{reason}")
+        return self._decision(current + 1, f"escalate:{reason}")
+
+    def record(
+        self,
+        run_id: str,
+        iteration: int,
+        decision: RoutingDecision,
+        outcome: str,
+        error: str = None,
+        seconds: float = None,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0
+    ):
+        """
+        Count the decision, and log it with the outcome of its turn (if the router has a log).
+        """
+        get_tracer().counter('agent_routing_decisions_total', 'Routing decisions, by tier, reason and outcome').inc(
+            tier=decision.tier, reason=decision.reason.split(':')[0], outcome=outcome
+        )
+        if not self.log_path:
+            return
+        line = json.dumps({
+            'timestamp': time.time(),
+            'run_id': run_id,
+            'iteration': iteration,
+            'tier': decision.tier,
+            'model_name': decision.model_name,
+            'reason': decision.reason,
+            'outcome': outcome,
+            'error_class': error_class(error),
+            'seconds': seconds,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens
+        })
+        with self._lock:
+            if os.path.dirname(self.log_path):
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            with open(self.log_path, 'a') as f:
+                f.write(line + "\n")
+
+
+def summarize_log(log_path: str) -> dict:
+    """
+    Aggregate a routing log: for every tier and reason, the turns, their success rate (the turn executed
+    or gave the final answer), and the mean seconds and tokens; for the runs which succeeded, the median
+    seconds and tokens per run, and the share of their turns on each tier.
+    """
+    with open(log_path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    by_reason, runs = {}, {}
+    for row in rows:
+        reason = row['reason'].split(':')[0]
+        stats = by_reason.setdefault((row['tier'], reason), {'turns': 0, 'successes': 0, 'seconds': 0.0, 'tokens': 0})
+        stats['turns'] += 1
+        stats['successes'] += row['outcome'] in ('executed', 'done')
+        stats['seconds'] += row['seconds'] or 0.0
+        stats['tokens'] += row['prompt_tokens'] + row['completion_tokens']
+        runs.setdefault(row['run_id'], []).append(row)
+    successful = [turns for turns in runs.values() if any(t['outcome'] == 'done' for t in turns)]
+
+    def median(values: list):
+        ordered = sorted(values)
+        return ordered[len(ordered) // 2] if ordered else None
+
+    tier_turns = {}
+    for turns in successful:
+        for t in turns:
+            tier_turns[t['tier']] = tier_turns.get(t['tier'], 0) + 1
+    total_turns = sum(tier_turns.values())
+    return {
+        'by_tier_and_reason': {
+            f"{tier}/{reason}": {
+                'turns': s['turns'],
+                'success_rate': s['successes'] / s['turns'],
+                'mean_seconds': s['seconds'] / s['turns'],
+                'mean_tokens': s['tokens'] / s['turns']
+            }
+            for (tier, reason), s in sorted(by_reason.items())
+        },
+        'runs': len(runs),
+        'successful_runs': len(successful),
+        'median_seconds_per_successful_run': median([sum(t['seconds'] or 0.0 for t in turns) for turns in successful]),
+        'median_tokens_per_successful_run': median([
+            sum(t['prompt_tokens'] + t['completion_tokens'] for t in turns) for turns in successful
+        ]),
+        'successful_turns_by_tier': {tier: n / total_turns for tier, n in sorted(tier_turns.items())}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a routing log")
+    parser.add_argument('--summary', metavar='LOG', required=True, help="the JSONL routing log to summarize")
+    args = parser.parse_args()
+    print(json.dumps(summarize_log(args.summary), indent=2))
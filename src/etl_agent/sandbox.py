@@ -0,0 +1,461 @@
+"""
+
+Sandbox sessions and a warm pool for running the agent's code.
+
+Booting a sandbox, installing packages and importing bauplan is most of the wall-clock time of an
+iteration outside the LLM call: instead of paying it on every retry, we keep a small pool of warm
+sessions ready and let a single run of the agent keep the same session (and its state) across
+all its iterations.
+
+Two session types are available: E2BSession, backed by an E2B Code Interpreter sandbox, and
+LocalSession, backed by a local Python subprocess, which is handy for offline tests and benchmarks.
+
+"""
+
+import contextvars
+import json
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from utils import CodeExecutor, ExecutorResponse
+from dependencies import DependencySet, WheelCache, normalize_packages, package_set_key, pip_install_command
+from tracing import get_tracer
+
+
+class SandboxSession(ABC):
+    """
+    A live environment in which code runs: state (variables, imports, installed packages)
+    persists across calls to run_code until the session is closed.
+    """
+
+    @abstractmethod
+    def install(self, python_packages: list) -> str:
+        # return None if the packages are installed, pip's error otherwise (for the model to fix them)
+        pass
+
+    @abstractmethod
+    def run_code(self, code: str) -> ExecutorResponse:
+        pass
+
+    @abstractmethod
+    def is_healthy(self) -> bool:
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+def _install_error(packages: list, stderr: str) -> str:
+    # what the model sees when its <packages> cannot be installed: the tail of pip's output has the reason
+    return f"Could not install {', '.join(packages)}: fix the <packages> section.\n{(stderr or '').strip()[-2000:]}"
+
+
+class E2BSession(SandboxSession):
+    """
+    A session backed by an E2B Code Interpreter sandbox: the sandbox stays up until close() is called
+    (or the E2B timeout, in seconds, expires).
+
+    If you build a custom E2B template with your usual packages pre-installed (a pre-baked environment),
+    pass its name as `template`: those packages are then detected as installed and never reinstalled.
+    """
+
+    def __init__(self, api_key: str, envs: dict = None, timeout: int = 600, template: str = None):
+        from e2b_code_interpreter import Sandbox
+        if template:
+            self.sbx = Sandbox(template=template, api_key=api_key, envs=envs, timeout=timeout)
+        else:
+            self.sbx = Sandbox(api_key=api_key, envs=envs, timeout=timeout)
+        self.dependencies = DependencySet()
+
+    def install(self, python_packages: list) -> str:
+        from e2b_code_interpreter import CommandExitException
+        if self.dependencies.installed is None:
+            freeze = self.sbx.commands.run("pip list --format=freeze --disable-pip-version-check")
+            self.dependencies.seed(freeze.stdout)
+        pending = self.dependencies.pending(python_packages)
+        if not pending:
+            return None
+        # one pip call for the entire set, so that pip resolves everything together
+        try:
+            self.sbx.commands.run(shlex.join(pip_install_command(pending)))
+        except CommandExitException as e:
+            # pip failed (e.g. a package which does not exist): not a sandbox problem, nothing to retry
+            return _install_error(pending, e.stderr)
+        self.dependencies.mark_installed(pending)
+        return None
+
+    def run_code(self, code: str) -> ExecutorResponse:
+        exec = self.sbx.run_code(code,
+            on_stderr=lambda stderr: print("[Code Interpreter]", stderr),
+            on_stdout=lambda stdout: print("[Code Interpreter]", stdout)
+        )
+        return ExecutorResponse(
+            result=exec.results,
+            stdout=exec.logs.stdout,
+            stderr=exec.logs.stderr,
+            error=exec.error
+        )
+
+    def is_healthy(self) -> bool:
+        try:
+            return self.sbx.is_running()
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.sbx.kill()
+        except Exception as e:
+            print(f"Could not kill the sandbox: {e}")
+
+
+# the program run by LocalSession in a child interpreter: it reads one JSON request per line
+# and answers with one JSON line, keeping the same globals across requests. The protocol uses
+# a duplicate of the original stdout, so that stray writes to fd 1 do not corrupt it.
+_LOCAL_WORKER = r'''
+import ast, contextlib, io, json, os, sys, traceback
+proto = os.fdopen(os.dup(1), "w")
+os.dup2(2, 1)
+scope = {"__name__": "__main__"}
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["op"] == "ping":
+        proto.write(json.dumps({"ok": True}) + "\n")
+        proto.flush()
+        continue
+    out, err = io.StringIO(), io.StringIO()
+    result, error = None, None
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            tree = ast.parse(request["code"])
+            last = tree.body.pop() if tree.body and isinstance(tree.body[-1], ast.Expr) else None
+            exec(compile(tree, "<agent>", "exec"), scope)
+            if last is not None:
+                value = eval(compile(ast.Expression(last.value), "<agent>", "eval"), scope)
+                result = None if value is None else repr(value)
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+    proto.write(json.dumps({"result": result, "stdout": out.getvalue(), "stderr": err.getvalue(), "error": error}) + "\n")
+    proto.flush()
+'''
+
+
+class LocalSession(SandboxSession):
+    """
+    A session backed by a persistent Python subprocess on this machine. There is NO isolation
+    here: use it for offline tests and benchmarks, not to run untrusted code.
+    """
+
+    def __init__(self, envs: dict = None, python_executable: str = None, wheel_cache: WheelCache = None):
+        self.python_executable = python_executable or sys.executable
+        self.wheel_cache = wheel_cache
+        self.dependencies = DependencySet()
+        self.proc = subprocess.Popen(
+            [self.python_executable, '-u', '-c', _LOCAL_WORKER],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, **(envs or {})},
+            text=True,
+            bufsize=1
+        )
+        self._lock = threading.Lock()
+
+    def _request(self, payload: dict) -> dict:
+        with self._lock:
+            self.proc.stdin.write(json.dumps(payload) + "\n")
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("Local sandbox process exited unexpectedly")
+        return json.loads(line)
+
+    def install(self, python_packages: list) -> str:
+        if self.dependencies.installed is None:
+            freeze = subprocess.run(
+                [self.python_executable, '-m', 'pip', 'list', '--format=freeze', '--disable-pip-version-check'],
+                capture_output=True,
+                text=True
+            )
+            self.dependencies.seed(freeze.stdout)
+        pending = self.dependencies.pending(python_packages)
+        if not pending:
+            return None
+        wheels = self.wheel_cache.ensure(pending) if self.wheel_cache else None
+        install = subprocess.run(
+            pip_install_command(pending, python_executable=self.python_executable, find_links=wheels),
+            capture_output=True,
+            text=True
+        )
+        if install.returncode != 0:
+            return _install_error(pending, install.stderr)
+        self.dependencies.mark_installed(pending)
+        return None
+
+    def run_code(self, code: str) -> ExecutorResponse:
+        response = self._request({"op": "run", "code": code})
+        return ExecutorResponse(
+            result=[response['result']] if response['result'] is not None else [],
+            stdout=[response['stdout']] if response['stdout'] else [],
+            stderr=[response['stderr']] if response['stderr'] else [],
+            error=response['error']
+        )
+
+    def is_healthy(self) -> bool:
+        if self.proc.poll() is not None:
+            return False
+        try:
+            return self._request({"op": "ping"}).get('ok', False)
+        except Exception:
+            return False
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+class SandboxPool:
+    """
+    Keep up to `size` warm sessions ready: sessions are created in background threads by
+    `session_factory`, optionally pre-installing `warm_packages` and running `warmup_code`
+    (e.g. "import bauplan"), so that acquiring one is (almost) free.
+
+    Sessions are health-checked when they are handed out, and the pool refills itself in
+    the background every time a session is taken, unless `refill` is False: a pool built for
+    a single run (see e2b_pooled_executor) would only boot sandboxes nobody uses.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        size: int = 1,
+        warm_packages: list = None,
+        warmup_code: str = None,
+        refill: bool = True
+    ):
+        self.session_factory = session_factory
+        self.size = size
+        self.warm_packages = warm_packages
+        self.warmup_code = warmup_code
+        self.refill = refill
+        self._idle = queue.Queue()
+        self._warming = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = ThreadPoolExecutor(max_workers=max(size, 1), thread_name_prefix='sandbox-warmup')
+        self.fill()
+
+    def _new_session(self) -> SandboxSession:
+        session = self.session_factory()
+        try:
+            if self.warm_packages:
+                install_error = session.install(self.warm_packages)
+                if install_error is not None:
+                    # a session without its warm packages is not one the pool should hand out
+                    raise RuntimeError(install_error)
+            if self.warmup_code:
+                session.run_code(self.warmup_code)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    def _warm_one(self):
+        try:
+            session = self._new_session()
+        except Exception as e:
+            print(f"Could not warm up a sandbox: {e}")
+            session = None
+        with self._lock:
+            self._warming -= 1
+            closed = self._closed
+        if session is None:
+            return
+        if closed:
+            session.close()
+        else:
+            self._idle.put(session)
+
+    def fill(self):
+        """
+        Start warming sessions in the background until idle + warming sessions reach the pool size.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            missing = self.size - self._idle.qsize() - self._warming
+            self._warming += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            self._workers.submit(self._warm_one)
+
+    def acquire(self) -> SandboxSession:
+        """
+        Return a healthy session, waiting for a warm one if one is on its way, and creating
+        one in the calling thread otherwise.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Sandbox pool is closed")
+            try:
+                session = self._idle.get(timeout=0.05)
+            except queue.Empty:
+                with self._lock:
+                    warming = self._warming
+                if warming > 0:
+                    continue
+                session = self._new_session()
+            if session.is_healthy():
+                if self.refill:
+                    self.fill()
+                return session
+            print("Discarding an unhealthy sandbox from the pool")
+            session.close()
+
+    def release(self, session: SandboxSession):
+        """
+        Give back a session whose state can be shared with the next user: sessions holding
+        the state of a finished run should be closed instead.
+        """
+        with self._lock:
+            closed = self._closed
+        if not closed and session.is_healthy() and self._idle.qsize() < self.size:
+            self._idle.put(session)
+        else:
+            session.close()
+
+    def close(self):
+        # do not wait for the sessions still warming up: _warm_one closes them when they are ready
+        with self._lock:
+            self._closed = True
+        self._workers.shutdown(wait=False, cancel_futures=True)
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+class PooledCodeExecutor(CodeExecutor):
+    """
+    A CodeExecutor that takes a warm session from a pool on first use, and then keeps it for
+    all the following calls: variables, imports and installed packages survive across the
+    iterations of a run. The session is checked before every call and replaced if it died.
+    If the packages cannot be installed, the code is not run, and pip's error is returned instead.
+
+    Call close() at the end of the run to discard the session: its state belongs to this run.
+    """
+
+    def __init__(self, pool: SandboxPool, owns_pool: bool = False):
+        self.pool = pool
+        self.owns_pool = owns_pool
+        self.session = None
+        self._lock = threading.Lock()
+        self._preparing = None
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sandbox-prepare')
+
+    def _ready_session(self, python_packages: list = None) -> tuple:
+        # (session, None) or (session, pip's error)
+        with self._lock:
+            if self.session is not None and not self.session.is_healthy():
+                print("⚠️ Sandbox session is not healthy anymore, switching to a fresh one (state is lost)")
+                self.session.close()
+                self.session = None
+            tracer = get_tracer()
+            if self.session is None:
+                with tracer.span('sandbox.acquire'):
+                    self.session = self.pool.acquire()
+            install_error = None
+            if python_packages:
+                with tracer.span('sandbox.install', packages=','.join(python_packages)) as span:
+                    install_error = self.session.install(python_packages)
+                    span.set_attribute('failed', install_error is not None)
+            return self.session, install_error
+
+    def prepare(self, python_packages: list = None):
+        """
+        Acquire the session and install the packages in the background: run_code will wait for it.
+        """
+        # run in a copy of the current context, so that the spans nest under the caller's
+        context = contextvars.copy_context()
+        self._preparing = self._background.submit(context.run, self._ready_session, python_packages)
+
+    def run_code(self, code: str, python_packages: list = None) -> ExecutorResponse:
+        install_error = None
+        if self._preparing is not None:
+            try:
+                # the packages prepared are the <packages> of this same response: no need to run pip twice
+                _, install_error = self._preparing.result()
+            except Exception as e:
+                print(f"Could not prepare the sandbox in the background, retrying now: {e}")
+            self._preparing = None
+        if install_error is None:
+            session, install_error = self._ready_session(python_packages)
+        if install_error is not None:
+            return ExecutorResponse(result=[], stdout=[], stderr=[], error=install_error)
+        with get_tracer().span('sandbox.execute', code_bytes=len(code)):
+            return session.run_code(code)
+
+    def close(self):
+        self._background.shutdown(wait=True)
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.owns_pool:
+            self.pool.close()
+
+
+def e2b_pooled_executor(
+    api_key: str,
+    envs: dict = None,
+    pool_size: int = 1,
+    warm_packages: list = None,
+    warmup_code: str = None,
+    template: str = None
+) -> PooledCodeExecutor:
+    """
+    Build a PooledCodeExecutor owning its own pool of E2B sandboxes: the sandbox starts warming up
+    right away, and the pool is not refilled once the executor has taken it. To reuse sandboxes
+    across runs, share one long-lived SandboxPool between PooledCodeExecutors instead (see batch.py).
+
+    A "{key}" in `template` is replaced by the package_set_key of the warm packages, e.g. "etl-agent-{key}",
+    so that each package set gets its own pre-built template, and a new set never boots a stale one.
+    """
+    if template and '{key}' in template:
+        template = template.replace('{key}', package_set_key(normalize_packages(warm_packages)))
+    pool = SandboxPool(
+        session_factory=lambda: E2BSession(api_key=api_key, envs=envs, template=template),
+        size=pool_size,
+        warm_packages=warm_packages,
+        warmup_code=warmup_code,
+        refill=False
+    )
+    return PooledCodeExecutor(pool, owns_pool=True)
+
+
+if __name__ == "__main__":
+    # quick offline benchmark: a fresh local session per iteration (what the agent loop used to
+    # do with E2B) versus one pooled session reused across iterations
+    import time
+    iterations = 5
+    code = "import json, decimal, email.parser, http.client\nx = sum(range(1000))\nx"
+    start = time.perf_counter()
+    for _ in range(iterations):
+        session = LocalSession()
+        session.run_code(code)
+        session.close()
+    cold = time.perf_counter() - start
+    pool = SandboxPool(session_factory=LocalSession, size=1, warmup_code="import json")
+    executor = PooledCodeExecutor(pool, owns_pool=True)
+    executor.run_code("pass")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        executor.run_code(code)
+    warm = time.perf_counter() - start
+    executor.close()
+    print(f"Fresh session per iteration: {cold / iterations * 1000:.1f} ms/iteration")
+    print(f"Pooled persistent session:   {warm / iterations * 1000:.1f} ms/iteration")
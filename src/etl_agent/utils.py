@@ -6,12 +6,127 @@ Utility functions for the agent loop.
 import re
 from abc import ABC, abstractmethod
 from collections import namedtuple
-from e2b_code_interpreter import Sandbox
 
 # structure to hold parsed response components
 ParsedResponse = namedtuple('ParsedResponse', ['done', 'packages', 'reasoning', 'code'])
 
 
+class ResponseFormatError(ValueError):
+    """
+    The LLM response does not follow the expected tag format: the loop sends the error back
+    to the model and asks for a well-formed response, instead of giving up.
+    """
+    pass
+
+
+class TruncatedResponseError(ResponseFormatError):
+    """
+    The LLM response was cut by the max_tokens limit before the closing tag.
+    """
+    pass
+
+
+# the tags we look for in the responses, and the ones after which the response is complete
+RESPONSE_TAGS = ('reasoning', 'packages', 'code', 'done')
+FINAL_TAGS = ('code', 'done')
+_TAG_RE = re.compile(r"<(/?)(reasoning|packages|code|done)>")
+_TAG_LITERALS = [f"<{c}{t}>" for t in RESPONSE_TAGS for c in ('', '/')]
+
+
+class IncrementalResponseParser:
+    """
+    Single pass, incremental parser for the tagged LLM responses: feed it the text as it streams,
+    and it reports each section as soon as its closing tag arrives (through `on_section(tag, content)`),
+    and whether the response is complete (after </code> or </done>), so that the stream can be cut there.
+
+    Every character is scanned once: we only look at '<', and wait for more text when a tag might be
+    split across two chunks.
+    """
+
+    def __init__(self, on_section=None):
+        self.on_section = on_section
+        self.text = ''
+        self.sections = {}
+        self.finished = False
+        self._pos = 0
+        self._open = None  # (tag, start of its content)
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Add a chunk of text, and return True if the response is complete.
+        """
+        if self.finished or not chunk:
+            return self.finished
+        self.text += chunk
+        text = self.text
+        while not self.finished:
+            lt = text.find('<', self._pos)
+            if lt == -1:
+                self._pos = len(text)
+                break
+            match = _TAG_RE.match(text, lt)
+            if match is None:
+                tail = text[lt:lt + 12]
+                if len(tail) < 12 and any(t.startswith(tail) for t in _TAG_LITERALS):
+                    # possibly a tag split across chunks: wait for more text
+                    self._pos = lt
+                    break
+                self._pos = lt + 1
+                continue
+            closing, tag = match.group(1) == '/', match.group(2)
+            if self._open is None and not closing:
+                self._open = (tag, match.end())
+                if tag == 'done':
+                    self.sections['done'] = None
+            elif self._open is not None and closing and tag == self._open[0]:
+                self._close_section(text[self._open[1]:lt])
+            self._pos = match.end()
+        return self.finished
+
+    def _close_section(self, content: str):
+        tag = self._open[0]
+        self._open = None
+        self.sections[tag] = content.strip()
+        if self.on_section is not None:
+            self.on_section(tag, self.sections[tag])
+        if tag in FINAL_TAGS:
+            self.finished = True
+
+    def close(self, stopped_by_sequence: bool = False, truncated: bool = False) -> ParsedResponse:
+        """
+        Signal the end of the stream and return the parsed response. If the provider confirmed that a stop
+        sequence cut the stream (it does not include it in the text), the open </code> or </done> is implied:
+        otherwise, code which was never closed makes the response malformed, as it may be incomplete.
+
+        Raise TruncatedResponseError if the response was cut by the token limit, ResponseFormatError
+        if it is not valid.
+        """
+        if self._open is not None and self._open[0] in FINAL_TAGS and stopped_by_sequence:
+            tag = self._open[0]
+            self._close_section(self.text[self._open[1]:])
+            self.text += f"</{tag}>"
+        done = 'done' in self.sections
+        reasoning, code = self.sections.get('reasoning'), self.sections.get('code')
+        if not done and (reasoning is None or code is None):
+            if truncated:
+                raise TruncatedResponseError(
+                    "The response was truncated by the token limit before the closing tag: "
+                    "please write shorter code."
+                )
+            if self._open is not None and self._open[0] == 'code':
+                # code which may be incomplete is never executed
+                raise ResponseFormatError("The <code> section was never closed: end it with </code>")
+            missing = [t for t in ('reasoning', 'code') if self.sections.get(t) is None]
+            raise ResponseFormatError(f"Response was not valid, missing the <{'>, <'.join(missing)}> section(s)")
+        packages = self.sections.get('packages')
+        return ParsedResponse(
+            done=done,
+            packages=packages.split(',') if packages is not None else None,
+            reasoning=reasoning,
+            code=code
+        )
+
+
 def parse_response(response_text: str) -> ParsedResponse:
     """
     Parse the LLM response and extract reasoning, code, or answer sections: thanks Fede!
@@ -22,36 +137,11 @@ def parse_response(response_text: str) -> ParsedResponse:
     - reasoning: The reasoning section if present
     - code: The code section if present
     
-    If the response does not conform to the expected format, we raise an error.
+    If the response does not conform to the expected format, we raise a ResponseFormatError.
     """
-    
-    packages = None # this should be a list of packages to install
-    reasoning = None
-    code = None
-    done = False
-    
-    # Check for <done> tag indicating completion
-    if "<done>" in response_text:
-        done = True
-    
-    # Check for packages
-    if "<packages>" in response_text and '</packages>' in response_text:
-        p_match = re.search(r"<packages>(.*?)</packages>", response_text, re.DOTALL)
-        if p_match:
-            packages = p_match.group(1).strip().split(',')
-    
-    # Check for reasoning and code sections
-    if "<reasoning>" in response_text and '</reasoning>' in response_text and "<code>" in response_text and '</code>' in response_text:
-        reasoning_match = re.search(r"<reasoning>(.*?)</reasoning>", response_text, re.DOTALL)
-        code_match = re.search(r"<code>(.*?)</code>", response_text, re.DOTALL)
-        
-        if reasoning_match and code_match:
-            reasoning = reasoning_match.group(1).strip()
-            code = code_match.group(1).strip()
-            
-    assert done or (reasoning is not None and code is not None), f"Response was not valid: {response_text}\n"
-
-    return ParsedResponse(done=done, packages=packages, reasoning=reasoning, code=code)
+    parser = IncrementalResponseParser()
+    parser.feed(response_text)
+    return parser.close()
 
 
 # structure to hold the result of code execution
@@ -64,11 +154,21 @@ class CodeExecutor(ABC):
     def run_code(self, code: str, python_packages: list = None):
         pass
 
+    def prepare(self, python_packages: list = None):
+        # start getting ready (e.g. booting a sandbox, installing packages) in the background,
+        # while the LLM is still writing the code: no-op by default
+        pass
+
+    def close(self):
+        # release any resource held by the executor (e.g. a sandbox session): no-op by default
+        pass
+
 # We use the E2B Code Interpreter class implementation to run code. You can implement your own 
 # executor if you want to use a different provider / method to run code.  
 class E2BCodeExecutor(CodeExecutor):    
     
     def __init__(self, api_key, envs: list = None):
+        from e2b_code_interpreter import Sandbox
         self.sbx = Sandbox(api_key=api_key, envs=envs) 
         
     def run_code(self, code: str, python_packages: list = None) -> ExecutorResponse:
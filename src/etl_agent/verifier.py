@@ -1,49 +1,164 @@
 """
 
-Human written verifier function for the ETL agent. This function is designed to verify the correctness 
-of the full ETL process by checking the state of the lakehouse after the ETL agent has run. 
+Human written verifier function for the ETL agent. This function is designed to verify the correctness
+of the full ETL process by checking the state of the lakehouse after the ETL agent has run.
+
+All the tables are checked concurrently, and each check is as cheap as we can make it: existence, schema
+and row count come from the Iceberg metadata of the table (no data is scanned), and everything else (ID
+uniqueness, null ratios) is computed by ONE aggregate query per table. Verification time is the time of
+the slowest table, and we get back a full report, not just the first failure.
 
 Please check out the companion blog post for more details, background and potential alternatives to this
 setup!
 
 """
 
-def verify_etl_process() -> bool:
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# what we expect of each table: the ID column (if any) should be unique and never null
+TableSpec = namedtuple('TableSpec', ['name', 'id_column', 'expected_columns'], defaults=(None, None))
+# the outcome of the checks on one table: ok is True if and only if errors is empty
+TableReport = namedtuple(
+    'TableReport',
+    ['table', 'ok', 'exists', 'row_count', 'columns', 'missing_columns', 'id_column',
+     'duplicate_ids', 'null_ratios', 'errors', 'seconds']
+)
+VerificationReport = namedtuple('VerificationReport', ['branch', 'ok', 'tables', 'seconds'])
+
+# each table corresponds to a file loaded in the raw S3 bucket: see the dataset docs in setup/data
+EXPECTED_TABLES = [
+    TableSpec('acquirer_countries', 'id', ['id', 'acquirer', 'country_code']),
+    TableSpec('payments', 'psp_reference', [
+        'psp_reference', 'merchant', 'card_scheme', 'year', 'hour_of_day', 'minute_of_hour', 'day_of_year',
+        'is_credit', 'eur_amount', 'ip_country', 'issuing_country', 'device_type', 'ip_address',
+        'email_address', 'card_number', 'shopper_interaction', 'card_bin', 'has_fraudulent_dispute',
+        'is_refused_by_adyen', 'aci', 'acquirer_country'
+    ]),
+    TableSpec('merchant_category_codes', 'id', ['id', 'mcc', 'description']),
+    TableSpec('fees', 'ID', [
+        'ID', 'card_scheme', 'account_type', 'capture_delay', 'monthly_fraud_level', 'monthly_volume',
+        'merchant_category_code', 'is_credit', 'aci', 'fixed_amount', 'rate', 'intracountry'
+    ]),
+    TableSpec('merchant_data', 'merchant', ['merchant', 'capture_delay', 'acquirer', 'merchant_category_code', 'account_type']),
+]
+
+
+def _aggregate_query(table: str, columns: list, id_column: str = None) -> str:
+    # one scan for all the checks: COUNT(col) counts the non null values of each column
+    select = ['COUNT(*) AS row_count']
+    if id_column is not None:
+        select.append(f'COUNT(DISTINCT "{id_column}") AS distinct_ids')
+    select += [f'COUNT("{c}") AS non_null_{i}' for i, c in enumerate(columns)]
+    return f"SELECT {', '.join(select)} FROM {table}"
+
+
+def check_table(client, spec: TableSpec, branch: str, deep: bool = True) -> TableReport:
+    """
+    Run all the checks on one table. With deep=False, only the table metadata is used (no query at all,
+    unless the metadata does not have the row count).
+    """
+    start = time.perf_counter()
+    errors, row_count, columns, missing, duplicates, null_ratios = [], None, [], [], None, {}
+    id_column = spec.id_column
+    try:
+        if not client.has_table(spec.name, ref=branch):
+            errors.append(f"Table {spec.name} does not exist in the lakehouse")
+        else:
+            # schema and row count from the snapshot metadata: no data scan
+            metadata = client.get_table(table=spec.name, ref=branch)
+            columns = [f.name for f in metadata.fields]
+            row_count = getattr(metadata, 'records', None)
+            missing = sorted(set(spec.expected_columns or []) - set(columns))
+            if missing:
+                errors.append(f"Table {spec.name} is missing the columns {missing}")
+            if len(columns) <= 1:
+                errors.append(f"Table {spec.name} does not have multiple columns.")
+            if id_column is not None and id_column not in columns:
+                errors.append(f"Table {spec.name} does not have its ID column {id_column}")
+                id_column = None
+            if deep or row_count is None:
+                query = _aggregate_query(spec.name, columns if deep else [], id_column if deep else None)
+                stats = client.query(query, ref=branch).to_pylist()[0]
+                row_count = stats['row_count']
+                if deep and row_count:
+                    null_ratios = {c: 1 - stats[f'non_null_{i}'] / row_count for i, c in enumerate(columns)}
+                    if id_column is not None:
+                        non_null_ids = stats[f'non_null_{columns.index(id_column)}']
+                        duplicates = non_null_ids - stats['distinct_ids']
+                        if duplicates > 0:
+                            errors.append(f"Table {spec.name} has {duplicates} duplicated values in {id_column}")
+                        if null_ratios[id_column] > 0:
+                            errors.append(f"Table {spec.name} has null values in {id_column}")
+            if not row_count:
+                errors.append(f"Table {spec.name} is empty.")
+    except Exception as e:
+        errors.append(f"Could not check table {spec.name}: {e}")
+
+    return TableReport(
+        table=spec.name,
+        ok=not errors,
+        exists=bool(columns),
+        row_count=row_count,
+        columns=columns,
+        missing_columns=missing,
+        id_column=id_column,
+        duplicate_ids=duplicates,
+        null_ratios=null_ratios,
+        errors=errors,
+        seconds=time.perf_counter() - start
+    )
+
+
+def build_verification_report(
+    client,
+    branch: str = 'main',
+    tables: list = None,
+    deep: bool = True,
+    max_workers: int = 8
+) -> VerificationReport:
+    """
+    Check all the tables concurrently, and return the full report.
+    """
+    start = time.perf_counter()
+    specs = tables or EXPECTED_TABLES
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(specs)))) as pool:
+        reports = list(pool.map(lambda spec: check_table(client, spec, branch, deep), specs))
+
+    return VerificationReport(
+        branch=branch,
+        ok=all(r.ok for r in reports),
+        tables=reports,
+        seconds=time.perf_counter() - start
+    )
+
+
+def verify_etl_process(branch: str = 'main', client=None) -> bool:
     """
     Verify the correctness of the ETL process by checking the state of the lakehouse.
-    We return True if and only if all the tables are in the main branch and they have data inside them.
-    
-    Note that we make this function completely self-contained, with its own imports and a fresh Bauplan client.
+    We return True if and only if all the tables are in the given branch (main by default), they have data
+    inside them, the expected columns, and unique, non null IDs.
+
+    Note that we make this function completely self-contained, with its own imports and a fresh Bauplan client,
+    unless a client is explicitly passed (e.g. a fake one, for offline tests).
     """
-    
-    import bauplan
-    import pyarrow as pa
+
     import os
-    # for testing purposes, we set up the option of specifying a profile
-    # via the BAUPLAN_PROFILE environment variable, otherwise we use the default profile
-    profile = 'default' if 'BAUPLAN_PROFILE' not in os.environ else os.environ['BAUPLAN_PROFILE']
-    client = bauplan.Client(profile=profile)
-    branch = 'main'
-    # each table corresponds to a file loaded in the raw S3 bucket
-    tables = [
-            'acquirer_countries', 
-            'payments', 
-            'merchant_category_codes',
-            'fees',
-            'merchant_data'
-        ]
-    # check for existence and for some data in each table
-    try:
-        for table in tables:
-            assert client.has_table(table, ref=branch), f"Table {table} does not exist in the lakehouse"
-            # we issue a query to check if the table has data and multiple columns
-            query = f"SELECT * FROM {table} LIMIT 3"
-            results: pa.Table = client.query(query, ref=branch)
-            assert len(results.column_names) > 1, f"Table {table} does not have multiple columns."
-            assert results.num_rows > 0, f"Table {table} is empty."
-            print(f"Table {table} exists and has {results.num_rows} rows.")
-    except AssertionError as e:
-        print(f"Verification failed: {e}")
-        return False
-
-    return True
\ No newline at end of file
+    if client is None:
+        import bauplan
+        # for testing purposes, we set up the option of specifying a profile
+        # via the BAUPLAN_PROFILE environment variable, otherwise we use the default profile
+        profile = 'default' if 'BAUPLAN_PROFILE' not in os.environ else os.environ['BAUPLAN_PROFILE']
+        client = bauplan.Client(profile=profile)
+    report = build_verification_report(client, branch=branch)
+    for table in report.tables:
+        if table.ok:
+            print(f"Table {table.table} exists and has {table.row_count} rows.")
+        else:
+            for error in table.errors:
+                print(f"Verification failed: {error}")
+    print(f"Verified {len(report.tables)} tables on {branch} in {report.seconds:.2f}s")
+
+    return report.ok
@@ -0,0 +1,264 @@
+"""
+
+A reusable Write-Audit-Publish (WAP) ingestion tool, pre-installed in the sandbox and exposed to the agent,
+so that the code it writes shrinks to one call instead of the full flow rewritten at every run:
+
+    import bauplan, wap
+    result = wap.run_wap(bauplan.Client(), {'fees': 's3://bucket/fees.parquet', 'payments': 's3://bucket/payments/*'})
+
+* Write: all the tables are created and imported concurrently in a temporary branch, so the ingestion
+  time is the one of the largest file, not the sum over the files;
+* Audit: the checks of all the tables (row count, unique and non null ID) run as ONE batched query;
+* Publish: if everything passed, the branch is merged in one step (all the tables, or none), and the
+  temporary branch is deleted whatever happens, so that a failed run leaves nothing behind.
+
+The module only depends on bauplan (boto3 for discover_tables), since it runs in the sandbox: see
+sandbox_install_code for how it gets there.
+
+"""
+
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# bump the version at every change: the sandbox installs each version in its own folder
+WAP_VERSION = '1.1.0'
+# the outcome of the audit of one table: ok is True if and only if errors is empty
+TableAudit = namedtuple('TableAudit', ['table', 'ok', 'row_count', 'id_column', 'duplicate_ids', 'null_ids', 'errors'])
+WapResult = namedtuple('WapResult', ['branch', 'ok', 'merged', 'tables', 'errors', 'seconds'])
+
+# the documentation of the tool, for the prompt
+WAP_TOOL_USAGE = """A tested `wap` module (version {version}) is pre-installed in the sandbox: it runs the whole Write-Audit-Publish flow
+in ONE call, importing all the tables concurrently and auditing them with one batched query. Prefer it to writing the flow by hand.
+It is already installed: do NOT add it to <packages>.
+
+```python
+import bauplan
+import wap
+client = bauplan.Client()
+# table name -> S3 URI to import from (a folder of files is imported with the * pattern)
+tables = {{'fees': 's3://my-bucket/fees.parquet', 'payments': 's3://my-bucket/payments/*'}}
+# or, to list the bucket (needs boto3 in <packages>): tables = wap.discover_tables('my-bucket')
+result = wap.run_wap(
+    client,
+    tables,
+    branch=None,             # None: a new username.wap_<timestamp> branch, or an exact branch name to use
+    id_columns=None,         # None: detected from the schemas, or e.g. {{'fees': 'ID'}}
+    merge=True,              # False: do not merge, and keep the branch for someone else to publish
+    into_branch='main',
+    replace=False            # True: delete and recreate the branch if it exists (otherwise, it is an error)
+)
+print(result.ok, result.branch, result.errors)
+for audit in result.tables:
+    print(audit.table, audit.row_count, audit.id_column, audit.duplicate_ids, audit.errors)
+```
+`result.ok` is True only if every table was imported and passed its checks (and was merged, if merge=True).""".format(version=WAP_VERSION)
+
+
+def discover_tables(bucket: str, prefix: str = '') -> dict:
+    """
+    List the parquet files of a bucket, as table name -> import URI: a file at the top of the bucket is a
+    table named after the file, a folder of files is a table named after the folder (imported with *).
+    """
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    bucket = bucket.replace('s3://', '').strip('/')
+    # the raw bucket is publicly readable: without credentials, we send unsigned requests
+    no_credentials = boto3.Session().get_credentials() is None
+    s3_client = boto3.client('s3', config=Config(signature_version=UNSIGNED) if no_credentials else None)
+    tables = {}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if not key.endswith('.parquet'):
+                continue
+            if '/' in key:
+                folder = key.split('/')[0]
+                tables[folder] = f"s3://{bucket}/{folder}/*"
+            else:
+                tables[os.path.splitext(key)[0]] = f"s3://{bucket}/{key}"
+    return tables
+
+
+def detect_id_column(table: str, columns: list):
+    """
+    The column which looks like the ID of the table, or None: id, then *_id / *_reference, then a column
+    named like the table itself (e.g. merchant in merchant_data).
+    """
+    for c in columns:
+        if c.lower() == 'id':
+            return c
+    for c in columns:
+        if c.lower().endswith(('_id', '_reference')):
+            return c
+    for c in columns:
+        if c.lower() == table.lower().split('_')[0]:
+            return c
+    return None
+
+
+def _ingest_table(client, table: str, search_uri: str, branch: str):
+    client.create_table(table=table, search_uri=search_uri, branch=branch, replace=True)
+    plan_state = client.import_data(table=table, search_uri=search_uri, branch=branch)
+    if getattr(plan_state, 'error', None):
+        raise RuntimeError(f"Import of {table} from {search_uri} failed: {plan_state.error}")
+
+
+def audit_query(id_columns: dict) -> str:
+    """
+    ONE query auditing all the tables (table name -> ID column or None): one row per table, with
+    row count, distinct and non null IDs.
+    """
+    selects = []
+    for table, id_column in id_columns.items():
+        if id_column is None:
+            ids = "NULL AS distinct_ids, NULL AS non_null_ids"
+        else:
+            ids = f'COUNT(DISTINCT "{id_column}") AS distinct_ids, COUNT("{id_column}") AS non_null_ids'
+        selects.append(f"SELECT '{table}' AS table_name, COUNT(*) AS row_count, {ids} FROM {table}")
+    return " UNION ALL ".join(selects)
+
+
+def audit_tables(client, tables: list, branch: str, id_columns: dict = None) -> list:
+    """
+    Audit the tables of a branch: every table must have rows, and its ID column (if any) unique, non null values.
+    """
+    id_columns = dict(id_columns or {})
+    for table in tables:
+        if table not in id_columns:
+            columns = [f.name for f in client.get_table(table=table, ref=branch).fields]
+            id_columns[table] = detect_id_column(table, columns)
+    rows = client.query(audit_query({t: id_columns[t] for t in tables}), ref=branch).to_pylist()
+    stats = {row['table_name']: row for row in rows}
+    audits = []
+    for table in tables:
+        row, errors = stats.get(table), []
+        duplicates = nulls = None
+        if row is None:
+            errors.append(f"No audit result for {table}")
+            row = {'row_count': None}
+        elif not row['row_count']:
+            errors.append(f"Table {table} is empty")
+        elif id_columns[table] is not None:
+            duplicates = row['non_null_ids'] - row['distinct_ids']
+            nulls = row['row_count'] - row['non_null_ids']
+            if duplicates:
+                errors.append(f"Table {table} has {duplicates} duplicated values in {id_columns[table]}")
+            if nulls:
+                errors.append(f"Table {table} has {nulls} null values in {id_columns[table]}")
+        audits.append(TableAudit(
+            table=table,
+            ok=not errors,
+            row_count=row['row_count'],
+            id_column=id_columns[table],
+            duplicate_ids=duplicates,
+            null_ids=nulls,
+            errors=errors
+        ))
+    return audits
+
+
+def run_wap(
+    client,
+    tables: dict,
+    branch: str = None,
+    id_columns: dict = None,
+    merge: bool = True,
+    into_branch: str = 'main',
+    max_workers: int = 8,
+    replace: bool = False
+) -> WapResult:
+    """
+    Run the Write-Audit-Publish flow for the tables (table name -> S3 URI): see the module docstring.
+
+    Parameters:
+    - client: A bauplan.Client.
+    - tables: The tables to import, as table name -> search URI.
+    - branch: The temporary branch: by default, username.wap_<timestamp>.
+    - id_columns: The ID column of some (or all) the tables: the others are detected from their schema.
+    - merge: Merge the branch if the audit passes, and delete it in any case; with merge=False, the
+      branch is kept (if the audit passes) for someone else to publish.
+    - into_branch: The branch to start from, and to merge into.
+    - max_workers: How many tables are imported concurrently.
+    - replace: Delete and recreate the branch if it already exists: otherwise, an existing branch (which
+      may hold someone else's work) raises a ValueError, and is left untouched.
+    """
+    start = time.perf_counter()
+    assert tables, "No tables to import"
+    if branch is None:
+        branch = f"{client.info().user.username}.wap_{int(time.time() * 1000)}"
+    if client.has_branch(branch) and not replace:
+        raise ValueError(f"Branch {branch} already exists: pass replace=True to delete and recreate it")
+    errors, audits, merged = [], [], False
+    try:
+        if replace and client.has_branch(branch):
+            client.delete_branch(branch)
+        client.create_branch(branch, from_ref=into_branch)
+        # write: every table concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tables)))) as pool:
+            futures = {t: pool.submit(_ingest_table, client, t, uri, branch) for t, uri in tables.items()}
+        for table, future in futures.items():
+            if future.exception() is not None:
+                errors.append(f"Could not import {table}: {future.exception()}")
+        # audit: one batched query
+        if not errors:
+            audits = audit_tables(client, list(tables), branch, id_columns)
+            errors += [e for a in audits for e in a.errors]
+        # publish: all the tables at once, or none
+        if not errors and merge:
+            client.merge_branch(source_ref=branch, into_branch=into_branch)
+            merged = True
+    except Exception as e:
+        errors.append(f"WAP failed on {branch}: {e}")
+    finally:
+        # a merged branch is not needed anymore, a failed one must not be left behind
+        if merged or errors:
+            try:
+                if client.has_branch(branch):
+                    client.delete_branch(branch)
+            except Exception as e:
+                errors.append(f"Could not delete branch {branch}: {e}")
+
+    return WapResult(
+        branch=branch,
+        ok=not errors,
+        merged=merged,
+        tables=audits,
+        errors=errors,
+        seconds=time.perf_counter() - start
+    )
+
+
+def sandbox_install_code() -> str:
+    """
+    The code installing this module in a sandbox session: the source is written in a folder of its own
+    version, which goes first in sys.path, so that `import wap` gives exactly this version.
+    """
+    with open(os.path.abspath(__file__)) as f:
+        source = f.read()
+    return (
+        "import os, sys, tempfile\n"
+        f"_wap_folder = os.path.join(tempfile.gettempdir(), 'data_agents_wap', {WAP_VERSION!r})\n"
+        "os.makedirs(_wap_folder, exist_ok=True)\n"
+        "with open(os.path.join(_wap_folder, 'wap.py'), 'w') as _f:\n"
+        f"    _f.write({source!r})\n"
+        "if _wap_folder not in sys.path:\n"
+        "    sys.path.insert(0, _wap_folder)\n"
+        "sys.modules.pop('wap', None)\n"
+        "import wap\n"
+        f"assert wap.WAP_VERSION == {WAP_VERSION!r}\n"
+    )
+
+
+if __name__ == "__main__":
+    # the flow against the fake lakehouse (see fakes.py): the imports run concurrently, so the total is
+    # about one import_delay, not one per table (tests/test_wap.py covers the failure paths)
+    from fakes import FakeBauplanClient
+    client = FakeBauplanClient(import_delay=0.5)
+    uris = {t: f"s3://raw/{t}.parquet" for t in ['acquirer_countries', 'merchant_category_codes', 'fees', 'merchant_data']}
+    result = run_wap(client, uris)
+    print(f"ok={result.ok} merged={result.merged} branch={result.branch} in {result.seconds:.2f}s, errors={result.errors}")
@@ -6,6 +6,10 @@ by creating a bucket (if does not exist) and uploading our tables in parquet for
 This script is intended to be run once, before the rest of the project is executed. None of this
 code is particularly interesting, but makes the repository self-contained.
 
+Raw files are converted in parallel (one process per file), and streamed: CSV files through the
+incremental arrow reader, JSON arrays rewritten as newline delimited JSON and parsed in blocks, so
+that memory stays flat with bigger raw drops. See ConversionOptions for the parquet settings.
+
 """
 
 
@@ -13,35 +17,317 @@ from datetime import datetime
 import boto3
 from botocore.exceptions import ClientError
 import pyarrow.csv as pv
+import pyarrow.json as pj
 import pyarrow.parquet as pq
 from os.path import join
 import json
+import os
+import inspect
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+from s3_sync import DEFAULT_MANIFEST_FOLDER, S3Sync, SyncManifest
+
+
+# how the raw files are read and the parquet files written: the readers work on blocks of block_size
+# bytes (types are inferred from the first block, so it should be large enough to see every type),
+# and we buffer batches up to row_group_size rows, so memory does not grow with the size of the file
+ConversionOptions = namedtuple(
+    'ConversionOptions',
+    ['row_group_size', 'compression', 'use_dictionary', 'block_size'],
+    defaults=(1_000_000, 'zstd', True, 16 * 1024 * 1024)
+)
+# the tokens that matter to find the objects in a JSON array: escapes (a backslash and the next
+# character), quotes, and brackets
+_JSON_STRUCTURE = re.compile(r'\\.|["{}\[\]]', re.DOTALL)
+# how a big table is laid out as many files under one prefix (e.g. payments/*, which the * pattern of
+# the import picks up): files are partitioned by buckets of the partition columns (column, bucket width),
+# and sorted inside by the columns the queries filter on, so that min / max statistics let the engine
+# skip files and row groups. The partition columns stay in the files. Low cardinality columns are
+# dictionary encoded, hashed ID columns get bloom filters (if the installed pyarrow can write them)
+PartitionedLayout = namedtuple(
+    'PartitionedLayout',
+    ['partition_columns', 'sort_columns', 'dictionary_columns', 'bloom_filter_columns', 'max_rows_per_file'],
+    defaults=((), (), (), 5_000_000)
+)
+# see payments-readme.md: queries mostly filter on year, day_of_year, merchant and card_scheme
+PAYMENTS_LAYOUT = PartitionedLayout(
+    partition_columns=(('year', 1), ('day_of_year', 31)),
+    sort_columns=('merchant', 'card_scheme'),
+    dictionary_columns=(
+        'merchant', 'card_scheme', 'ip_country', 'issuing_country', 'device_type', 'shopper_interaction',
+        'aci', 'acquirer_country'
+    ),
+    bloom_filter_columns=('psp_reference', 'ip_address', 'email_address', 'card_number')
+)
+LAYOUTS = {'payments.csv': PAYMENTS_LAYOUT}
+_WRITER_PARAMETERS = set(inspect.signature(pq.ParquetWriter.__init__).parameters)
+RAW_FILES = ['acquirer_countries.csv', 'payments.csv', 'merchant_category_codes.csv', 'fees.json', 'merchant_data.json']
+
+
+def parquet_path_for(data_folder: str, file_name: str) -> str:
+    return join(data_folder, os.path.splitext(file_name)[0] + '.parquet')
+
+
+def converted_path_for(data_folder: str, file_name: str, layouts: dict = None) -> str:
+    # a folder of parquet files for the partitioned tables, one parquet file for the others
+    if file_name in (layouts or {}):
+        return join(data_folder, os.path.splitext(file_name)[0])
+    return parquet_path_for(data_folder, file_name)
+
+
+def _write_batches(batches, parquet_path: str, options: ConversionOptions) -> str:
+    # write to a temporary file and rename, so that a failed conversion never leaves a partial parquet
+    tmp_path = f"{parquet_path}.tmp"
+    writer, buffered, buffered_rows = None, [], 0
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    tmp_path,
+                    batch.schema,
+                    compression=options.compression,
+                    use_dictionary=options.use_dictionary
+                )
+            buffered.append(batch)
+            buffered_rows += batch.num_rows
+            if buffered_rows >= options.row_group_size:
+                # write full row groups only, and keep the remainder for the next one
+                table = pa.Table.from_batches(buffered)
+                full = buffered_rows - buffered_rows % options.row_group_size
+                writer.write_table(table.slice(0, full), row_group_size=options.row_group_size)
+                buffered = table.slice(full).to_batches()
+                buffered_rows -= full
+        if writer is None:
+            raise ValueError(f"No data to write to {parquet_path}")
+        if buffered:
+            writer.write_table(pa.Table.from_batches(buffered), row_group_size=options.row_group_size)
+        writer.close()
+        os.replace(tmp_path, parquet_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return parquet_path
+
+
+def json_array_to_ndjson(json_path: str, ndjson_path: str, chunk_size: int = 1024 * 1024):
+    """
+    Rewrite a JSON array of objects (e.g. a pretty printed fees.json) as newline delimited JSON, one
+    object per line, in chunks: only the brackets and quotes are looked at, nothing is parsed.
+    """
+    depth, in_string = 0, False
+    with open(json_path, 'r', encoding='utf-8') as fin, open(ndjson_path, 'w', encoding='utf-8') as fout:
+        while chunk := fin.read(chunk_size):
+            # never split an escape sequence between two chunks
+            if chunk.endswith('\\'):
+                chunk += fin.read(1)
+            start = 0 if depth > 1 else None
+            for match in _JSON_STRUCTURE.finditer(chunk):
+                token = match.group()
+                if token == '"':
+                    in_string = not in_string
+                elif in_string or token[0] == '\\':
+                    continue
+                elif token in '{[':
+                    if depth == 1:
+                        start = match.start()
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        # JSON strings cannot contain raw newlines: the only ones are whitespace
+                        fout.write(chunk[start:match.end()].replace('\n', ' ').replace('\r', ' ') + '\n')
+                        start = None
+            if start is not None:
+                fout.write(chunk[start:].replace('\n', ' ').replace('\r', ' '))
 
 
 def csv_to_parquet(
     data_folder: str,
-    csv_file_name: str
+    csv_file_name: str,
+    options: ConversionOptions = None
 ) -> str:
-    _table = pv.read_csv(join(data_folder, csv_file_name))
-    parquet_path = join(data_folder, csv_file_name.replace('.csv', '.parquet'))
-    pq.write_table(_table, parquet_path)
-    
-    return parquet_path
+    options = options or ConversionOptions()
+    reader = pv.open_csv(
+        join(data_folder, csv_file_name),
+        read_options=pv.ReadOptions(block_size=options.block_size)
+    )
+    parquet_path = parquet_path_for(data_folder, csv_file_name)
+
+    return _write_batches(reader, parquet_path, options)
 
 
 def json_to_parquet(
     data_folder: str,
-    json_file_name: str
+    json_file_name: str,
+    options: ConversionOptions = None
 ) -> str:
-    with open(join(data_folder, json_file_name), 'r') as f:
-        rows_as_dict = json.load(f) 
-        
-    _table = pa.Table.from_pylist(rows_as_dict)
-    parquet_path = join(data_folder, json_file_name.replace('.json', '.parquet'))
-    pq.write_table(_table, parquet_path)
-    
-    return parquet_path
+    options = options or ConversionOptions()
+    json_path = join(data_folder, json_file_name)
+    parquet_path = parquet_path_for(data_folder, json_file_name)
+    with open(json_path, 'r', encoding='utf-8') as f:
+        first = f.read(4096).lstrip()[:1]
+    ndjson_path = None
+    if first == '[':
+        # arrow reads newline delimited JSON only: rewrite the array first
+        fd, ndjson_path = tempfile.mkstemp(suffix='.ndjson', dir=data_folder)
+        os.close(fd)
+        json_array_to_ndjson(json_path, ndjson_path)
+    try:
+        source = ndjson_path or json_path
+        read_options = pj.ReadOptions(block_size=options.block_size)
+        if hasattr(pj, 'open_json'):
+            batches = pj.open_json(source, read_options=read_options)
+        else:
+            # older pyarrow: no streaming reader, but still parsed in C++ without Python objects
+            batches = pj.read_json(source, read_options=read_options).to_batches()
+        return _write_batches(batches, parquet_path, options)
+    finally:
+        if ndjson_path is not None:
+            os.remove(ndjson_path)
+
+
+def _partition_keys(batch, layout: PartitionedLayout) -> list:
+    # the bucket of each partition column, e.g. day_of_year // 31
+    return [
+        batch.column(column) if width == 1 else pc.multiply(pc.divide(batch.column(column), width), width)
+        for column, width in layout.partition_columns
+    ]
+
+
+def _partition_file_name(prefix: str, key: tuple, layout: PartitionedLayout, part: int) -> str:
+    bounds = [
+        f"{column}={value}" if width == 1 else f"{column}={value:03d}-{value + width - 1:03d}"
+        for (column, width), value in zip(layout.partition_columns, key)
+    ]
+    return f"{prefix}-{'-'.join(bounds)}-{part:04d}.parquet"
+
+
+def _layout_writer_options(layout: PartitionedLayout, schema, num_rows: int) -> dict:
+    options = {
+        'use_dictionary': [c for c in layout.dictionary_columns if c in schema.names],
+        'write_statistics': True
+    }
+    if 'bloom_filter_options' in _WRITER_PARAMETERS:
+        options['bloom_filter_options'] = {
+            c: {'ndv': max(num_rows, 1), 'fpp': 0.01} for c in layout.bloom_filter_columns if c in schema.names
+        }
+    if 'write_page_index' in _WRITER_PARAMETERS:
+        options['write_page_index'] = True
+    if 'sorting_columns' in _WRITER_PARAMETERS and layout.sort_columns:
+        options['sorting_columns'] = pq.SortingColumn.from_ordering(
+            schema, [(c, 'ascending') for c in layout.sort_columns]
+        )
+    return options
+
+
+def csv_to_partitioned_parquet(
+    data_folder: str,
+    csv_file_name: str,
+    layout: PartitionedLayout,
+    options: ConversionOptions = None
+) -> str:
+    """
+    Convert a CSV file to a folder of parquet files laid out as described by the layout, in two passes
+    with bounded memory: the CSV is streamed and every batch is split by partition into spill files, then
+    each partition (sorted) is written as one or more parquet files. Return the folder.
+    """
+    options = options or ConversionOptions()
+    folder = converted_path_for(data_folder, csv_file_name, {csv_file_name: layout})
+    prefix = os.path.basename(folder)
+    key_names = [column for column, _ in layout.partition_columns]
+    reader = pv.open_csv(
+        join(data_folder, csv_file_name),
+        read_options=pv.ReadOptions(block_size=options.block_size)
+    )
+    spill_folder = tempfile.mkdtemp(prefix=f'{prefix}_spill_', dir=data_folder)
+    tmp_folder = f"{folder}.tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    spills = {}
+    try:
+        # first pass: split the stream by partition
+        for batch in reader:
+            keys = pa.table(_partition_keys(batch, layout), names=key_names)
+            for key in keys.group_by(key_names).aggregate([]).to_pylist():
+                mask = None
+                for name in key_names:
+                    match = pc.equal(keys.column(name), key[name])
+                    mask = match if mask is None else pc.and_(mask, match)
+                key = tuple(key[name] for name in key_names)
+                if key not in spills:
+                    path = join(spill_folder, f"{len(spills)}.arrow")
+                    spills[key] = (path, ipc.new_stream(path, batch.schema))
+                spills[key][1].write_batch(batch.filter(mask))
+        for _, writer in spills.values():
+            writer.close()
+        # second pass: one partition at a time, sorted
+        for key, (path, _) in sorted(spills.items()):
+            with ipc.open_stream(path) as spill:
+                table = spill.read_all()
+            os.remove(path)
+            if layout.sort_columns:
+                table = table.sort_by([(c, 'ascending') for c in layout.sort_columns])
+            for part, offset in enumerate(range(0, table.num_rows, layout.max_rows_per_file)):
+                chunk = table.slice(offset, layout.max_rows_per_file)
+                file_path = join(tmp_folder, _partition_file_name(prefix, key, layout, part))
+                with pq.ParquetWriter(
+                    file_path,
+                    chunk.schema,
+                    compression=options.compression,
+                    **_layout_writer_options(layout, chunk.schema, chunk.num_rows)
+                ) as writer:
+                    writer.write_table(chunk, row_group_size=options.row_group_size)
+        if not spills:
+            raise ValueError(f"No data to write to {folder}")
+        # swap the new files in: no stale partition is left behind
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
+    finally:
+        shutil.rmtree(spill_folder, ignore_errors=True)
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    return folder
+
+
+def _convert(args: tuple) -> str:
+    data_folder, file_name, options, layout = args
+    if layout is not None:
+        if not file_name.endswith('.csv'):
+            raise ValueError(f"Partitioned layouts are only supported for CSV files, not {file_name}")
+        return csv_to_partitioned_parquet(data_folder, file_name, layout, options)
+    if file_name.endswith('.csv'):
+        return csv_to_parquet(data_folder, file_name, options)
+    if file_name.endswith('.json'):
+        return json_to_parquet(data_folder, file_name, options)
+    raise ValueError(f"Unsupported raw file {file_name}: expected .csv or .json")
+
+
+def convert_raw_files(
+    data_folder: str,
+    file_names: list,
+    options: ConversionOptions = None,
+    max_workers: int = None,
+    layouts: dict = None
+) -> list:
+    """
+    Convert the raw files to parquet in parallel, one process per file (up to max_workers), and
+    return the parquet paths in the same order as the file names. Files with a layout (file name ->
+    PartitionedLayout) are converted to a folder of parquet files, and their path is the folder.
+    """
+    options = options or ConversionOptions()
+    layouts = layouts or {}
+    if not file_names:
+        return []
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(file_names)))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_convert, [(data_folder, f, options, layouts.get(f)) for f in file_names]))
 
 
 def create_bucket_if_not_exists(s3_client, s3_bucket_raw_data):
@@ -59,38 +345,80 @@ def create_bucket_if_not_exists(s3_client, s3_bucket_raw_data):
 def main(
     s3_bucket_raw_data: str,
     local_data_folder: str,
+    conversion_options: ConversionOptions = None,
+    s3_client=None,
+    manifest_path: str = None,
+    force: bool = False,
+    layouts: dict = None
 ):
+    """
+    Convert the raw files and sync them to the bucket. Incremental by default: raw files which did not
+    change since the last run are not converted again, and parquet files which are already in the
+    bucket are not uploaded again; force=True converts and uploads everything.
+
+    Files in layouts (LAYOUTS by default, pass {} for flat files only) are uploaded as many parquet
+    files under one prefix, e.g. payments/*.
+    """
     print(f"Starting cloud setup preparation at {datetime.now()}")
     # initialize the S3 client
     # NOTE: we assume AWS credentials are set up in the environment
-    s3_client = boto3.client('s3')  
-    # keep track of the parquet files to upload
-    parquet_files = []
-    # get csv files to parquet
-    for f in ['acquirer_countries.csv', 'payments.csv', 'merchant_category_codes.csv']:
-        p_file = csv_to_parquet(local_data_folder, f)
-        parquet_files.append(p_file)
-    # get the JSON files to parquet
-    for f in ['fees.json', 'merchant_data.json']:
-        j_file = json_to_parquet(local_data_folder, f)
-        parquet_files.append(j_file)
-        
-    assert len(parquet_files) == 5, "There should be 5 parquet files to upload"
+    s3_client = s3_client or boto3.client('s3')
+    options = conversion_options or ConversionOptions()
+    layouts = LAYOUTS if layouts is None else layouts
+    manifest = SyncManifest(manifest_path or join(DEFAULT_MANIFEST_FOLDER, f'{s3_bucket_raw_data}.json'))
+
+    def fingerprint(f):
+        layout = layouts.get(f)
+        return json.dumps({'options': options._asdict(), 'layout': layout and layout._asdict()}, sort_keys=True)
+
+    # convert the changed csv and JSON files to parquet, in parallel
+    to_convert = [
+        f for f in RAW_FILES
+        if force or not manifest.source_unchanged(
+            join(local_data_folder, f), converted_path_for(local_data_folder, f, layouts), fingerprint(f)
+        )
+    ]
+    converted = convert_raw_files(local_data_folder, to_convert, options=options, layouts=layouts)
+    for f, p_file in zip(to_convert, converted):
+        manifest.record_source(join(local_data_folder, f), p_file, fingerprint(f))
+    print(f"Converted {len(to_convert)} files to parquet ({len(RAW_FILES) - len(to_convert)} unchanged) at {datetime.now()}")
+    parquet_files = [converted_path_for(local_data_folder, f, layouts) for f in RAW_FILES]
+
+    assert len(parquet_files) == 5, "There should be 5 parquet files (or folders) to upload"
     # create the S3 bucket if it does not exist
     does_bucket_exist = create_bucket_if_not_exists(s3_client, s3_bucket_raw_data)
     if not does_bucket_exist:
         print(f"Created a new S3 bucket {s3_bucket_raw_data}")
-    # upload the parquet files to S3
+    # upload the changed parquet files to S3, concurrently: the files of a folder go under its prefix
+    to_sync = {}
     for p_file in parquet_files:
-        print(f"Uploading {p_file} to S3 bucket {s3_bucket_raw_data}")
-        s3_client.upload_file(p_file, s3_bucket_raw_data, p_file.split('/')[-1])
-    
-    print(f"Upload done at {datetime.now()}. See you, space cowboy!")
-    return
+        if os.path.isdir(p_file):
+            prefix = os.path.basename(p_file)
+            to_sync.update({join(p_file, f): f"{prefix}/{f}" for f in sorted(os.listdir(p_file))})
+        else:
+            to_sync[p_file] = os.path.basename(p_file)
+    sync = S3Sync(s3_client, s3_bucket_raw_data, manifest=manifest)
+    results = sync.sync(to_sync, force=force)
+    for r in results:
+        print(f"{r.action.capitalize()} {r.key} in S3 bucket {s3_bucket_raw_data} ({r.bytes} bytes, {r.seconds:.2f}s)")
+    # a table must not be imported with stale files, nor in both layouts (after switching --layout): a
+    # partitioned table loses its old files and its flat file, a flat one the prefix of its old partitions
+    stale = []
+    for p_file in parquet_files:
+        if os.path.isdir(p_file):
+            prefix = os.path.basename(p_file)
+            stale += sync.prune(f"{prefix}/", keep=to_sync.values()) + sync.prune(f"{prefix}.parquet", keep=())
+        else:
+            stale += sync.prune(f"{os.path.splitext(os.path.basename(p_file))[0]}/", keep=())
+    for key in stale:
+        print(f"Deleted stale {key} from S3 bucket {s3_bucket_raw_data}")
 
+    print(f"Upload done at {datetime.now()}. See you, space cowboy!")
+    return results
 
 
 if __name__ == "__main__":
+    import argparse
     from dotenv import load_dotenv
     from os.path import dirname, abspath, join
     from os import environ
@@ -98,8 +426,17 @@ if __name__ == "__main__":
     # Load environment variables from .env file in the src directory    
     load_dotenv(join(d, '.env'))
     assert 'S3_BUCKET_RAW_DATA' in environ, "S3_BUCKET_RAW_DATA environment variable is not set"
-    
+    parser = argparse.ArgumentParser(description="Convert the raw data and sync it to the S3 bucket")
+    parser.add_argument('--force', action='store_true', help="convert and upload every file, even if unchanged")
+    parser.add_argument(
+        '--layout', choices=['partitioned', 'flat'], default='partitioned',
+        help="partitioned: big tables (payments) as many sorted files under one prefix; flat: one file per table"
+    )
+    args = parser.parse_args()
+
     main(
         s3_bucket_raw_data=environ['S3_BUCKET_RAW_DATA'],
-        local_data_folder=join(dirname(abspath(__file__)), 'data')
+        local_data_folder=join(dirname(abspath(__file__)), 'data'),
+        force=args.force,
+        layouts=LAYOUTS if args.layout == 'partitioned' else {}
     )
\ No newline at end of file
@@ -0,0 +1,303 @@
+"""
+
+Incremental sync of local files to S3, used by prepare_cloud_setup.py to (re)seed the raw data bucket.
+
+A local JSON manifest keeps the content hash of every file we converted and uploaded: a file is uploaded
+only if its hash differs from the one of the object in the bucket (stored in the object metadata, or
+derived from its ETag for objects uploaded by other means). Changed files are uploaded concurrently;
+big ones as multipart uploads with concurrent parts, whose upload id is saved in the manifest, so that
+a failed run resumes from the parts already in S3 instead of starting over.
+
+Any S3 compatible endpoint works, e.g. a local moto server for tests: boto3 picks up AWS_ENDPOINT_URL.
+
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+
+DEFAULT_MANIFEST_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'data-agents', 's3_sync')
+# the outcome of the sync of one file: action is one of 'skipped', 'uploaded', 'resumed'
+SyncResult = namedtuple('SyncResult', ['key', 'action', 'bytes', 'seconds'])
+
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _part_ranges(size: int, part_size: int) -> list:
+    # (part number, offset, length) for every part of a multipart upload: S3 part numbers start at 1
+    return [(i + 1, offset, min(part_size, size - offset)) for i, offset in enumerate(range(0, max(size, 1), part_size))]
+
+
+def _read_range(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def expected_etag(path: str, multipart_threshold: int, part_size: int) -> str:
+    """
+    The ETag S3 gives to the file uploaded by us: the MD5 of the content for a single upload, the MD5 of
+    the concatenated part MD5s, followed by the number of parts, for a multipart one.
+    """
+    size = os.path.getsize(path)
+    if size < multipart_threshold:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            while chunk := f.read(8 * 1024 * 1024):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+    parts = _part_ranges(size, part_size)
+    digests = b''.join(hashlib.md5(_read_range(path, offset, length)).digest() for _, offset, length in parts)
+    return f'"{hashlib.md5(digests).hexdigest()}-{len(parts)}"'
+
+
+class SyncManifest:
+    """
+    The local state of the sync, saved as JSON after every change (write and rename):
+
+    - files: local path -> size, mtime and sha256, so that unchanged files are not hashed again;
+    - sources: raw file -> fingerprint of the raw content and conversion options, and the converted file;
+    - objects: S3 key -> sha256 and ETag of what we uploaded;
+    - uploads: S3 key -> upload id, sha256 and part size of the multipart upload in progress.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {'files': {}, 'sources': {}, 'objects': {}, 'uploads': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+
+    def save(self):
+        with self._lock:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def set(self, section: str, key: str, value: dict = None):
+        with self._lock:
+            if value is None:
+                self.data[section].pop(key, None)
+            else:
+                self.data[section][key] = value
+        self.save()
+
+    def get(self, section: str, key: str) -> dict:
+        with self._lock:
+            return self.data[section].get(key)
+
+    def sha256(self, path: str) -> str:
+        """
+        The hash of a local file, reused from the manifest if its size and modification time did not change.
+        The hash of a folder is the hash of the names and hashes of its files.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for name in sorted(os.listdir(path)):
+                digest.update(f"{name}:{self.sha256(os.path.join(path, name))}\n".encode('utf-8'))
+            return digest.hexdigest()
+        stat = os.stat(path)
+        known = self.get('files', os.path.abspath(path))
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        sha = file_sha256(path)
+        self.set('files', os.path.abspath(path), {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha})
+        return sha
+
+    def source_unchanged(self, raw_path: str, converted_path: str, options_fingerprint: str) -> bool:
+        """
+        True if the raw file was already converted, with the same options, to a file which is still there.
+        """
+        known = self.get('sources', os.path.abspath(raw_path))
+        return (
+            known is not None
+            and os.path.exists(converted_path)
+            and known['converted'] == os.path.abspath(converted_path)
+            and known['options'] == options_fingerprint
+            and known['sha256'] == self.sha256(raw_path)
+            and known['converted_sha256'] == self.sha256(converted_path)
+        )
+
+    def record_source(self, raw_path: str, converted_path: str, options_fingerprint: str):
+        self.set('sources', os.path.abspath(raw_path), {
+            'sha256': self.sha256(raw_path),
+            'converted': os.path.abspath(converted_path),
+            'converted_sha256': self.sha256(converted_path),
+            'options': options_fingerprint
+        })
+
+
+class S3Sync:
+    """
+    Upload local files to a bucket, skipping the ones which did not change: see the module docstring.
+
+    Parameters:
+    - s3_client: A boto3 S3 client.
+    - bucket: The destination bucket.
+    - manifest: The SyncManifest to use: by default, one per bucket in DEFAULT_MANIFEST_FOLDER.
+    - multipart_threshold: Files at least this big are uploaded in parts (S3 needs parts of at least 5MB).
+    - part_size: The size of each part.
+    - max_workers: How many files are uploaded concurrently.
+    - max_part_workers: How many parts of each file are uploaded concurrently.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        manifest: SyncManifest = None,
+        multipart_threshold: int = 64 * 1024 * 1024,
+        part_size: int = 16 * 1024 * 1024,
+        max_workers: int = 8,
+        max_part_workers: int = 8
+    ):
+        assert part_size >= 5 * 1024 * 1024, "S3 parts must be at least 5MB"
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.manifest = manifest or SyncManifest(os.path.join(DEFAULT_MANIFEST_FOLDER, f'{bucket}.json'))
+        self.multipart_threshold = max(multipart_threshold, part_size)
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.max_part_workers = max_part_workers
+
+    def is_unchanged(self, path: str, key: str, sha: str) -> bool:
+        """
+        True if the object already in the bucket has the same content as the local file.
+        """
+        try:
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        remote_sha = head.get('Metadata', {}).get('sha256')
+        if remote_sha is not None:
+            return remote_sha == sha
+        # uploaded by someone else: the ETag is all we have
+        known = self.manifest.get('objects', key)
+        if known is not None and known['sha256'] == sha:
+            return known['etag'] == head['ETag']
+        return head['ETag'] == expected_etag(path, self.multipart_threshold, self.part_size)
+
+    def sync(self, files: dict, force: bool = False) -> list:
+        """
+        Sync the files (local path -> S3 key) concurrently, and return one SyncResult per file, in order.
+        With force=True, every file is uploaded.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(files)))) as pool:
+            return list(pool.map(lambda item: self.sync_file(*item, force=force), files.items()))
+
+    def sync_file(self, path: str, key: str, force: bool = False) -> SyncResult:
+        start = time.perf_counter()
+        sha = self.manifest.sha256(path)
+        if not force and self.is_unchanged(path, key, sha):
+            return SyncResult(key, 'skipped', 0, time.perf_counter() - start)
+        size = os.path.getsize(path)
+        if size < self.multipart_threshold:
+            response = self.s3_client.put_object(
+                Bucket=self.bucket, Key=key, Body=_read_range(path, 0, size), Metadata={'sha256': sha}
+            )
+            action = 'uploaded'
+        else:
+            response, action = self._multipart_upload(path, key, sha, size)
+        self.manifest.set('objects', key, {'sha256': sha, 'etag': response['ETag']})
+
+        return SyncResult(key, action, size, time.perf_counter() - start)
+
+    def prune(self, prefix: str, keep) -> list:
+        """
+        Delete the objects whose key starts with prefix, except the ones in keep, and return their keys.
+        """
+        keep = set(keep)
+        stale = [
+            obj['Key']
+            for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])
+            if obj['Key'] not in keep
+        ]
+        for i in range(0, len(stale), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.bucket, Delete={'Objects': [{'Key': key} for key in stale[i:i + 1000]], 'Quiet': True}
+            )
+        for key in stale:
+            self.manifest.set('objects', key)
+        return stale
+
+    def _uploaded_parts(self, key: str, upload_id: str) -> dict:
+        # part number -> ETag of the parts already in S3, or None if the upload is gone
+        parts, marker = {}, 0
+        try:
+            while True:
+                response = self.s3_client.list_parts(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumberMarker=marker
+                )
+                for part in response.get('Parts', []):
+                    parts[part['PartNumber']] = (part['ETag'], part['Size'])
+                if not response.get('IsTruncated'):
+                    return parts
+                marker = response['NextPartNumberMarker']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchUpload', '404'):
+                return None
+            raise
+
+    def _multipart_upload(self, path: str, key: str, sha: str, size: int) -> tuple:
+        pending = self.manifest.get('uploads', key)
+        done, action = None, 'uploaded'
+        if pending is not None:
+            if pending['sha256'] == sha and pending['part_size'] == self.part_size:
+                done = self._uploaded_parts(key, pending['upload_id'])
+            else:
+                # the file changed since the failed run: its parts are useless
+                try:
+                    self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=pending['upload_id'])
+                except ClientError:
+                    pass
+        if done is None:
+            upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=key, Metadata={'sha256': sha}
+            )['UploadId']
+            self.manifest.set('uploads', key, {'upload_id': upload_id, 'sha256': sha, 'part_size': self.part_size})
+            done = {}
+        else:
+            upload_id = pending['upload_id']
+            action = 'resumed'
+            print(f"Resuming the upload of {key}: {len(done)} parts already in S3")
+
+        ranges = _part_ranges(size, self.part_size)
+
+        def upload_part(part: tuple) -> dict:
+            number, offset, length = part
+            body = _read_range(path, offset, length)
+            etag = done.get(number, (None, None))[0]
+            # keep a part from the failed run only if it is the same content
+            if etag is None or done[number][1] != length or etag.strip('"') != hashlib.md5(body).hexdigest():
+                etag = self.s3_client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+                )['ETag']
+            return {'PartNumber': number, 'ETag': etag}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_part_workers, len(ranges)))) as pool:
+            parts = list(pool.map(upload_part, ranges))
+        response = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+        )
+        self.manifest.set('uploads', key)
+
+        return response, action
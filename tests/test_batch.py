@@ -0,0 +1,137 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import etl_agent_loop
+import sandbox
+from batch import BatchTask, ProviderLimit, RateLimitedCompletion, TokenBucket, react_task_runner, run_batch
+from fakes import ScriptedLLM, FakeCodeExecutor, RateLimitedProvider
+from utils import ExecutorResponse
+
+
+CODE = (
+    "<reasoning>Answer the question</reasoning><packages>bauplan</packages>"
+    "<code>try:\n    print('42')\nexcept Exception as e:\n    print(e)</code>"
+)
+
+
+def _scripted(model: str, messages: list, **kwargs):
+    # the first turn writes code, the next one answers: the same for every task
+    text = CODE if len(messages) <= 2 else "<done>42</done>"
+    return ScriptedLLM([text], delay=0.01)(model=model, messages=messages, **kwargs)
+
+
+def _unlimited(completion_fn):
+    return RateLimitedCompletion(completion_fn, provider_limits={'together_ai': ProviderLimit(requests_per_minute=60_000)})
+
+
+def _tasks(n):
+    return [
+        BatchTask(task_id=str(i), prompt_variables={'question': f"Question {i}"}, user_prompt_template="{question} on {s3_raw_bucket}")
+        for i in range(n)
+    ]
+
+
+def _runner(tmp_path, completion_fn, on_run=None):
+    return react_task_runner(
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        eb2_api_key='fake',
+        model_name='together_ai/fake-model',
+        max_tokens=1000,
+        max_iterations=4,
+        llm_folder=str(tmp_path / 'llm_code'),
+        completion_fn=completion_fn,
+        executor_factory=lambda: FakeCodeExecutor(on_run=on_run)
+    )
+
+
+def _read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batch_under_a_rate_limited_provider(tmp_path, monkeypatch):
+    monkeypatch.setattr(etl_agent_loop, 'TRANSIENT_RETRY_DELAY', 0.01)
+    provider = RateLimitedProvider(_scripted, requests_per_second=20)
+    completion_fn = RateLimitedCompletion(
+        provider, provider_limits={'together_ai': ProviderLimit(requests_per_minute=20 * 60)}, base_delay=0.1, max_delay=2.0
+    )
+    failures = iter([True, True] + [False] * 100)
+    lock = threading.Lock()
+
+    def on_run(code, packages):
+        with lock:
+            failed = next(failures)
+        if failed:
+            raise ConnectionError("Sandbox connection dropped")
+        return ExecutorResponse(result=[], stdout=['42\n'], stderr=[], error=None)
+
+    results_path = tmp_path / 'results.jsonl'
+    with _runner(tmp_path, completion_fn, on_run) as run_task:
+        summary = asyncio.run(run_batch(_tasks(30), run_task, str(results_path), max_workers=8, base_delay=0.01))
+    assert len(summary.results) == 30 and all(r.ok for r in summary.results)
+    # a dropped connection costs an iteration of the run, not an attempt of the task
+    assert all(r.attempts == 1 for r in summary.results)
+    assert sorted(r['task_id'] for r in _read_results(results_path)) == sorted(str(i) for i in range(30))
+
+
+def test_completed_tasks_are_skipped(tmp_path):
+    results_path = str(tmp_path / 'results.jsonl')
+    with _runner(tmp_path, _unlimited(_scripted)) as run_task:
+        asyncio.run(run_batch(_tasks(3), run_task, results_path))
+        summary = asyncio.run(run_batch(_tasks(5), run_task, results_path))
+    assert summary.skipped == 3 and sorted(r.task_id for r in summary.results) == ['3', '4']
+    assert len(_read_results(results_path)) == 5
+
+
+def test_interrupted_task_resumes_its_checkpoint(tmp_path):
+    llm, executions = ScriptedLLM([CODE, "<done>42</done>"]), []
+
+    def on_run(code, packages):
+        executions.append(code)
+        if len(executions) == 1:
+            raise RuntimeError("sandbox crashed")
+        return ExecutorResponse(result=[], stdout=['42\n'], stderr=[], error=None)
+
+    with _runner(tmp_path, _unlimited(llm), on_run) as run_task:
+        summary = asyncio.run(run_batch(_tasks(1), run_task, str(tmp_path / 'results.jsonl'), base_delay=0.01))
+    result = summary.results[0]
+    assert result.ok and result.attempts == 2
+    # the code the model wrote before the crash is executed again, without asking the model again
+    assert len(llm.calls) == 2 and len(executions) == 2
+
+
+def test_default_sandbox_pool_is_closed(tmp_path, monkeypatch):
+    pools = []
+
+    class RecordingPool:
+        def __init__(self, **kwargs):
+            self.closed = False
+            pools.append(self)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(sandbox, 'SandboxPool', RecordingPool)
+    with pytest.raises(RuntimeError, match="batch failed"):
+        with react_task_runner('s3://raw', 'fake', 'fake', 'together_ai/fake-model', 1000, 4, str(tmp_path)):
+            assert len(pools) == 1 and not pools[0].closed
+            raise RuntimeError("batch failed")
+    assert pools[0].closed
+
+
+def test_token_bucket_spreads_requests():
+    now, slept = [0.0], []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=2.0, capacity=2.0, clock=lambda: now[0], sleep=sleep)
+    waits = [bucket.acquire() for _ in range(6)]
+    assert waits[:2] == [0.0, 0.0] and waits[2:] == [0.5] * 4
+    bucket.pause(3.0)
+    assert bucket.acquire() >= 3.0
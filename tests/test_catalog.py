@@ -0,0 +1,135 @@
+import io
+import os
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+from catalog import S3RangeFile, TableEntry, build_catalog, format_catalog, key_candidates, read_footer
+
+
+BUCKET = 'raw-data'
+
+
+class RecordingClient:
+    """
+    A boto3 S3 client recording the get_object calls, to check that only ranges are read.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.gets = []
+
+    def get_object(self, **kwargs):
+        self.gets.append(kwargs)
+        return self.client.get_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield RecordingClient(client)
+
+
+def _put_parquet(s3, key: str, table: pa.Table, row_group_size: int = None) -> int:
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, row_group_size=row_group_size)
+    s3.put_object(Bucket=BUCKET, Key=key, Body=buffer.getvalue())
+    return len(buffer.getvalue())
+
+
+def _payments(n: int, offset: int = 0) -> pa.Table:
+    return pa.table({
+        'psp_reference': pa.array(range(offset, offset + n), pa.int64()),
+        # random bytes do not compress: the file is much larger than its footer
+        'payload': pa.array([os.urandom(64).hex() for _ in range(n)]),
+        'merchant': pa.array([None if i % 10 == 0 else f"m{i % 7}" for i in range(n)]),
+    })
+
+
+def _object(s3, key: str) -> dict:
+    head = s3.head_object(Bucket=BUCKET, Key=key)
+    return {'size': head['ContentLength'], 'etag': head['ETag']}
+
+
+def test_footer_is_read_with_range_requests_only(s3):
+    size = _put_parquet(s3, 'payments.parquet', _payments(20_000), row_group_size=5_000)
+    footer = read_footer(s3, BUCKET, 'payments.parquet', **_object(s3, 'payments.parquet'))
+    assert footer.num_rows == 20_000 and footer.num_row_groups == 4 and footer.size == size
+    assert footer.columns == [['psp_reference', 'int64'], ['payload', 'string'], ['merchant', 'string']]
+    assert footer.non_null == ['psp_reference', 'payload']
+    # one request for the tail of the file, where the footer is
+    assert [g['Range'] for g in s3.gets] == [f"bytes={size - 64 * 1024}-{size - 1}"]
+    assert all(g['IfMatch'] == footer.etag for g in s3.gets)
+
+
+def test_range_file_reads(s3):
+    data = bytes(range(256)) * 40
+    s3.put_object(Bucket=BUCKET, Key='blob', Body=data)
+    f = S3RangeFile(s3, BUCKET, 'blob', len(data), tail_bytes=1000)
+    f.seek(-10, io.SEEK_END)
+    assert f.read(100) == data[-10:] and f.read(1) == b''
+    f.seek(-500, io.SEEK_END)
+    assert f.read(20) == data[-500:-480]
+    f.seek(100)
+    assert f.read(50) == data[100:150] and f.tell() == 150
+    # the tail is fetched once, the other reads are ranges of their own
+    assert [g['Range'] for g in s3.gets] == [f"bytes={len(data) - 1000}-{len(data) - 1}", "bytes=100-149"]
+    assert f.bytes_read == 1050
+
+
+@pytest.mark.parametrize('table, columns, non_null, expected', [
+    ('payments', [['amount', 'double'], ['psp_reference', 'int64'], ['id', 'int64']], ['amount', 'psp_reference', 'id'], ['id', 'psp_reference']),
+    ('merchant_data', [['merchant', 'string'], ['account_type', 'string']], ['merchant', 'account_type'], ['merchant']),
+    # columns with nulls (or no statistics) are never keys
+    ('fees', [['ID', 'int64'], ['card_scheme', 'string']], ['card_scheme'], []),
+])
+def test_key_candidates(table, columns, non_null, expected):
+    assert key_candidates(table, columns, non_null) == expected
+
+
+def test_catalog_of_a_bucket(s3, tmp_path):
+    sizes = [
+        _put_parquet(s3, 'payments/part-0.parquet', _payments(1_000)),
+        _put_parquet(s3, 'payments/part-1.parquet', _payments(500, offset=1_000)),
+        _put_parquet(s3, 'fees.parquet', pa.table({'ID': [1, 2, 3], 'fixed_amount': [0.1, 0.2, None]})),
+    ]
+    s3.put_object(Bucket=BUCKET, Key='notes.txt', Body=b'not a table')
+    cache_path = str(tmp_path / 'catalog.json')
+    tables = build_catalog(s3, BUCKET, cache_path=cache_path)
+    assert [t.name for t in tables] == ['fees', 'payments']
+    fees, payments = tables
+    assert fees.uri == f"s3://{BUCKET}/fees.parquet" and fees.files == 1 and fees.num_rows == 3
+    assert fees.key_candidates == ['ID']
+    assert payments.uri == f"s3://{BUCKET}/payments/*" and payments.files == 2 and payments.num_rows == 1_500
+    assert payments.size == sum(sizes[:2]) and payments.key_candidates == ['psp_reference']
+    assert all('Range' in g for g in s3.gets) and len(s3.gets) == 3
+    # an unchanged bucket is served from the cache, a changed file is read again
+    s3.gets.clear()
+    assert build_catalog(s3, BUCKET, cache_path=cache_path) == tables and s3.gets == []
+    _put_parquet(s3, 'fees.parquet', pa.table({'ID': [1, 2], 'fixed_amount': [0.1, 0.2]}))
+    assert build_catalog(s3, BUCKET, cache_path=cache_path)[0].num_rows == 2
+    assert [g['Key'] for g in s3.gets] == ['fees.parquet']
+
+
+def test_format_catalog():
+    tables = [
+        TableEntry('fees', 's3://raw/fees.parquet', 1, 2 * 1024 * 1024, 1000, [['ID', 'int64'], ['fixed_amount', 'double']], ['ID']),
+        TableEntry('payments', 's3://raw/payments/*', 2, 1024, 5, [[f"c{i}", 'string'] for i in range(45)], []),
+    ]
+    assert format_catalog(tables, max_columns=3).splitlines() == [
+        "- fees: import from s3://raw/fees.parquet (1 file, 1000 rows, 2.0 MB); ID column: ID; "
+        "columns: ID int64, fixed_amount double",
+        "- payments: import from s3://raw/payments/* (2 files, 5 rows, 0.0 MB); ID column: none; "
+        "columns: c0 string, c1 string, c2 string, ... (42 more)",
+    ]
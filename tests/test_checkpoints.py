@@ -0,0 +1,193 @@
+import pytest
+
+from checkpoints import RunCheckpoint, detect_branches, is_transient_error
+from etl_agent_loop import resume_react_loop, run_react_loop
+from fakes import ScriptedLLM, FakeBauplanClient, FakeCodeExecutor
+from utils import ExecutorResponse, parse_response
+
+
+STEP = (
+    "<reasoning>Work on the branch</reasoning><packages>bauplan</packages>"
+    "<code>import bauplan\ntry:\n    client = bauplan.Client()\n    print('working')\nexcept Exception as e:\n    print(e)</code>"
+)
+
+
+def _failed_run(tmp_path, client, on_run, prompt_variables=None):
+    # a run which never gets to <done>: its branches are deleted at the end
+    (tmp_path / 'etl_agent').mkdir(exist_ok=True)
+    run_react_loop(
+        templated_user_input="ETL from {s3_raw_bucket}",
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        model_name='fake/model',
+        max_tokens=1000,
+        temperature=0.2,
+        eb2_api_key='fake',
+        system_prompt='fake system prompt',
+        max_iterations=2,
+        llm_folder=str(tmp_path),
+        executor=FakeCodeExecutor(on_run=on_run),
+        completion_fn=ScriptedLLM([STEP, STEP]),
+        bauplan_client=client,
+        prompt_variables=prompt_variables
+    )
+    return RunCheckpoint.load(str(tmp_path / 'checkpoints'))
+
+
+def test_branches_in_the_output_are_not_deleted(tmp_path):
+    client = FakeBauplanClient()
+    client.create_branch('fake_user.production_copy')
+
+    def on_run(code, packages):
+        return ExecutorResponse(result=[], stdout=["fake_user.production_copy has 10 tables\n"], stderr=[], error=None)
+
+    checkpoint = _failed_run(tmp_path, client, on_run)
+    assert checkpoint.data['status'] == 'failed' and checkpoint.branches == []
+    assert client.has_branch('fake_user.production_copy')
+
+
+def test_branches_created_at_runtime_are_deleted(tmp_path):
+    client = FakeBauplanClient()
+    client.create_branch('fake_user.before_the_run')
+
+    def on_run(code, packages):
+        # a name built at runtime, e.g. from client.info() and a timestamp
+        if not client.has_branch('fake_user.etl_1234'):
+            client.create_branch('fake_user.etl_1234')
+        return ExecutorResponse(result=[], stdout=[], stderr=[], error=None)
+
+    checkpoint = _failed_run(tmp_path, client, on_run)
+    assert not client.has_branch('fake_user.etl_1234')
+    assert client.has_branch('fake_user.before_the_run')
+    assert checkpoint.branches == []
+
+
+def test_runs_with_an_assigned_branch_do_not_claim_new_branches(tmp_path):
+    client = FakeBauplanClient()
+
+    def on_run(code, packages):
+        # a sibling run, on the same user, creates its own branch at the same time
+        for branch in ('fake_user.assigned', 'fake_user.sibling'):
+            if not client.has_branch(branch):
+                client.create_branch(branch)
+        return ExecutorResponse(result=[], stdout=[], stderr=[], error=None)
+
+    _failed_run(tmp_path, client, on_run, prompt_variables={'branch_name': 'fake_user.assigned'})
+    assert not client.has_branch('fake_user.assigned')
+    assert client.has_branch('fake_user.sibling')
+
+
+NEXT_STEP = (
+    "<reasoning>Import the files in the branch</reasoning><packages>bauplan</packages>"
+    "<code>import bauplan\ntry:\n    client = bauplan.Client()\n    print('importing')\nexcept Exception as e:\n    print(e)</code>"
+)
+
+
+def _interrupted_run(tmp_path, client, interrupt_at: int):
+    # the process dies while executing the code of iteration interrupt_at: after the response was received
+    (tmp_path / 'etl_agent').mkdir(exist_ok=True)
+    calls = []
+
+    def on_run(code, packages):
+        calls.append(code)
+        if len(calls) == interrupt_at + 1:
+            raise KeyboardInterrupt
+        # a name built at runtime, e.g. from client.info() and a timestamp
+        client.create_branch('fake_user.etl_1234')
+        return ExecutorResponse(result=[], stdout=['branch created\n'], stderr=[], error=None)
+
+    with pytest.raises(KeyboardInterrupt):
+        run_react_loop(
+            templated_user_input="ETL from {s3_raw_bucket}",
+            s3_raw_bucket='s3://raw',
+            bauplan_api_key='fake',
+            model_name='fake/model',
+            max_tokens=1000,
+            temperature=0.2,
+            eb2_api_key='fake',
+            system_prompt='fake system prompt',
+            max_iterations=4,
+            llm_folder=str(tmp_path),
+            executor=FakeCodeExecutor(on_run=on_run),
+            completion_fn=ScriptedLLM([STEP, NEXT_STEP]),
+            bauplan_client=client
+        )
+    checkpoint = RunCheckpoint.load(str(tmp_path / 'checkpoints'))
+    assert checkpoint.data['status'] == 'running' and checkpoint.branches == ['fake_user.etl_1234']
+    return checkpoint
+
+
+def _resume(tmp_path, client, llm, executor):
+    return resume_react_loop(
+        checkpoint_folder=str(tmp_path / 'checkpoints'),
+        bauplan_api_key='fake',
+        eb2_api_key='fake',
+        executor=executor,
+        completion_fn=llm,
+        bauplan_client=client
+    )
+
+
+def test_resume_executes_the_pending_response(tmp_path):
+    client = FakeBauplanClient()
+    checkpoint = _interrupted_run(tmp_path, client, interrupt_at=1)
+    assert checkpoint.pending_response(1) == NEXT_STEP
+    llm = ScriptedLLM(["<done>Temporary branch name: fake_user.etl_1234</done>"])
+    executor = FakeCodeExecutor(on_run=lambda code, packages: ExecutorResponse(
+        result=[], stdout=[f"{len(client.get_branches(user='fake_user'))} branches\n"], stderr=[], error=None
+    ))
+    answer = _resume(tmp_path, client, llm, executor)
+    assert answer == "<done>Temporary branch name: fake_user.etl_1234</done>"
+    # the response of the model is executed, without asking it again: the only call is the next step
+    assert [c['code'] for c in executor.calls] == [parse_response(NEXT_STEP).code]
+    assert len(llm.calls) == 1 and NEXT_STEP in [m['content'] for m in llm.calls[0]['messages']]
+    resumed = RunCheckpoint.load(str(tmp_path / 'checkpoints'))
+    assert resumed.data['status'] == 'done' and resumed.pending_response(1) is None
+    assert resumed.branches == ['fake_user.etl_1234'] and client.has_branch('fake_user.etl_1234')
+
+
+def test_resume_tells_the_model_which_branches_exist(tmp_path):
+    client = FakeBauplanClient()
+    _interrupted_run(tmp_path, client, interrupt_at=1)
+    # the pending response is lost, and one of the branches is gone too
+    checkpoint = RunCheckpoint.load(str(tmp_path / 'checkpoints'))
+    checkpoint.data['pending_response'] = None
+    checkpoint.add_branches(['fake_user.deleted_meanwhile'])
+    llm = ScriptedLLM([NEXT_STEP, "<done>Temporary branch name: fake_user.etl_1234</done>"])
+    executor = FakeCodeExecutor()
+    assert _resume(tmp_path, client, llm, executor) is not None
+    note = llm.calls[0]['messages'][-1]['content']
+    assert "resumed in a NEW sandbox session" in note
+    assert "still exist: fake_user.etl_1234." in note and 'deleted_meanwhile' not in note
+    assert len(executor.calls) == 1
+
+
+def test_detect_branches_reads_create_branch_literals():
+    code = (
+        "client.create_branch('fake_user.a', from_ref='main')\n"
+        "client.create_branch(branch='fake_user.b')\n"
+        "client.create_branch(f'fake_user.{suffix}')\n"
+        "print('fake_user.c')"
+    )
+    assert detect_branches(code) == {'fake_user.a', 'fake_user.b'}
+    assert detect_branches("not python (") == set()
+
+
+def _error(name, status_code=None):
+    error = type(name, (Exception,), {})("boom")
+    error.status_code = status_code
+    return error
+
+
+@pytest.mark.parametrize('error, transient', [
+    (_error('TimeoutException'), True),
+    (_error('RateLimitException'), True),
+    (_error('ConnectError'), True),
+    (_error('APIError', 503), True),
+    (_error('SandboxException'), False),
+    (_error('NotFoundException'), False),
+    (_error('APIError', 409), False),
+    (_error('ValueError'), False),
+])
+def test_transient_errors(error, transient):
+    assert is_transient_error(error) == transient
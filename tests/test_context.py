@@ -0,0 +1,82 @@
+from context import ContextManager, approx_tokens, compact_output
+from utils import ExecutorResponse
+
+
+PREFIX = [{'role': 'system', 'content': 'system prompt'}, {'role': 'user', 'content': 'the task'}]
+
+
+def _attempt(i, output='ok'):
+    return [
+        {'role': 'assistant', 'content': f"<reasoning>Attempt {i}</reasoning><code>print({i})\nprint({i})</code>"},
+        {'role': 'user', 'content': f"Result of attempt {i}: {output}"},
+    ]
+
+
+def _history(n, output='ok'):
+    return PREFIX + [m for i in range(n) for m in _attempt(i, output)]
+
+
+def test_repeated_lines_are_collapsed():
+    assert compact_output("start\nretry\nretry\nretry\nend") == "start\nretry  [repeated 3 times]\nend"
+    assert compact_output('') == '' and compact_output(None) is None
+
+
+def test_long_outputs_keep_their_head_and_tail():
+    text = "\n".join(f"line {i}" for i in range(1000))
+    compacted = compact_output(text, max_chars=1000, head_lines=3, tail_lines=5)
+    lines = compacted.splitlines()
+    assert lines[:3] == ['line 0', 'line 1', 'line 2'] and lines[-5:] == [f"line {i}" for i in range(995, 1000)]
+    assert lines[3] == '[... 992 lines omitted ...]'
+    # a few huge lines are cut in the middle instead
+    compacted = compact_output('x' * 5000 + "\n" + 'y' * 5000, max_chars=1000)
+    assert len(compacted) < 1100 and compacted.startswith('x' * 500) and compacted.endswith('y' * 500)
+    assert "characters omitted" in compacted
+
+
+def test_execution_results_are_compacted():
+    result = ExecutorResponse(result=None, stdout=['a\n'] * 500, stderr=[], error=None)
+    content = ContextManager(max_output_chars=200).format_execution_result(result)
+    assert "a  [repeated 500 times]" in content and content.endswith("Sandbox error if any: ")
+
+
+def test_history_within_the_budget_is_sent_as_is():
+    messages, budget = ContextManager(keep_last_attempts=3).build(_history(3))
+    assert messages == _history(3)
+    assert (budget.collapsed, budget.dropped) == (0, 0)
+    assert budget.total_tokens == budget.prefix_tokens + budget.history_tokens <= budget.budget
+
+
+def test_superseded_attempts_are_collapsed():
+    history = _history(3)
+    messages, budget = ContextManager(keep_last_attempts=1).build(history)
+    assert messages[:2] == PREFIX and messages[-2:] == history[-2:]
+    assert messages[2]['content'] == "<reasoning>Attempt 0</reasoning>\n[code of this superseded attempt omitted, 2 lines]"
+    assert messages[3] == history[3]
+    assert budget.collapsed == 4 and budget.dropped == 0
+    # the history itself is not modified
+    assert history == _history(3)
+
+
+def test_oldest_attempts_are_dropped_first():
+    history = _history(5, output='x' * 400)
+    manager = ContextManager(max_prompt_tokens=250, keep_last_attempts=5)
+    messages, budget = manager.build(history)
+    # the prefix is always kept, and the pairs are dropped from the oldest
+    assert messages[:2] == PREFIX and messages[2:] == history[-len(messages) + 2:]
+    assert budget.dropped == len(history) - len(messages) > 0 and budget.total_tokens <= 250
+    assert sum(manager._tokens(m) for m in messages) == budget.total_tokens
+    # the last attempt is kept even when it is over the budget on its own
+    messages, budget = ContextManager(max_prompt_tokens=10).build(history)
+    assert messages == PREFIX + history[-2:] and budget.total_tokens > 10
+
+
+def test_the_prefix_is_marked_cacheable():
+    messages, _ = ContextManager(cache_prefix=True).build(_history(1))
+    assert messages[0]['content'] == [{'type': 'text', 'text': 'system prompt', 'cache_control': {'type': 'ephemeral'}}]
+    assert PREFIX[0]['content'] == 'system prompt'
+
+
+def test_token_counter():
+    assert approx_tokens('') == 0 and approx_tokens('abcd') == 1 and approx_tokens('abcde') == 2
+    messages, budget = ContextManager(token_counter=len).build(_history(1))
+    assert budget.prefix_tokens == len('system prompt') + len('the task') + 8
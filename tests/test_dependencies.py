@@ -0,0 +1,84 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import dependencies
+from dependencies import (
+    DependencySet, WheelCache, canonical_name, normalize_packages, package_set_key, parse_freeze, pip_install_command
+)
+
+
+@pytest.mark.parametrize('packages, expected', [
+    (None, []),
+    ('', []),
+    ('bauplan, pyarrow', ['bauplan', 'pyarrow']),
+    # whitespace, case, duplicates (the last spelling wins) and standard library modules
+    ([' PyArrow ', 'bauplan', 'json', 'os', 'pyarrow>=14', ''], ['bauplan', 'pyarrow>=14']),
+    (['scikit_learn', 'Scikit-Learn==1.5'], ['scikit-learn==1.5']),
+    (['duckdb', 'bauplan==0.0.3a395'], ['bauplan==0.0.3a395', 'duckdb']),
+])
+def test_normalize_packages(packages, expected):
+    assert normalize_packages(packages) == expected
+
+
+def test_names_and_keys():
+    assert canonical_name('Typing_Extensions>=4') == 'typing-extensions' and canonical_name('>=1') == ''
+    assert package_set_key(['pyarrow', 'bauplan']) == package_set_key(['bauplan', 'pyarrow'])
+    assert package_set_key(['bauplan']) != package_set_key(['bauplan==0.0.3a395'])
+    assert parse_freeze("bauplan==0.0.3a395\nPyYAML==6.0\n\n") == {'bauplan', 'pyyaml'}
+
+
+def test_dependency_set_asks_only_for_what_is_missing():
+    deps = DependencySet()
+    # not inspected yet: everything is pending
+    assert deps.pending('pyarrow, bauplan') == ['bauplan', 'pyarrow']
+    deps.seed("pyarrow==17.0.0\n")
+    assert deps.pending('pyarrow, bauplan') == ['bauplan']
+    # a version constraint is left for pip to check
+    assert deps.pending(['pyarrow>=14']) == ['pyarrow>=14']
+    deps.mark_installed(['bauplan', 'pyarrow>=14'])
+    assert deps.pending('bauplan, pyarrow>=14, json') == [] and 'bauplan' in deps.installed
+
+
+def test_pip_install_command():
+    assert pip_install_command(['bauplan']) == ['python', '-m', 'pip', 'install', '-q', '--disable-pip-version-check', 'bauplan']
+    assert pip_install_command(['bauplan'], python_executable='py', find_links='/wheels')[-4:] == [
+        '--no-index', '--find-links', '/wheels', 'bauplan'
+    ]
+
+
+def _fake_pip_wheel(calls, returncode=0):
+    def run(command, **kwargs):
+        calls.append(command)
+        if returncode == 0:
+            folder = command[command.index('-w') + 1]
+            open(os.path.join(folder, 'fake-1.0-py3-none-any.whl'), 'w').close()
+        return subprocess.CompletedProcess(command, returncode, stdout='', stderr='no such package')
+    return run
+
+
+def test_wheel_cache_builds_each_package_set_once(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dependencies.subprocess, 'run', _fake_pip_wheel(calls))
+    cache = WheelCache(root=str(tmp_path), python_executable='py')
+    folder = cache.ensure(['bauplan', 'pyarrow'])
+    assert folder == str(tmp_path / package_set_key(['bauplan', 'pyarrow']))
+    assert calls == [['py', '-m', 'pip', 'wheel', '-q', '--disable-pip-version-check', '-w', folder, 'bauplan', 'pyarrow']]
+    # the same set, in any order, is served from the folder
+    assert cache.ensure(['pyarrow', 'bauplan']) == folder and len(calls) == 1
+    assert cache.ensure(['bauplan']) != folder and len(calls) == 2
+
+
+def test_wheel_cache_failures_are_not_cached(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dependencies.subprocess, 'run', _fake_pip_wheel(calls, returncode=1))
+    cache = WheelCache(root=str(tmp_path))
+    assert cache.ensure(['missing-package']) is None
+    assert cache.ensure(['missing-package']) is None and len(calls) == 2
+    assert not os.path.exists(os.path.join(cache.folder(['missing-package']), '.complete'))
+
+
+def test_wheel_cache_default_interpreter():
+    assert WheelCache().python_executable == sys.executable
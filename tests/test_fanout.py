@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+from fakes import FakeBauplanClient
+from fanout import _offline_agents, fan_out
+from verifier import EXPECTED_TABLES, verify_etl_process
+
+
+TABLES = [t.name for t in EXPECTED_TABLES]
+DELAYS = {'fast': 0.05, 'medium': 0.2, 'slow': 0.6}
+
+
+class FailingMergeClient(FakeBauplanClient):
+
+    def merge_branch(self, source_ref: str, into_branch: str = 'main'):
+        raise RuntimeError("merge conflict")
+
+
+def _client(cls=FakeBauplanClient):
+    return cls(schemas={t.name: t.expected_columns for t in EXPECTED_TABLES})
+
+
+def _fan_out(tmp_path, client, branches: dict, **kwargs):
+    # the scripted agents of the offline demo, recording the branch of each variant
+    client, run_agent, variants = _offline_agents(client=client, delays=DELAYS, llm_folder=str(tmp_path))
+
+    def recording_run_agent(variant, branch, stop_event):
+        branches[variant.name] = branch
+        return run_agent(variant, branch, stop_event)
+
+    return asyncio.run(fan_out(variants, recording_run_agent, client=client, **kwargs))
+
+
+def test_first_verified_candidate_wins(tmp_path):
+    client, start = _client(), time.perf_counter()
+    result = _fan_out(tmp_path, client, {}, provider_limits={'together_ai': 2})
+    returned = time.perf_counter() - start
+    assert result.winner.variant.name == 'fast'
+    # the winner is returned without waiting for the slower agents
+    assert result.time_to_first_verified < DELAYS['slow'] and returned < DELAYS['slow']
+    assert [c.variant.name for c in result.candidates] == ['fast']
+    assert all(client.has_table(t, ref='main') for t in TABLES)
+    # the others stop, and no candidate branch is left behind
+    result.cleanup.join(timeout=10)
+    assert not result.cleanup.is_alive() and set(client.branches) == {'main'}
+
+
+def test_unverified_candidate_does_not_win(tmp_path):
+    client, branches = _client(), {}
+    verify = lambda branch, client: branch != branches['fast'] and verify_etl_process(branch=branch, client=client)
+    result = _fan_out(tmp_path, client, branches, verify=verify)
+    assert result.winner.variant.name == 'medium'
+    assert [c.variant.name for c in result.candidates] == ['fast', 'medium']
+    result.cleanup.join(timeout=10)
+    assert set(client.branches) == {'main'}
+
+
+def test_no_winner_leaves_main_untouched(tmp_path):
+    client = _client()
+    result = _fan_out(tmp_path, client, {}, verify=lambda branch, client: False)
+    assert result.winner is None and result.time_to_first_verified is None
+    assert [c.variant.name for c in result.candidates] == ['fast', 'medium', 'slow']
+    assert not any(client.has_table(t, ref='main') for t in TABLES)
+    result.cleanup.join(timeout=10)
+    assert set(client.branches) == {'main'}
+
+
+def test_branches_are_deleted_when_the_merge_fails(tmp_path):
+    client, branches = _client(FailingMergeClient), {}
+    with pytest.raises(RuntimeError, match="merge conflict"):
+        _fan_out(tmp_path, client, branches)
+    assert set(branches) == {'fast', 'medium', 'slow'}
+    assert set(client.branches) == {'main'}
@@ -0,0 +1,169 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fakes import ScriptedLLM
+from llm import STOP_SEQUENCES, HTTPCompletion, HTTPCompletionError, stream_into_parser
+from utils import IncrementalResponseParser, ResponseFormatError, TruncatedResponseError
+
+
+CODE = "<reasoning>Print it</reasoning><packages>bauplan</packages><code>print('a < b')</code>"
+
+
+def _feed(chunks, **close_kwargs):
+    parser = IncrementalResponseParser()
+    finished = [parser.feed(c) for c in chunks]
+    return parser, finished, parser.close(**close_kwargs)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 16, len(CODE)])
+def test_tags_split_across_chunks(size):
+    parser, finished, response = _feed([CODE[i:i + size] for i in range(0, len(CODE), size)])
+    assert finished[-1] and not any(finished[:-1])
+    assert response.reasoning == 'Print it' and response.packages == ['bauplan'] and response.code == "print('a < b')"
+
+
+def test_sections_are_reported_as_they_close():
+    sections = []
+    parser = IncrementalResponseParser(on_section=lambda tag, content: sections.append(tag))
+    assert not parser.feed(CODE[:CODE.index('<code>')])
+    assert sections == ['reasoning', 'packages']
+    # anything after the closing tag is ignored
+    assert parser.feed(CODE[CODE.index('<code>'):] + "<code>other</code>")
+    assert sections == ['reasoning', 'packages', 'code'] and parser.close().code == "print('a < b')"
+
+
+def test_a_confirmed_stop_sequence_implies_the_closing_tag():
+    text = CODE[:-len('</code>')]
+    parser, _, response = _feed([text], stopped_by_sequence=True)
+    assert response.code == "print('a < b')" and parser.text == CODE
+
+
+def test_code_never_closed_is_not_executed():
+    # a natural end of the generation, e.g. the model forgot the tag, or the text was cut mid code
+    with pytest.raises(ResponseFormatError, match="never closed") as e:
+        _feed([CODE[:-len('</code>')]])
+    assert not isinstance(e.value, TruncatedResponseError)
+
+
+def test_truncated_response():
+    with pytest.raises(TruncatedResponseError):
+        _feed([CODE[:-20]], truncated=True)
+
+
+def test_missing_sections():
+    with pytest.raises(ResponseFormatError, match="missing the <reasoning>"):
+        _feed(["<code>print(1)</code>"])
+    _, _, response = _feed(["<done>42</done>"])
+    assert response.done and response.code is None
+
+
+@pytest.mark.parametrize('stop, finish_reason', [(None, 'stop'), (STOP_SEQUENCES, 'stop_sequence')])
+def test_stream_into_parser_cuts_after_the_closing_tag(stop, finish_reason):
+    # without stop sequences the closing tag is in the text, and we stop reading there: with them, the
+    # provider cuts before it and reports the one that matched
+    llm = ScriptedLLM([CODE + "\nmore text which is never read"], chunk_size=4)
+    parser = IncrementalResponseParser()
+    reason = stream_into_parser(llm, parser, model='fake/model', messages=[], max_tokens=1000, temperature=0.0, stop=stop)
+    assert reason == finish_reason
+    assert parser.close(stopped_by_sequence=reason == 'stop_sequence').code == "print('a < b')"
+
+
+def test_stream_into_parser_reports_a_natural_end_as_stop():
+    parser = IncrementalResponseParser()
+    reason = stream_into_parser(ScriptedLLM([CODE[:-len('</code>')]]), parser, 'fake/model', [], 1000, 0.0, stop=STOP_SEQUENCES)
+    assert reason == 'stop'
+    with pytest.raises(ResponseFormatError):
+        parser.close(stopped_by_sequence=reason == 'stop_sequence')
+
+
+def test_stream_into_parser_reports_the_token_limit():
+    parser = IncrementalResponseParser()
+    reason = stream_into_parser(ScriptedLLM([CODE]), parser, 'fake/model', [], max_tokens=10, temperature=0.0)
+    assert reason == 'length'
+    with pytest.raises(TruncatedResponseError):
+        parser.close(truncated=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # answers like an OpenAI compatible server, with what the test put in server.reply
+
+    def do_POST(self):
+        self.server.requests.append((self.headers.get('Authorization'), json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+        status, headers, body = self.server.reply
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.requests, server.reply = [], None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def _sse(events):
+    return ''.join(f"data: {e if isinstance(e, str) else json.dumps(e)}\n\n" for e in events)
+
+
+def test_http_completion(server):
+    server.reply = (200, {'Content-Type': 'application/json'}, json.dumps({
+        'choices': [{'message': {'content': 'hello'}, 'finish_reason': 'stop', 'stop_reason': '</done>'}],
+        'usage': {'prompt_tokens': 3, 'completion_tokens': 1}
+    }))
+    messages = [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi', 'cache_control': {'type': 'ephemeral'}}]}]
+    response = HTTPCompletion(base_url=_url(server), api_key='secret')(
+        model='local-model', messages=messages, max_tokens=10, stop=STOP_SEQUENCES
+    )
+    choice = response.choices[0]
+    assert (choice.message.content, choice.finish_reason, choice.stop_reason) == ('hello', 'stop', '</done>')
+    assert response.usage == {'prompt_tokens': 3, 'completion_tokens': 1}
+    authorization, payload = server.requests[0]
+    assert authorization == 'Bearer secret'
+    assert payload == {
+        'model': 'local-model', 'messages': [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}],
+        'stream': False, 'max_tokens': 10, 'stop': STOP_SEQUENCES
+    }
+
+
+def test_http_completion_streams_into_the_parser(server):
+    text = CODE[:-len('</code>')]
+    chunks = [text[i:i + 10] for i in range(0, len(text), 10)]
+    events = [{'choices': [{'delta': {'content': c}, 'finish_reason': None}]} for c in chunks]
+    events += [{'choices': [{'delta': {}, 'finish_reason': 'stop', 'stop_reason': '</code>'}]}, {'choices': []}, '[DONE]']
+    server.reply = (200, {'Content-Type': 'text/event-stream'}, ": keep-alive\n\n" + _sse(events))
+    parser = IncrementalResponseParser()
+    # the provider prefix is dropped from the model sent to the endpoint
+    reason = stream_into_parser(
+        HTTPCompletion(base_url=_url(server)), parser, 'together_ai/fake-model', [{'role': 'user', 'content': 'hi'}],
+        1000, 0.0, stop=STOP_SEQUENCES
+    )
+    assert reason == 'stop_sequence' and parser.close(stopped_by_sequence=True).code == "print('a < b')"
+    assert server.requests[0][1]['model'] == 'fake-model' and server.requests[0][1]['stream']
+
+
+def test_http_completion_errors(server):
+    server.reply = (429, {'Retry-After': '7'}, 'slow down')
+    with pytest.raises(HTTPCompletionError) as e:
+        HTTPCompletion(base_url=_url(server))(model='local-model', messages=[])
+    assert (e.value.status_code, e.value.retry_after) == (429, 7.0) and 'slow down' in str(e.value)
+    server.shutdown()
+    server.server_close()
+    with pytest.raises(ConnectionError):
+        HTTPCompletion(base_url=_url(server), timeout=2.0)(model='local-model', messages=[])
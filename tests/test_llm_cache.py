@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from etl_agent_loop import run_react_loop
+from fakes import ScriptedLLM, FakeCodeExecutor
+from llm_cache import CachedCompletion, CachedExecutor, CacheMissError, CompletionCache
+from utils import ExecutorResponse
+
+
+RESPONSES = [
+    "<reasoning>Create a branch</reasoning><packages>bauplan</packages>"
+    "<code>try:\n    print('branch')\nexcept Exception as e:\n    print(e)</code>",
+    "<reasoning>Import the files</reasoning><packages>bauplan</packages>"
+    "<code>try:\n    print('import')\nexcept Exception as e:\n    print(e)</code>",
+    "<done>Temporary branch name: fake_user.etl</done>"
+]
+
+
+def _timestamped_run(code, packages):
+    # like the real code: the branch name has a timestamp, so the output changes at every run
+    return ExecutorResponse(result=[], stdout=[f"fake_user.etl_{time.time_ns()}\n"], stderr=[], error=None)
+
+
+def _run(tmp_path, completion_fn, executor):
+    (tmp_path / 'etl_agent').mkdir(exist_ok=True)
+    return run_react_loop(
+        templated_user_input="ETL from {s3_raw_bucket}",
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        model_name='fake/model',
+        max_tokens=1000,
+        temperature=0.2,
+        eb2_api_key='fake',
+        system_prompt='fake system prompt',
+        max_iterations=5,
+        llm_folder=str(tmp_path),
+        executor=executor,
+        completion_fn=completion_fn
+    )
+
+
+def test_recorded_run_replays_without_provider_or_sandbox(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'cache.sqlite'))
+    sandbox = FakeCodeExecutor(on_run=_timestamped_run)
+    recorded = _run(tmp_path, CachedCompletion(ScriptedLLM(RESPONSES), cache, mode='record'), CachedExecutor(sandbox, cache, mode='record'))
+    assert recorded is not None and len(sandbox.calls) == 2
+
+    provider = ScriptedLLM([RuntimeError("no calls to the provider in replay")])
+    completion_fn = CachedCompletion(provider, cache, mode='replay')
+    executor = CachedExecutor(None, cache, mode='replay')
+    assert _run(tmp_path, completion_fn, executor) == recorded
+    assert provider.calls == [] and completion_fn.misses == 0
+    assert executor.hits == 2 and executor.misses == 0
+
+
+def test_replay_fails_on_unrecorded_execution(tmp_path):
+    executor = CachedExecutor(None, CompletionCache(str(tmp_path / 'cache.sqlite')), mode='replay')
+    with pytest.raises(CacheMissError):
+        executor.run_code("print('never recorded')")
+
+
+def test_repeated_code_replays_each_recorded_output(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'cache.sqlite'))
+    outputs = iter(['first\n', 'second\n'])
+    recorder = CachedExecutor(
+        FakeCodeExecutor(on_run=lambda code, packages: ExecutorResponse(result=[], stdout=[next(outputs)], stderr=[], error=None)),
+        cache, mode='record'
+    )
+    assert [recorder.run_code("print(1)").stdout for _ in range(2)] == [['first\n'], ['second\n']]
+    replayer = CachedExecutor(None, cache, mode='replay')
+    assert [replayer.run_code("print(1)").stdout for _ in range(2)] == [['first\n'], ['second\n']]
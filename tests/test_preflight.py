@@ -0,0 +1,73 @@
+import inspect
+
+import pytest
+
+from preflight import BAUPLAN_CLIENT_METHODS, Preflight, bauplan_client_methods
+
+
+def _kinds(code, packages=('bauplan',)):
+    return [i.kind for i in Preflight(client_methods=BAUPLAN_CLIENT_METHODS).check(code, list(packages))]
+
+
+@pytest.mark.parametrize('code', [
+    "import bauplan\ntry:\n    client = bauplan.Client()\n    print(client.info())\nexcept Exception as e:\n    print(e)",
+    # the client created before the block
+    "import bauplan\nclient = bauplan.Client()\ntry:\n    print(client.info())\nexcept Exception as e:\n    print(e)",
+    # a __main__ guard
+    "import bauplan\nif __name__ == '__main__':\n    try:\n        bauplan.Client().info()\n    except Exception as e:\n        print(e)",
+    # the block in a function called at the top level, or in the guard
+    "import bauplan\ndef main():\n    client = bauplan.Client()\n    try:\n        return client.info()\n    except Exception as e:\n        print(e)\nmain()",
+    "import bauplan\ndef main():\n    try:\n        bauplan.Client().info()\n    except Exception as e:\n        print(e)\nif __name__ == '__main__':\n    main()",
+    # literal constants, and the value of the cell after the block
+    "import bauplan\nTABLES = ['fees', 'payments']\nURIS = {'fees': 's3://raw/fees.json'}\nbranch = None\n"
+    "try:\n    branch = bauplan.Client().create_branch('u.etl', from_ref='main')\nexcept Exception as e:\n    print(e)\nbranch",
+    "import bauplan\ntry:\n    result = bauplan.Client().info()\nexcept Exception as e:\n    result = None\nresult.user",
+])
+def test_accepted_shapes(code):
+    assert _kinds(code) == []
+
+
+@pytest.mark.parametrize('code, line', [
+    ("import bauplan\nclient = bauplan.Client()\nclient.info()", None),
+    ("import bauplan\ndef main():\n    bauplan.Client().info()\nmain()", None),
+    ("import bauplan\nprint('start')\ntry:\n    bauplan.Client().info()\nexcept Exception as e:\n    print(e)", 2),
+    ("try:\n    print(1)\nexcept Exception as e:\n    print(e)\nif __name__ == '__main__':\n    print(2)", 6),
+    # only the last line is the value of the cell, and only a name is
+    ("import bauplan\nbranch = 'u.etl'\nbranch\ntry:\n    print(branch)\nexcept Exception as e:\n    print(e)", 3),
+    ("try:\n    print(1)\nexcept Exception as e:\n    print(e)\nTABLES = [len('a')]", 5),
+])
+def test_rejected_shapes(code, line):
+    issues = Preflight(client_methods=BAUPLAN_CLIENT_METHODS).check(code, ['bauplan'])
+    assert [(i.line, i.kind) for i in issues] == [(line, 'shape')]
+
+
+@pytest.mark.parametrize('call, ok', [
+    ("client.merge_branch(source_ref='b', into_branch='main', message='etl', properties={'run': '1'})", True),
+    ("client.create_table(table='t', search_uri='s3://raw/t.parquet', branch='b', debug=True)", True),
+    ("client.import_data(table='t', search_uri='s3://raw/t.parquet', branch='b', debug=True)", True),
+    ("client.query(query='SELECT 1', ref='main', debug=True)", True),
+    ("client.list_jobs(all_users=False)", True),
+    ("client.create_branch(branch='b', from_ref='main', if_not_exists=True)", False),
+    ("client.delete_branch(branch='b', if_exists=True)", False),
+    ("client.rename_branch('b', 'c')", False),
+])
+def test_client_calls_in_the_pinned_version(call, ok):
+    code = f"import bauplan\ntry:\n    client = bauplan.Client()\n    {call}\nexcept Exception as e:\n    print(e)"
+    assert (_kinds(code) == []) == ok
+
+
+def test_client_methods_come_from_the_installed_client():
+    bauplan = pytest.importorskip('bauplan')
+    methods = bauplan_client_methods()
+    public = {name for name, _ in inspect.getmembers(bauplan.Client, callable) if not name.startswith('_')}
+    assert set(methods) == public
+    assert all(kwargs is None or 'self' not in kwargs for kwargs in methods.values())
+
+
+@pytest.mark.parametrize('module, ok', [
+    ('pandas', True), ('numpy', True), ('requests', True), ('pyarrow', True), ('sklearn', True),
+    ('polars', False), ('missing_module', False),
+])
+def test_imports_of_the_sandbox_image_need_no_packages(module, ok):
+    code = f"import {module}\ntry:\n    print({module})\nexcept Exception as e:\n    print(e)"
+    assert (_kinds(code, packages=()) == []) == ok
@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+
+import boto3
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+from prepare_cloud_setup import LAYOUTS, RAW_FILES, ConversionOptions, csv_to_parquet, json_to_parquet, main
+
+
+BUCKET = 'raw-data'
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'setup', 'data')
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with mock_aws():
+        yield boto3.client('s3')
+
+
+@pytest.fixture
+def raw_folder(tmp_path):
+    # the small raw files of the repo, and a few payments over two years
+    for name in RAW_FILES:
+        if name != 'payments.csv':
+            shutil.copy(os.path.join(DATA_FOLDER, name), tmp_path / name)
+    rows = [
+        f"{i},{year},{day},merchant_{i % 3},{'GlobalCard' if i % 2 else 'NexPay'},{i * 1.5}"
+        for i, (year, day) in enumerate([(2023, 1), (2023, 40), (2023, 100), (2024, 1), (2024, 200)] * 4)
+    ]
+    (tmp_path / 'payments.csv').write_text(
+        "psp_reference,year,day_of_year,merchant,card_scheme,eur_amount\n" + "\n".join(rows) + "\n"
+    )
+    return tmp_path
+
+
+def _keys(s3) -> list:
+    return sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+
+def _run(s3, raw_folder, layouts):
+    main(BUCKET, str(raw_folder), s3_client=s3, manifest_path=str(raw_folder / 'manifest.json'), layouts=layouts)
+
+
+def test_switching_layouts_prunes_the_other_layout(s3, raw_folder):
+    _run(s3, raw_folder, LAYOUTS)
+    partitioned = [k for k in _keys(s3) if k.startswith('payments/')]
+    assert len(partitioned) > 1 and 'payments.parquet' not in _keys(s3)
+
+    _run(s3, raw_folder, {})
+    assert 'payments.parquet' in _keys(s3)
+    assert not any(k.startswith('payments/') for k in _keys(s3))
+
+    _run(s3, raw_folder, LAYOUTS)
+    assert 'payments.parquet' not in _keys(s3)
+    assert [k for k in _keys(s3) if k.startswith('payments/')] == partitioned
+    # the other tables are never touched
+    assert {'acquirer_countries.parquet', 'fees.parquet', 'merchant_data.parquet', 'merchant_category_codes.parquet'} <= set(_keys(s3))
+
+
+def _from_pylist(data_folder, json_file_name):
+    # the conversion before streaming: the whole array in Python objects
+    with open(os.path.join(data_folder, json_file_name)) as f:
+        return pa.Table.from_pylist(json.load(f))
+
+
+def _assert_same_table(parquet_path, expected):
+    converted = pq.read_table(parquet_path)
+    assert converted.schema == expected.schema
+    assert converted.num_rows == expected.num_rows
+    assert converted.to_pylist() == expected.to_pylist()
+
+
+@pytest.mark.parametrize('name', ['fees.json', 'merchant_data.json'])
+def test_streamed_json_matches_from_pylist(tmp_path, name):
+    shutil.copy(os.path.join(DATA_FOLDER, name), tmp_path / name)
+    # small blocks and row groups, so that the file is read and written in many pieces
+    options = ConversionOptions(row_group_size=100, block_size=64 * 1024)
+    _assert_same_table(json_to_parquet(str(tmp_path), name, options), _from_pylist(str(tmp_path), name))
+
+
+def test_streamed_json_with_tricky_strings(tmp_path):
+    rows = [
+        {'ID': i, 'name': f'brackets ] [ {{ }} and "quotes" \\ {i}', 'rate': i / 3, 'tags': ['a', 'b'][:i % 3], 'note': None}
+        for i in range(500)
+    ]
+    rows[3]['note'] = 'line\nbreak'
+    (tmp_path / 'tricky.json').write_text(json.dumps(rows, indent=2))
+    options = ConversionOptions(row_group_size=64, block_size=4 * 1024)
+    _assert_same_table(json_to_parquet(str(tmp_path), 'tricky.json', options), _from_pylist(str(tmp_path), 'tricky.json'))
+
+
+def test_streamed_csv_matches_read_csv(tmp_path):
+    name = 'merchant_category_codes.csv'
+    shutil.copy(os.path.join(DATA_FOLDER, name), tmp_path / name)
+    expected = pv.read_csv(str(tmp_path / name))
+    _assert_same_table(csv_to_parquet(str(tmp_path), name, ConversionOptions(row_group_size=50, block_size=16 * 1024)), expected)
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from etl_agent_loop import run_react_loop
+from fakes import ScriptedLLM, ScriptedModels, FakeCodeExecutor
+from routing import ModelRouter, ModelTier, TurnOutcome, error_class, summarize_log
+from utils import ExecutorResponse
+
+
+BROKEN = (
+    "<reasoning>Import the files</reasoning><packages>bauplan</packages>"
+    "<code>try:\n    print(TABLES['payments'])\nexcept Exception as e:\n    raise</code>"
+)
+FIXED = (
+    "<reasoning>Import the files, properly</reasoning><packages>bauplan</packages>"
+    "<code>try:\n    print('imported')\nexcept Exception as e:\n    print(e)</code>"
+)
+TIERS = [ModelTier('cheap', 'fake/cheap', 0.2, 1000), ModelTier('strong', 'fake/strong', 0.7, 1000)]
+
+
+def _on_run(code, packages):
+    if 'TABLES' in code:
+        return ExecutorResponse(result=[], stdout=[], stderr=[], error="NameError: name 'TABLES' is not defined")
+    return ExecutorResponse(result=[], stdout=['imported\n'], stderr=[], error=None)
+
+
+def test_run_escalates_when_the_cheap_model_is_stuck(tmp_path):
+    # a cheap scripted model which cannot fix its code (an undefined name), and a strong one which can
+    (tmp_path / 'etl_agent').mkdir()
+    log_path = str(tmp_path / 'routing.jsonl')
+    models = ScriptedModels({
+        'fake/cheap': ScriptedLLM([FIXED, BROKEN, BROKEN, BROKEN]),
+        'fake/strong': ScriptedLLM([FIXED, "<done>Temporary branch name: fake_user.etl</done>"])
+    })
+    answer = run_react_loop(
+        templated_user_input="ETL from {s3_raw_bucket}",
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        model_name='fake/cheap',
+        max_tokens=1000,
+        temperature=0.2,
+        eb2_api_key='fake',
+        system_prompt='fake system prompt',
+        max_iterations=6,
+        llm_folder=str(tmp_path),
+        executor=FakeCodeExecutor(on_run=_on_run),
+        completion_fn=models,
+        router=ModelRouter(TIERS, log_path=log_path)
+    )
+    assert answer is not None
+    with open(log_path) as f:
+        decisions = [(row['tier'], row['reason'], row['outcome']) for row in map(json.loads, f)]
+    assert decisions == [
+        ('cheap', 'first_draft', 'executed'),
+        ('cheap', 'progress', 'execution_error'),
+        ('cheap', 'small_repair', 'execution_error'),
+        ('strong', 'escalate:failures:2', 'executed'),
+        ('strong', 'progress', 'done'),
+    ]
+    summary = summarize_log(log_path)
+    assert summary['runs'] == 1 and summary['successful_runs'] == 1
+    assert summary['successful_turns_by_tier'] == {'cheap': 0.6, 'strong': 0.4}
+    assert summary['by_tier_and_reason']['cheap/small_repair']['success_rate'] == 0.0
+
+
+@pytest.mark.parametrize('turns, tier, reason', [
+    ([], 'cheap', 'first_draft'),
+    ([TurnOutcome('cheap', 'executed', None)], 'cheap', 'progress'),
+    ([TurnOutcome('cheap', 'execution_error', 'KeyError: x')], 'cheap', 'small_repair'),
+    # errors small models rarely fix, and long tracebacks, escalate at once
+    ([TurnOutcome('cheap', 'execution_error', 'BauplanError: no table')], 'strong', 'escalate:error_class:BauplanError'),
+    ([TurnOutcome('cheap', 'execution_error', 'Traceback\n' * 40 + 'KeyError: x')], 'strong', 'escalate:long_traceback'),
+    # transient errors are not the model's fault
+    ([TurnOutcome('cheap', 'execution_error', 'KeyError: x'), TurnOutcome('cheap', 'transient_error', 'Timeout')], 'cheap', 'small_repair'),
+    # escalation is sticky, and there is nothing above the top tier
+    ([TurnOutcome('strong', 'executed', None), TurnOutcome('strong', 'executed', None)], 'strong', 'progress'),
+    ([TurnOutcome('strong', 'preflight_rejected', None)] * 2, 'strong', 'top_tier:failures:2'),
+])
+def test_route(turns, tier, reason):
+    decision = ModelRouter(TIERS).route(turns)
+    assert (decision.tier, decision.reason) == (tier, reason)
+
+
+def test_single_router_always_picks_the_same_model():
+    router = ModelRouter.single('fake/model', 0.2, 1000)
+    decision = router.route([TurnOutcome('default', 'execution_error', 'BauplanError: boom')] * 3)
+    assert decision.model_name == 'fake/model' and decision.reason.startswith('top_tier')
+
+
+def test_error_class():
+    assert error_class("Traceback:\n  ValueError: bad\nDuring handling...\nKeyError: 'x'") == 'KeyError'
+    assert error_class("pyarrow.lib.ArrowInvalid: cannot cast") == 'ArrowInvalid'
+    assert error_class("no class here") is None and error_class(None) is None
@@ -0,0 +1,91 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from s3_sync import S3Sync, SyncManifest
+
+
+MB = 1024 * 1024
+BUCKET = 'raw-data'
+
+
+class CountingClient:
+    """
+    A boto3 S3 client counting the uploads, and failing the upload of the given part numbers.
+    """
+
+    def __init__(self, client, fail_parts: set = None):
+        self.client = client
+        self.fail_parts = set(fail_parts or [])
+        self.put_objects = 0
+        self.uploaded_parts = []
+
+    def put_object(self, **kwargs):
+        self.put_objects += 1
+        return self.client.put_object(**kwargs)
+
+    def upload_part(self, **kwargs):
+        if kwargs['PartNumber'] in self.fail_parts:
+            raise ConnectionError(f"Connection lost while uploading part {kwargs['PartNumber']}")
+        self.uploaded_parts.append(kwargs['PartNumber'])
+        return self.client.upload_part(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _file(folder, name: str, size: int) -> str:
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def _sync(client, tmp_path) -> S3Sync:
+    # 5MB parts: a 12MB file is uploaded in 3 parts
+    return S3Sync(
+        client, BUCKET, manifest=SyncManifest(str(tmp_path / 'manifest.json')),
+        multipart_threshold=5 * MB, part_size=5 * MB, max_part_workers=1
+    )
+
+
+def test_second_run_skips_everything(s3, tmp_path):
+    files = {
+        _file(tmp_path, 'fees.json', 1000): 'fees.parquet',
+        _file(tmp_path, 'merchants.json', 2000): 'merchants.parquet',
+        _file(tmp_path, 'payments.csv', 12 * MB): 'payments.parquet'
+    }
+    first = _sync(s3, tmp_path).sync(files)
+    assert [r.action for r in first] == ['uploaded'] * 3
+    client = CountingClient(s3)
+    second = _sync(client, tmp_path).sync(files)
+    assert [r.action for r in second] == ['skipped'] * 3
+    assert client.put_objects == 0 and client.uploaded_parts == []
+
+
+def test_failed_multipart_upload_resumes_from_the_missing_part(s3, tmp_path):
+    path = _file(tmp_path, 'payments.csv', 12 * MB)
+    failing = CountingClient(s3, fail_parts={3})
+    with pytest.raises(ConnectionError):
+        _sync(failing, tmp_path).sync({path: 'payments.parquet'})
+    assert failing.uploaded_parts == [1, 2]
+
+    client = CountingClient(s3)
+    [result] = _sync(client, tmp_path).sync({path: 'payments.parquet'})
+    assert result.action == 'resumed'
+    assert client.uploaded_parts == [3]
+    with open(path, 'rb') as f:
+        assert s3.get_object(Bucket=BUCKET, Key='payments.parquet')['Body'].read() == f.read()
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+import sandbox
+from dependencies import package_set_key
+from sandbox import LocalSession, PooledCodeExecutor, SandboxPool, e2b_pooled_executor
+
+
+class _Session:
+    # a session whose warm packages cannot be installed
+
+    def __init__(self):
+        self.closed = False
+        sessions.append(self)
+
+    def install(self, python_packages):
+        return f"Could not install {', '.join(python_packages)}"
+
+    def run_code(self, code):
+        raise AssertionError("the warm-up code runs only after the install")
+
+    def is_healthy(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+sessions = []
+
+
+def test_sessions_whose_warm_packages_fail_are_discarded(capsys):
+    sessions.clear()
+    pool = SandboxPool(session_factory=_Session, size=1, warm_packages=['missing-package'], warmup_code='import bauplan')
+    with pytest.raises(RuntimeError, match="Could not install missing-package"):
+        pool.acquire()
+    pool.close()
+    assert len(sessions) == 2 and all(s.closed for s in sessions)
+    assert "Could not warm up a sandbox: Could not install missing-package" in capsys.readouterr().out
+
+
+def test_e2b_templates_are_keyed_by_package_set(monkeypatch):
+    templates = []
+
+    class RecordingSession(_Session):
+        def __init__(self, api_key, envs=None, template=None):
+            templates.append(template)
+            super().__init__()
+
+        def install(self, python_packages):
+            return None
+
+    monkeypatch.setattr(sandbox, 'E2BSession', RecordingSession)
+    executor = e2b_pooled_executor('fake', warm_packages=['pyarrow', 'bauplan'], template='etl-agent-{key}')
+    executor.pool.acquire().close()
+    executor.close()
+    assert templates == [f"etl-agent-{package_set_key(['bauplan', 'pyarrow'])}"]
+
+
+def _wait(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def local_pool():
+    pools = []
+
+    def build(**kwargs):
+        pools.append(SandboxPool(session_factory=LocalSession, **kwargs))
+        return pools[-1]
+
+    yield build
+    for pool in pools:
+        pool.close()
+
+
+def test_acquire_and_release(local_pool):
+    pool = local_pool(size=1, refill=False, warmup_code="import json\nwarm = True")
+    session = pool.acquire()
+    assert session.run_code("warm").result == ['True']
+    pool.release(session)
+    assert pool.acquire() is session
+    # a dead session is not taken back, and not handed out
+    session.close()
+    pool.release(session)
+    assert pool._idle.empty()
+
+
+def test_the_pool_refills_after_sessions_are_taken(local_pool):
+    pool = local_pool(size=2)
+    first = pool.acquire()
+    _wait(lambda: pool._idle.qsize() == 2)
+    second = pool.acquire()
+    assert second is not first and second.is_healthy()
+    first.close()
+    second.close()
+    # sessions which died while idle are discarded, and replaced
+    for session in list(pool._idle.queue):
+        session.close()
+    assert pool.acquire().is_healthy()
+
+
+def test_closing_while_sessions_warm_up():
+    started, sessions = threading.Event(), []
+
+    def slow_session():
+        started.set()
+        time.sleep(0.3)
+        sessions.append(LocalSession())
+        return sessions[-1]
+
+    pool = SandboxPool(session_factory=slow_session, size=2)
+    assert started.wait(5)
+    pool.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        pool.acquire()
+    # the sessions which were warming up are closed when they are ready, not left running
+    _wait(lambda: len(sessions) == 2 and all(s.proc.poll() is not None for s in sessions))
+    assert pool._warming == 0 and pool._idle.empty()
+
+
+def test_state_persists_across_run_code(local_pool):
+    executor = PooledCodeExecutor(local_pool(size=1, refill=False))
+    try:
+        assert executor.run_code("import json\nrows = [1, 2]").error is None
+        response = executor.run_code("print(json.dumps(rows))\nrows.append(3)\nlen(rows)")
+        assert response.stdout == ['[1, 2]\n'] and response.result == ['3'] and response.error is None
+        assert executor.run_code("missing_name").error.startswith("NameError")
+        # a session which dies is replaced: the state is lost, not the run
+        executor.session.proc.kill()
+        executor.session.proc.wait()
+        assert executor.run_code("'rows' in globals()").result == ['False']
+    finally:
+        executor.close()
+    assert executor.session is None
@@ -0,0 +1,114 @@
+import json
+import urllib.request
+
+import pytest
+
+import tracing
+from etl_agent_loop import run_react_loop
+from fakes import ScriptedLLM, FakeCodeExecutor
+from tracing import InMemorySpanExporter, JsonlSpanExporter, MetricsRegistry, Tracer, configure_tracing
+from utils import ExecutorResponse
+
+
+def test_spans_nest_and_keep_their_attributes():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporters=[exporter])
+    with tracer.span('agent.run', model='fake/model') as run:
+        with tracer.span('agent.iteration', iteration=1) as iteration:
+            with tracer.span('llm.completion') as llm:
+                llm.set_attributes(completion_tokens=12, finish_reason='stop')
+            iteration.set_attribute('outcome', 'executed')
+    with tracer.span('agent.run') as other:
+        pass
+    # exported when they end: children first
+    assert [s.name for s in exporter.spans] == ['llm.completion', 'agent.iteration', 'agent.run', 'agent.run']
+    assert run.parent_id is None and iteration.parent_id == run.span_id and llm.parent_id == iteration.span_id
+    assert run.trace_id == iteration.trace_id == llm.trace_id != other.trace_id
+    assert run.attributes == {'model': 'fake/model'} and iteration.attributes == {'iteration': 1, 'outcome': 'executed'}
+    assert llm.attributes == {'completion_tokens': 12, 'finish_reason': 'stop'}
+    assert all(s.status == 'OK' and s.duration >= 0 and s.end_ns >= s.start_ns for s in exporter.spans)
+
+
+def test_failed_spans_record_the_exception(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = Tracer(exporters=[JsonlSpanExporter(str(path))])
+    with pytest.raises(ValueError):
+        with tracer.span('sandbox.run'):
+            raise ValueError("boom")
+    span = json.loads(path.read_text())
+    assert span['status'] == 'ERROR' and span['attributes'] == {'exception': 'ValueError: boom'}
+    assert span['parent_id'] is None and span['duration_ms'] >= 0
+
+
+def test_prometheus_exposition():
+    metrics = MetricsRegistry()
+    metrics.counter('agent_runs_total', 'Runs, by outcome').inc(outcome='success')
+    metrics.counter('agent_runs_total').inc(2, outcome='fail"ed\n')
+    durations = metrics.histogram('agent_span_duration_seconds', 'Durations', buckets=(0.1, 1.0))
+    durations.observe(0.05, span='llm')
+    durations.observe(0.5, span='llm')
+    durations.observe(5.0, span='llm')
+    assert metrics.render() == (
+        '# HELP agent_runs_total Runs, by outcome\n'
+        '# TYPE agent_runs_total counter\n'
+        'agent_runs_total{outcome="fail\\"ed\\n"} 2\n'
+        'agent_runs_total{outcome="success"} 1\n'
+        '# HELP agent_span_duration_seconds Durations\n'
+        '# TYPE agent_span_duration_seconds histogram\n'
+        'agent_span_duration_seconds_bucket{span="llm",le="0.1"} 1\n'
+        'agent_span_duration_seconds_bucket{span="llm",le="1.0"} 2\n'
+        'agent_span_duration_seconds_bucket{span="llm",le="+Inf"} 3\n'
+        'agent_span_duration_seconds_sum{span="llm"} 5.55\n'
+        'agent_span_duration_seconds_count{span="llm"} 3\n'
+    )
+
+
+def test_metrics_are_written_and_served(tmp_path):
+    metrics = MetricsRegistry()
+    metrics.counter('agent_runs_total', 'Runs').inc(outcome='success')
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    assert (tmp_path / 'metrics.prom').read_text() == metrics.render()
+    server = metrics.serve(0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5) as response:
+            assert response.read().decode('utf-8') == metrics.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_run_spans_and_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_tracer', tracing._tracer)
+    exporter = InMemorySpanExporter()
+    tracer = configure_tracing(exporters=[exporter])
+    code = (
+        "<reasoning>Try</reasoning><packages>bauplan</packages>"
+        "<code>try:\n    print(1)\nexcept Exception as e:\n    print(e)</code>"
+    )
+    # an error with no message must not break the bookkeeping of the iteration
+    errors = iter(['', None])
+    (tmp_path / 'etl_agent').mkdir()
+    run_react_loop(
+        templated_user_input="ETL from {s3_raw_bucket}",
+        s3_raw_bucket='s3://raw',
+        bauplan_api_key='fake',
+        model_name='fake/model',
+        max_tokens=1000,
+        temperature=0.2,
+        eb2_api_key='fake',
+        system_prompt='fake system prompt',
+        max_iterations=4,
+        llm_folder=str(tmp_path),
+        executor=FakeCodeExecutor(on_run=lambda c, p: ExecutorResponse(result=[], stdout=['1\n'], stderr=[], error=next(errors))),
+        completion_fn=ScriptedLLM([code, code, "<done>1</done>"])
+    )
+    (run,) = [s for s in exporter.spans if s.name == 'agent.run']
+    iterations = [s for s in exporter.spans if s.name == 'agent.iteration']
+    assert [s.attributes.get('outcome') for s in iterations] == ['execution_error', 'executed', 'done']
+    assert iterations[0].attributes['retry_reason'] == ''
+    assert all(s.parent_id == run.span_id for s in iterations)
+    stages = {s.name for s in exporter.spans if s.parent_id == iterations[0].span_id}
+    assert {'llm.completion', 'response.parse', 'sandbox.run'} <= stages
+    rendered = tracer.metrics.render()
+    assert 'agent_iterations_total{outcome="execution_error"} 1' in rendered
+    assert 'agent_span_duration_seconds_count{span="agent.run"} 1' in rendered
@@ -0,0 +1,74 @@
+import pytest
+
+from fakes import FakeBauplanClient, FakeQueryResult
+from verifier import EXPECTED_TABLES, build_verification_report, verify_etl_process
+
+
+class NullIdsClient(FakeBauplanClient):
+    # the aggregates of the fees table report 3 null values in its ID column
+
+    def query(self, query: str, ref: str = 'main'):
+        result = super().query(query, ref)
+        if 'FROM fees' in query:
+            row = dict(result.rows[0])
+            row['non_null_0'] -= 3
+            row['distinct_ids'] -= 3
+            return FakeQueryResult(result.column_names, [row])
+        return result
+
+
+def _lakehouse(cls=FakeBauplanClient, skip: str = None, schemas: dict = None):
+    # every expected table, imported in main with 10 rows
+    client = cls(schemas={**{t.name: t.expected_columns for t in EXPECTED_TABLES}, **(schemas or {})})
+    for t in EXPECTED_TABLES:
+        if t.name != skip:
+            client.create_table(t.name, search_uri=f"s3://raw/{t.name}.parquet", branch='main')
+            client.import_data(t.name, search_uri=f"s3://raw/{t.name}.parquet", branch='main')
+    return client
+
+
+def _reports(client) -> tuple:
+    report = build_verification_report(client)
+    return report, {t.table: t for t in report.tables}
+
+
+def test_all_tables_pass():
+    report, tables = _reports(_lakehouse())
+    assert report.ok and report.branch == 'main' and list(tables) == [t.name for t in EXPECTED_TABLES]
+    fees = tables['fees']
+    assert fees.ok and fees.exists and fees.errors == [] and fees.row_count == 10
+    assert fees.id_column == 'ID' and fees.duplicate_ids == 0 and fees.missing_columns == []
+    assert set(fees.null_ratios.values()) == {0}
+    assert verify_etl_process(client=_lakehouse())
+
+
+def test_missing_table():
+    report, tables = _reports(_lakehouse(skip='payments'))
+    assert not report.ok and [t for t, r in tables.items() if not r.ok] == ['payments']
+    payments = tables['payments']
+    assert not payments.exists and payments.row_count is None and payments.columns == []
+    assert payments.errors == ["Table payments does not exist in the lakehouse"]
+
+
+def test_missing_columns():
+    client = _lakehouse(schemas={'merchant_data': ['merchant', 'acquirer', 'extra']})
+    report, tables = _reports(client)
+    merchants = tables['merchant_data']
+    assert not report.ok and merchants.exists and merchants.row_count == 10
+    assert merchants.missing_columns == ['account_type', 'capture_delay', 'merchant_category_code']
+    assert merchants.errors == [
+        "Table merchant_data is missing the columns ['account_type', 'capture_delay', 'merchant_category_code']"
+    ]
+    # the ID column itself missing is reported, and its checks skipped
+    report, tables = _reports(_lakehouse(schemas={'fees': ['card_scheme', 'rate']}))
+    assert tables['fees'].id_column is None and tables['fees'].duplicate_ids is None
+    assert "Table fees does not have its ID column ID" in tables['fees'].errors
+
+
+def test_null_ids():
+    report, tables = _reports(_lakehouse(cls=NullIdsClient))
+    fees = tables['fees']
+    assert not report.ok and [t for t, r in tables.items() if not r.ok] == ['fees']
+    assert fees.null_ratios['ID'] == pytest.approx(0.3) and fees.duplicate_ids == 0
+    assert fees.errors == ["Table fees has null values in ID"]
+    assert not verify_etl_process(client=_lakehouse(cls=NullIdsClient))
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import FakeBauplanClient
+from wap import audit_query, detect_id_column, run_wap
+
+
+TABLES = ['acquirer_countries', 'merchant_category_codes', 'fees', 'merchant_data']
+URIS = {t: f"s3://raw/{t}.parquet" for t in TABLES}
+
+
+class EmptyImportClient(FakeBauplanClient):
+    # the import of `empty` succeeds, with no rows
+    def __init__(self, empty: str, **kwargs):
+        super().__init__(**kwargs)
+        self.empty = empty
+
+    def import_data(self, table: str, search_uri: str, branch: str, num_rows: int = 10):
+        return super().import_data(table, search_uri, branch, num_rows=0 if table == self.empty else num_rows)
+
+
+class FailingImportClient(FakeBauplanClient):
+    # the import of `failing` returns an error state, like a failed bauplan job
+    def __init__(self, failing: str, **kwargs):
+        super().__init__(**kwargs)
+        self.failing = failing
+
+    def import_data(self, table: str, search_uri: str, branch: str, num_rows: int = 10):
+        if table == self.failing:
+            return SimpleNamespace(error=f"no files found at {search_uri}")
+        return super().import_data(table, search_uri, branch, num_rows)
+
+
+def test_audit_passes_and_merges():
+    client = FakeBauplanClient()
+    result = run_wap(client, URIS)
+    assert result.ok and result.merged and not result.errors
+    assert [a.table for a in result.tables] == TABLES and all(a.ok and a.row_count == 10 for a in result.tables)
+    assert all(client.has_table(t) for t in TABLES)
+    assert not client.has_branch(result.branch)
+
+
+def test_failed_audit_merges_nothing_and_deletes_the_branch():
+    client = EmptyImportClient('fees')
+    result = run_wap(client, URIS)
+    assert not result.ok and not result.merged
+    assert result.errors == ["Table fees is empty"]
+    assert not any(client.has_table(t) for t in TABLES)
+    assert not client.has_branch(result.branch)
+
+
+def test_failed_import_deletes_the_branch():
+    client = FailingImportClient('merchant_data')
+    result = run_wap(client, URIS, branch='fake_user.wap_test')
+    assert not result.ok and not result.merged and result.tables == []
+    assert "Could not import merchant_data" in result.errors[0]
+    assert not client.has_branch('fake_user.wap_test')
+    assert not any(client.has_table(t) for t in TABLES)
+
+
+def test_failed_merge_deletes_the_branch():
+    client = FakeBauplanClient()
+
+    def merge_branch(source_ref, into_branch='main'):
+        raise RuntimeError("merge conflict")
+
+    client.merge_branch = merge_branch
+    result = run_wap(client, URIS, branch='fake_user.wap_test')
+    assert not result.ok and not result.merged
+    assert "merge conflict" in result.errors[0]
+    assert not client.has_branch('fake_user.wap_test')
+
+
+def test_no_merge_keeps_the_audited_branch():
+    client = FakeBauplanClient()
+    result = run_wap(client, URIS, branch='fake_user.candidate', merge=False)
+    assert result.ok and not result.merged
+    assert client.has_branch('fake_user.candidate')
+    assert all(client.has_table(t, ref='fake_user.candidate') for t in TABLES)
+    assert not any(client.has_table(t) for t in TABLES)
+
+
+def test_existing_branch_is_an_error_and_left_untouched():
+    client = FakeBauplanClient()
+    client.create_branch('fake_user.mine')
+    client.create_table('keep_me', search_uri='s3://raw/keep_me.parquet', branch='fake_user.mine')
+    with pytest.raises(ValueError, match="already exists"):
+        run_wap(client, URIS, branch='fake_user.mine')
+    assert client.has_table('keep_me', ref='fake_user.mine')
+
+
+def test_existing_branch_is_recreated_with_replace():
+    client = FakeBauplanClient()
+    client.create_branch('fake_user.mine')
+    client.create_table('stale', search_uri='s3://raw/stale.parquet', branch='fake_user.mine')
+    result = run_wap(client, URIS, branch='fake_user.mine', merge=False, replace=True)
+    assert result.ok
+    assert not client.has_table('stale', ref='fake_user.mine')
+
+
+def test_id_columns_and_audit_query():
+    assert detect_id_column('fees', ['ID', 'card_scheme']) == 'ID'
+    assert detect_id_column('payments', ['psp_reference', 'merchant']) == 'psp_reference'
+    assert detect_id_column('merchant_data', ['merchant', 'mcc']) == 'merchant'
+    assert detect_id_column('fees', ['card_scheme', 'fixed_amount']) is None
+    query = audit_query({'fees': 'ID', 'acquirer_countries': None})
+    assert query.count('UNION ALL') == 1
+    assert 'COUNT(DISTINCT "ID")' in query and 'NULL AS distinct_ids' in query